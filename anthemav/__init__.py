@@ -4,4 +4,12 @@ This module provides a unified asyncio network handler for interacting with
 home A/V receivers and processors made by Anthem ( http://www.anthemav.com/ )
 """
 from .connection import Connection      # noqa: F401
-from .protocol import AVR               # noqa: F401
+from .protocol import AVR, CommandError # noqa: F401
+from .metrics import Metrics            # noqa: F401
+from .zone import Zone                  # noqa: F401
+from .fleet import ConnectionManager    # noqa: F401
+from .capture import Recorder, replay   # noqa: F401
+from .profiles import Profiles          # noqa: F401
+from .cache import StateCache           # noqa: F401
+from .events import Change, EventStream, Subscription  # noqa: F401
+from .sync import SyncAVR               # noqa: F401
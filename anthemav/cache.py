@@ -0,0 +1,93 @@
+"""Module containing the persisted state cache for the AVR interface."""
+import asyncio
+import json
+import logging
+import os
+
+__all__ = ('StateCache')
+
+
+class StateCache:
+    """Last known state of devices, kept in a JSON file across restarts.
+
+    Entries are keyed by the MAC address (IDN) each device reports, and the
+    name a device was reached under (host:port for a Connection) is kept as
+    an alias of its MAC so the entry can be found again before the device
+    has identified itself.  The file holds::
+
+        {"devices": {mac: {"state": {key: value}, "inputs": {number: name}}},
+         "aliases": {name: mac}}
+
+    Writes are debounced: a change only marks the device dirty, and the file
+    is rewritten at most once every delay seconds for all devices sharing
+    the cache.
+    """
+
+    def __init__(self, path, delay=5, loop=None):
+        """Open the cache, loading the file if it exists.
+
+            :param path: JSON file holding the cache
+            :param delay: seconds to gather changes before writing the file
+            :param loop: asyncio event loop (optional)
+            :type path: str
+            :type delay: int or float
+            :type loop: asyncio.loop
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.delay = delay
+        self._loop = loop or asyncio.get_event_loop()
+        self._devices = {}
+        self._aliases = {}
+        self._dirty = set()
+        self._handle = None
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        """Merge the entries stored in the cache file."""
+        with open(self.path) as cache_file:
+            data = json.load(cache_file)
+        self._devices.update(data.get('devices', {}))
+        self._aliases.update(data.get('aliases', {}))
+
+    def lookup(self, name):
+        """Return the entry for a MAC address or alias (or None)."""
+        return self._devices.get(self._aliases.get(name, name))
+
+    def changed(self, avr):
+        """Schedule a write of the state of avr."""
+        self._dirty.add(avr)
+        if self._handle is None:
+            self._handle = self._loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        """Write all pending changes to the cache file now."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        dirty = self._dirty
+        self._dirty = set()
+
+        updated = False
+        for avr in dirty:
+            entry = avr.export_state()
+            mac = entry['state'].get('IDN')
+            if not mac:
+                continue
+            self._devices[mac] = entry
+            if avr.device_name is not None:
+                self._aliases[avr.device_name] = mac
+            updated = True
+        if updated:
+            self.save()
+
+    def save(self):
+        """Rewrite the cache file with every known entry."""
+        data = {'devices': self._devices, 'aliases': self._aliases}
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as cache_file:
+            json.dump(data, cache_file, sort_keys=True)
+        os.replace(temp, self.path)
+        self.log.debug('Saved state of %d devices to %s',
+                       len(self._devices), self.path)
@@ -0,0 +1,144 @@
+"""Module containing wire-traffic capture and replay for the AVR interface."""
+import asyncio
+import struct
+import time
+
+__all__ = ('Recorder', 'read_capture', 'replay')
+
+MAGIC = b'ANTHCAP1'
+
+INBOUND = 0
+OUTBOUND = 1
+
+# monotonic timestamp, direction, payload length
+RECORD = struct.Struct('<dBI')
+
+# Chunks replayed at full speed between yields to the event loop
+REPLAY_BATCH = 64
+
+
+class Recorder:
+    """Append-only capture file of the bytes exchanged with a device.
+
+    Every chunk handed to data_received and every transport write is stored
+    as it happened, with a monotonic timestamp, so a capture reproduces the
+    original TCP segmentation as well as the timing.  A file starts with an
+    8 byte magic header followed by fixed-size record headers and payloads.
+    """
+
+    def __init__(self, path):
+        """Open (or append to) a capture file.
+
+            :param path: file to write the capture to
+            :type path: str
+        """
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def record(self, direction, data):
+        """Append one chunk of traffic (INBOUND or OUTBOUND)."""
+        self._file.write(RECORD.pack(time.monotonic(), direction, len(data)))
+        self._file.write(data)
+
+    def flush(self):
+        """Push buffered records to disk."""
+        self._file.flush()
+
+    def close(self):
+        """Flush and close the capture file."""
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_capture(path):
+    """Iterate over the records of a capture file.
+
+    yields (timestamp, direction, data) tuples in the order they were
+    recorded; a record truncated by a crash ends the iteration
+    """
+    with open(path, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not an anthemav capture file: %s' % (path))
+        while True:
+            header = capture.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            stamp, direction, length = RECORD.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                return
+            yield stamp, direction, data
+
+
+class _NullTransport(asyncio.Transport):
+    """Transport that discards writes, used while replaying a capture."""
+
+    def write(self, data):
+        pass
+
+    def get_write_buffer_limits(self):
+        return (0, 0)
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@asyncio.coroutine
+def replay(avr, path, speed=1, loop=None):
+    """Feed the inbound traffic of a capture through an AVR protocol handler.
+
+    Each recorded chunk is passed to avr.data_received(), so the handler
+    parses exactly the segments the device originally sent.  If avr is not
+    connected it is given a transport that discards its writes for the
+    duration of the replay, and detached again afterwards without calling
+    its connection_lost_callback (so the Connection it may belong to does
+    not start reconnecting).  Replaying as fast as possible still yields to
+    the event loop every REPLAY_BATCH chunks, and event streams cannot
+    pause a replay: a blocking stream simply fills up.
+
+        :param avr: protocol handler to feed
+        :param path: capture file written by Recorder
+        :param speed: playback rate relative to the recording (2 replays
+            twice as fast); None replays as fast as possible
+        :param loop: asyncio event loop (optional)
+
+        :type avr: anthemav.AVR
+        :type path: str
+        :type speed: int or float
+        :type loop: asyncio.loop
+
+    returns the number of chunks replayed
+    """
+    loop = loop or asyncio.get_event_loop()
+    attached = avr.transport is None
+    if attached:
+        avr.connection_made(_NullTransport())
+
+    chunks = 0
+    started = None
+    try:
+        for stamp, direction, data in read_capture(path):
+            if direction != INBOUND:
+                continue
+            if speed:
+                if started is None:
+                    started = (stamp, loop.time())
+                delay = started[1] + (stamp - started[0]) / speed - loop.time()
+                if delay > 0:
+                    yield from asyncio.sleep(delay, loop=loop)
+            elif chunks % REPLAY_BATCH == REPLAY_BATCH - 1:
+                yield from asyncio.sleep(0, loop=loop)
+            avr.data_received(data)
+            chunks += 1
+    finally:
+        if attached:
+            avr.detach()
+    return chunks
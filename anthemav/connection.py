@@ -1,7 +1,10 @@
 """Module containing the connection wrapper for the AVR interface."""
 import asyncio
 import logging
-from .protocol import AVR
+import random
+import socket
+from .metrics import Metrics
+from .protocol import AVR, CommandError
 
 __all__ = ('Connection')
 
@@ -22,7 +25,11 @@ class Connection:
     @asyncio.coroutine
     def create(cls, host='localhost', port=14999,
                auto_reconnect=True, loop=None, protocol_class=AVR,
-               update_callback=None):
+               update_callback=None, commands_per_second=100, command_burst=1,
+               metrics=False, max_write_size=256, update_window=None, zones=1,
+               wait=True, scheduler=None, retry_base=1, retry_cap=300,
+               capture=None, coalesce=False, profiles=None, state_cache=None,
+               keepalive=None, heartbeat=None, heartbeat_timeout=5):
         """Initiate a connection to a specific device.
 
         Here is where we supply the host and port and callback callables we
@@ -38,6 +45,44 @@ class Connection:
             asyncio.loop for async operation
         :param update_callback"
             This function is called whenever AVR state data changes
+        :param commands_per_second:
+            Maximum rate at which commands are written to the device
+        :param command_burst:
+            Maximum number of queued commands joined into a single write
+        :param metrics:
+            Collect runtime metrics, shared by the Connection and its protocol
+        :param max_write_size:
+            Largest single write (in bytes) the device is sent
+        :param update_window:
+            Coalesce changes for this many seconds (0 for one burst) and call
+            update_callback once with a dict of {key: (old, new)}
+        :param zones:
+            Number of zones (1-3) queried by a full refresh
+        :param wait:
+            Wait for the first connection before returning; otherwise it is
+            made in the background
+        :param scheduler:
+            ReconnectScheduler shared with other connections, which gates
+            every connection attempt (optional)
+        :param retry_base:
+            Shortest delay in seconds between failed connection attempts
+        :param retry_cap:
+            Longest delay in seconds between failed connection attempts
+        :param capture:
+            Record all traffic to and from the device in this capture file
+        :param coalesce:
+            Send only the latest of several queued commands for the same key
+        :param profiles:
+            Capability profiles used to skip queries the model rejects
+        :param state_cache:
+            Cache of the last known device state, found again by host:port
+        :param keepalive:
+            Enable TCP keepalive, probing after this many idle seconds
+        :param heartbeat:
+            Query the device after this many seconds without receiving
+            anything, and reconnect if it does not answer
+        :param heartbeat_timeout:
+            Seconds the device has to answer a heartbeat query
 
         :type host:
             str
@@ -49,6 +94,40 @@ class Connection:
             asyncio.loop
         :type update_callback:
             callable
+        :type commands_per_second:
+            int or float
+        :type command_burst:
+            int
+        :type metrics:
+            boolean
+        :type max_write_size:
+            int
+        :type update_window:
+            int or float
+        :type zones:
+            int
+        :type wait:
+            boolean
+        :type scheduler:
+            anthemav.fleet.ReconnectScheduler
+        :type retry_base:
+            int or float
+        :type retry_cap:
+            int or float
+        :type capture:
+            str
+        :type coalesce:
+            boolean
+        :type profiles:
+            anthemav.profiles.Profiles
+        :type state_cache:
+            anthemav.cache.StateCache
+        :type keepalive:
+            int
+        :type heartbeat:
+            int or float
+        :type heartbeat_timeout:
+            int or float
         """
         assert port >= 0, 'Invalid port value: %r' % (port)
         conn = cls()
@@ -56,22 +135,48 @@ class Connection:
         conn.host = host
         conn.port = port
         conn._loop = loop or asyncio.get_event_loop()
-        conn._retry_interval = 1
+        conn._retry_base = retry_base
+        conn._retry_cap = retry_cap
+        conn._retry_interval = retry_base
         conn._closed = False
         conn._closing = False
         conn._halted = False
+        conn._resumed = asyncio.Event(loop=conn._loop)
+        conn._resumed.set()
+        conn._retry_now = asyncio.Event(loop=conn._loop)
+        conn._connected_event = asyncio.Event(loop=conn._loop)
         conn._auto_reconnect = auto_reconnect
+        conn._disconnected_at = None
+        conn._attempted = False
+        conn._last_error = None
+        conn._scheduler = scheduler
+        conn._keepalive = keepalive
+        conn._heartbeat_interval = heartbeat
+        conn._heartbeat_timeout = heartbeat_timeout
+        conn._heartbeat_task = None
+        conn.metrics = Metrics() if metrics else None
 
         def connection_lost():
             """Function callback for Protocoal class when connection is lost."""
+            conn._disconnected_at = conn._loop.time()
+            conn._connected_event.clear()
             if conn._auto_reconnect and not conn._closing:
                 ensure_future(conn._reconnect(), loop=conn._loop)
 
         conn.protocol = protocol_class(
             connection_lost_callback=connection_lost, loop=conn._loop,
-            update_callback=update_callback)
+            update_callback=update_callback,
+            commands_per_second=commands_per_second,
+            command_burst=command_burst, metrics=conn.metrics,
+            max_write_size=max_write_size, update_window=update_window,
+            zones=zones, capture=capture, coalesce=coalesce,
+            profiles=profiles, state_cache=state_cache,
+            device_name='%s:%d' % (host, port))
 
-        yield from conn._reconnect()
+        if wait:
+            yield from conn._reconnect()
+        else:
+            ensure_future(conn._reconnect(), loop=conn._loop)
 
         return conn
 
@@ -84,40 +189,199 @@ class Connection:
         """
         return self.protocol.transport
 
+    @property
+    def connected(self):
+        """Report if the device connection is currently established."""
+        return self.protocol.transport is not None
+
+    def health(self):
+        """Summarize the state of the connection for monitoring.
+
+        returns a dict with the connection status, the seconds spent in the
+        current outage (if any), the last connection error and the number of
+        commands waiting to be sent
+        """
+        if self._disconnected_at is None:
+            disconnected_for = 0
+        else:
+            disconnected_for = self._loop.time() - self._disconnected_at
+        return {'host': self.host,
+                'port': self.port,
+                'connected': self.connected,
+                'halted': self._halted,
+                'closing': self._closing,
+                'disconnected_for': disconnected_for,
+                'retry_interval': self._retry_interval,
+                'last_error': self._last_error,
+                'queue_depth': self.protocol.queue_depth}
+
     def _get_retry_interval(self):
         return self._retry_interval
 
     def _reset_retry_interval(self):
-        self._retry_interval = 1
+        self._retry_interval = self._retry_base
 
     def _increase_retry_interval(self):
-        self._retry_interval = min(300, 1.5 * self._retry_interval)
+        """Pick the next retry delay using decorrelated jitter.
+
+        Each delay is drawn at random between retry_base and three times the
+        previous delay (capped at retry_cap), so devices that failed together
+        drift apart instead of retrying in lockstep.
+        """
+        self._retry_interval = min(
+            self._retry_cap,
+            random.uniform(self._retry_base, 3 * self._retry_interval))
+
+    def _connected(self):
+        """Record a successful (re)connection and wake up any waiters."""
+        if self.metrics is not None and self._disconnected_at is not None:
+            self.metrics.inc('disconnected_seconds',
+                             self._loop.time() - self._disconnected_at)
+        self._disconnected_at = None
+        self._connected_event.set()
+
+    @asyncio.coroutine
+    def wait_connected(self, timeout=None):
+        """Wait until the device connection is established.
+
+            :param timeout: seconds to wait (None waits forever)
+            :type timeout: int or float
+
+        returns True if connected, False if the timeout expired first
+        """
+        try:
+            yield from asyncio.wait_for(self._connected_event.wait(), timeout,
+                                        loop=self._loop)
+        except asyncio.TimeoutError:
+            return False
+        return True
 
     @asyncio.coroutine
     def _reconnect(self):
-        while True:
+        while not self._closing:
             try:
                 if self._halted:
-                    yield from asyncio.sleep(2, loop=self._loop)
+                    yield from self._resumed.wait()
                 else:
-                    self.log.info('Connecting to Anthem AVR at %s:%d',
-                                  self.host, self.port)
-                    yield from self._loop.create_connection(
-                        lambda: self.protocol, self.host, self.port)
+                    if self._scheduler is not None:
+                        yield from self._scheduler.acquire()
+                    try:
+                        self.log.info('Connecting to Anthem AVR at %s:%d',
+                                      self.host, self.port)
+                        if self._attempted and self.metrics is not None:
+                            self.metrics.inc('reconnect_attempts')
+                        self._attempted = True
+                        yield from self._loop.create_connection(
+                            lambda: self.protocol, self.host, self.port)
+                    finally:
+                        if self._scheduler is not None:
+                            self._scheduler.release()
                     self._reset_retry_interval()
+                    self._connected()
+                    self._configure_keepalive()
+                    self._start_heartbeat()
+                    if self._closing and self.protocol.transport:
+                        self.protocol.transport.close()
                     return
 
-            except OSError:
+            except OSError as exc:
+                self._last_error = str(exc)
                 self._increase_retry_interval()
                 interval = self._get_retry_interval()
-                self.log.warning('Connecting failed, retrying in %i seconds',
-                              interval)
-                yield from asyncio.sleep(interval, loop=self._loop)
+                self.log.warning('Connecting failed, retrying in %.1f seconds',
+                                 interval)
+                yield from self._retry_wait(interval)
+
+    @asyncio.coroutine
+    def _retry_wait(self, interval):
+        """Sleep between connection attempts, cut short by resume() or close()."""
+        self._retry_now.clear()
+        try:
+            yield from asyncio.wait_for(self._retry_now.wait(), interval,
+                                        loop=self._loop)
+        except asyncio.TimeoutError:
+            pass
+
+    def _configure_keepalive(self):
+        """Turn on TCP keepalive for the current socket if requested.
+
+        The kernel probes the device after keepalive idle seconds and gives
+        up after three unanswered probes a third of that apart, which is
+        reported as a lost connection.  Options missing on the platform are
+        skipped.
+        """
+        if not self._keepalive or self.transport is None:
+            return
+        sock = self.transport.get_extra_info('socket')
+        if sock is None:
+            return
+        interval = max(1, int(self._keepalive) // 3)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', int(self._keepalive)),
+                              ('TCP_KEEPALIVE', int(self._keepalive)),
+                              ('TCP_KEEPINTVL', interval),
+                              ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def _start_heartbeat(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self._heartbeat_interval and self.transport is not None:
+            self._heartbeat_task = ensure_future(
+                self._heartbeat(self.transport), loop=self._loop)
+
+    @asyncio.coroutine
+    def _heartbeat(self, transport):
+        """Make sure a quiet connection is still alive.
+
+        Whenever nothing has been received for the heartbeat interval the
+        device is asked for its power state.  A half-open connection never
+        answers, so if no reply arrives within heartbeat_timeout the
+        transport is aborted, which triggers the usual reconnect.  No probe
+        is made while an event stream has paused reading, since its reply
+        could not be read anyway.
+        """
+        protocol = self.protocol
+        while protocol.transport is transport:
+            if protocol.reading_paused:
+                yield from asyncio.sleep(self._heartbeat_interval,
+                                         loop=self._loop)
+                continue
+            idle = self._loop.time() - protocol.last_received
+            if idle < self._heartbeat_interval:
+                yield from asyncio.sleep(self._heartbeat_interval - idle,
+                                         loop=self._loop)
+                continue
+            try:
+                yield from protocol.fetch('Z1POW', self._heartbeat_timeout)
+            except CommandError:
+                pass
+            except asyncio.TimeoutError:
+                if protocol.transport is not transport:
+                    return
+                if protocol.reading_paused:
+                    continue
+                self.log.warning('No heartbeat from AVR in %.1f seconds, '
+                                 'reconnecting', self._heartbeat_timeout)
+                self._last_error = 'heartbeat timeout'
+                if self.metrics is not None:
+                    self.metrics.inc('heartbeat_failures')
+                transport.abort()
+                return
+            except ConnectionError:
+                return
 
     def close(self):
         """Close the AVR device connection and don't try to reconnect."""
         self.log.warning('Closing connection to AVR')
         self._closing = True
+        self._resumed.set()
+        self._retry_now.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
         if self.protocol.transport:
             self.protocol.transport.close()
 
@@ -125,6 +389,7 @@ class Connection:
         """Close the AVR device connection and wait for a resume() request."""
         self.log.warning('Halting connection to AVR')
         self._halted = True
+        self._resumed.clear()
         if self.protocol.transport:
             self.protocol.transport.close()
 
@@ -132,6 +397,8 @@ class Connection:
         """Resume the AVR device connection if we have been halted."""
         self.log.warning('Resuming connection to AVR')
         self._halted = False
+        self._resumed.set()
+        self._retry_now.set()
 
     @property
     def dump_conndata(self):
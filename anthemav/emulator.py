@@ -0,0 +1,277 @@
+"""Local emulation of an Anthem receiver for testing and load generation."""
+import argparse
+import asyncio
+import collections
+import logging
+
+from .protocol import ATTR_CORE, ATTRIBUTES, match_key
+from .zone import ZONE_KEYS
+
+__all__ = ('Emulator', 'main')
+
+# Values reported by a freshly started emulator
+DEFAULTS = {'IDM': 'MRX 520', 'IDS': '1.0.0', 'IDR': 'US',
+            'IDB': 'Jan 01 2018', 'IDH': '1.0', 'IDN': '00:11:22:33:44:55',
+            'ECH': '0', 'SIP': '1', 'FPB': '2', 'ICN': '3'}
+
+ZONE_DEFAULTS = {'POW': '0', 'VOL': '-40', 'INP': '1', 'MUT': '0', 'ARC': '1',
+                 'VIR': '2', 'IRH': '1920', 'IRV': '1080', 'AIC': '4',
+                 'AIF': '3', 'BRT': '640', 'SRT': '48', 'AIN': 'Dolby Digital',
+                 'AIR': '48 kHz', 'ALM': '00', 'DYN': '0', 'DIA': '-27'}
+
+INPUT_NAMES = {1: 'Blu-ray', 2: 'Game', 3: 'TV'}
+
+# Seconds between the pieces of a fragmented response
+FRAGMENT_GAP = 0.002
+
+
+class Emulator:
+    """Asyncio TCP server speaking the Anthem IP control protocol.
+
+    The emulator answers KEY? queries from a state table seeded with every
+    attribute the AVR class knows about, applies KEYvalue commands and, while
+    Tx status (ECH) is on, reports every change to all connected clients, the
+    way a real receiver does.  It can also misbehave on purpose: reject
+    selected keys with !I, answer !E while it is still powering on, reply
+    after a fixed latency and split its responses into small TCP segments.
+    """
+
+    def __init__(self, host='127.0.0.1', port=14999, loop=None, state=None,
+                 input_names=None, unsupported=(), poweron_lag=0, latency=0,
+                 fragment=None):
+        """Create an emulator (call start() to begin listening).
+
+            :param host: address to listen on
+            :param port: TCP port to listen on (0 picks a free port)
+            :param loop: asyncio event loop (optional)
+            :param state: attribute values overriding the defaults
+            :param input_names: {number: name} of the configured inputs
+            :param unsupported: keys answered with !I, like an older model
+            :param poweron_lag: seconds after Zone 1 power on during which
+                all but the core queries are answered with !E
+            :param latency: seconds to wait before every response
+            :param fragment: if set, split responses into writes of at most
+                this many bytes
+
+            :type host: str
+            :type port: int
+            :type loop: asyncio.loop
+            :type state: dict
+            :type input_names: dict
+            :type unsupported: iterable of str
+            :type poweron_lag: int or float
+            :type latency: int or float
+            :type fragment: int
+        """
+        self.log = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self._loop = loop or asyncio.get_event_loop()
+        self.state = {key: '' for key in ATTRIBUTES}
+        self.state.update(DEFAULTS)
+        for keys in ZONE_KEYS.values():
+            for suffix, key in keys.items():
+                self.state[key] = ZONE_DEFAULTS[suffix]
+        self.state.update(state or {})
+        self.input_names = dict(INPUT_NAMES if input_names is None else input_names)
+        self.unsupported = set(unsupported)
+        self.poweron_lag = poweron_lag
+        self.latency = latency
+        self.fragment = fragment
+        self.clients = set()
+        self.received = []
+        self._ready_at = 0
+        self._server = None
+
+    @asyncio.coroutine
+    def start(self):
+        """Start listening; self.port is updated with the actual port."""
+        self._server = yield from self._loop.create_server(
+            lambda: _EmulatorProtocol(self), self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.log.info('Emulating Anthem AVR on %s:%d', self.host, self.port)
+
+    def close(self):
+        """Stop listening and drop every client connection."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for client in list(self.clients):
+            client.transport.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        """Wait until the server has shut down."""
+        if self._server is not None:
+            yield from self._server.wait_closed()
+
+    def push(self, key, value):
+        """Change an attribute as if it happened on the device itself."""
+        self._apply(key, value)
+
+    def disconnect_all(self):
+        """Drop every client connection but keep listening."""
+        for client in list(self.clients):
+            client.transport.close()
+
+    #
+    # Protocol implementation
+    #
+
+    def handle(self, client, message):
+        """Answer one datagram received from a client."""
+        self.received.append(message)
+        if message.endswith('?'):
+            self._query(client, message)
+        else:
+            self._command(client, message)
+
+    def _query(self, client, message):
+        key = message[:-1]
+        if key[:3] == 'ISN' and key[3:].isdigit():
+            name = self.input_names.get(int(key[3:]))
+            if name is None:
+                self._send(client, '!R'+message)
+            else:
+                self._send(client, key+name)
+            return
+
+        error = self._check(key)
+        if error is None and key not in ATTR_CORE and self._powering_on():
+            error = '!E'
+        if error is not None:
+            self._send(client, error+message)
+        else:
+            self._send(client, key+self.state[key])
+
+    def _command(self, client, message):
+        key = match_key(message)[0]
+        if key is None or key == 'ISN':
+            self._send(client, '!I'+message)
+            return
+
+        error = self._check(key)
+        value = message[len(key):]
+        if error is None and key.endswith('VOL'):
+            try:
+                if not -90 <= int(value) <= 0:
+                    error = '!R'
+            except ValueError:
+                error = '!R'
+        if error is not None:
+            self._send(client, error+message)
+        else:
+            self._apply(key, value)
+
+    def _check(self, key):
+        """Return the error code a query or command for key earns, if any."""
+        if key not in self.state or key in self.unsupported:
+            return '!I'
+        if key[:1] == 'Z' and not key.endswith('POW'):
+            if self.state[key[:2]+'POW'] != '1':
+                return '!Z'
+        return None
+
+    def _powering_on(self):
+        return self._loop.time() < self._ready_at
+
+    def _apply(self, key, value):
+        oldvalue = self.state.get(key)
+        self.state[key] = value
+        if key == 'Z1POW' and value == '1' and oldvalue != '1':
+            self._ready_at = self._loop.time() + self.poweron_lag
+        if self.state['ECH'] == '1':
+            for client in self.clients:
+                self._send(client, key+value)
+
+    def _send(self, client, message):
+        payload = (message+';').encode()
+        if self.fragment:
+            pieces = [payload[start:start+self.fragment]
+                      for start in range(0, len(payload), self.fragment)]
+        else:
+            pieces = [payload]
+
+        due = self._loop.time() + self.latency
+        for piece in pieces:
+            client.send(piece, due)
+            if self.fragment:
+                due += FRAGMENT_GAP
+
+
+class _EmulatorProtocol(asyncio.Protocol):
+    """One client connection to the emulator."""
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.transport = None
+        self.buffer = bytearray()
+        self._outbox = collections.deque()
+        self._last_due = 0
+        self._handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.emulator.clients.add(self)
+
+    def connection_lost(self, exc):
+        self.emulator.clients.discard(self)
+        self.transport = None
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def data_received(self, data):
+        self.buffer.extend(data)
+        *messages, tail = self.buffer.split(b';')
+        self.buffer = bytearray(tail)
+        for message in messages:
+            if message:
+                self.emulator.handle(self, message.decode('utf-8', 'replace'))
+
+    def send(self, data, due):
+        """Write data no earlier than loop time due, preserving order."""
+        self._last_due = max(due, self._last_due)
+        self._outbox.append((self._last_due, data))
+        if self._handle is None:
+            self._drain()
+
+    def _drain(self):
+        self._handle = None
+        loop = self.emulator._loop
+        now = loop.time()
+        while self._outbox and self._outbox[0][0] <= now:
+            data = self._outbox.popleft()[1]
+            if self.transport is not None:
+                self.transport.write(data)
+        if self._outbox and self.transport is not None:
+            self._handle = loop.call_at(self._outbox[0][0], self._drain)
+
+
+def main():
+    """Run an emulator from the command line until interrupted."""
+    parser = argparse.ArgumentParser(description=Emulator.__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', default='14999', help='Port to listen on')
+    parser.add_argument('--latency', default='0', help='Response delay (seconds)')
+    parser.add_argument('--poweron-lag', default='0',
+                        help='Seconds of !E replies after power on')
+    parser.add_argument('--fragment', default=None,
+                        help='Split responses into writes of this many bytes')
+    parser.add_argument('--verbose', '-v', action='count')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    emulator = Emulator(
+        host=args.host, port=int(args.port), loop=loop,
+        latency=float(args.latency), poweron_lag=float(args.poweron_lag),
+        fragment=int(args.fragment) if args.fragment else None)
+    loop.run_until_complete(emulator.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
@@ -0,0 +1,231 @@
+"""Module containing the state change event streams of the AVR interface."""
+import asyncio
+import collections
+
+__all__ = ('Change', 'EventStream', 'Subscription')
+
+# One state change: attribute key (ISNnn for input names), old and new value
+Change = collections.namedtuple('Change', ('key', 'oldvalue', 'value'))
+
+# What a full stream does with another change:
+#   drop_oldest: discard the oldest queued change
+#   coalesce:    merge changes per key, discarding the oldest key when full
+#   block:       keep it, and stop reading from the device until the
+#                consumer has caught up
+POLICIES = ('drop_oldest', 'coalesce', 'block')
+
+
+class Subscription:
+    """Handle of a callback registered with AVR.subscribe()."""
+
+    __slots__ = ('keys', 'callback', 'immediate', '_index')
+
+    def __init__(self, index, keys, callback, immediate):
+        """Create a handle; use SubscriberIndex.add() rather than this."""
+        self.keys = keys
+        self.callback = callback
+        self.immediate = immediate
+        self._index = index
+
+    @property
+    def active(self):
+        """Report if the subscription still receives changes."""
+        return self._index is not None
+
+    def cancel(self):
+        """Stop delivering changes to the callback."""
+        if self._index is not None:
+            self._index.remove(self)
+            self._index = None
+
+
+class SubscriberIndex:
+    """Subscriptions indexed by the keys they are interested in.
+
+    Each key maps to an insertion-ordered dict used as a set of
+    subscriptions, with subscriptions to every key filed under None, so
+    publishing a change only visits the subscribers that want it and
+    cancelling a subscription costs one dict deletion per key.
+    """
+
+    __slots__ = ('_buckets',)
+
+    def __init__(self):
+        """Create an empty index."""
+        self._buckets = {}
+
+    def __bool__(self):
+        """Report if there are any subscriptions."""
+        return bool(self._buckets)
+
+    def add(self, keys, callback, immediate=False):
+        """Subscribe callback to keys (None for all) and return the handle."""
+        keys = (None,) if keys is None else frozenset(keys)
+        subscription = Subscription(self, keys, callback, immediate)
+        for key in keys:
+            self._buckets.setdefault(key, collections.OrderedDict())[subscription] = None
+        return subscription
+
+    def remove(self, subscription):
+        """Drop a subscription from every key it was filed under."""
+        for key in subscription.keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.pop(subscription, None)
+                if not bucket:
+                    del self._buckets[key]
+
+    def publish(self, change, loop):
+        """Hand change to every subscriber of its key.
+
+        Immediate subscribers (event streams) are called right away, all
+        others are scheduled on the loop so a callback can never hold up
+        parsing.
+        """
+        for key in (change.key, None):
+            bucket = self._buckets.get(key)
+            if bucket:
+                for subscription in tuple(bucket):
+                    if subscription.immediate:
+                        subscription.callback(change)
+                    else:
+                        loop.call_soon(subscription.callback, change)
+
+
+class EventStream:
+    """Bounded queue of state changes for a single consumer.
+
+    Streams are created with AVR.events() and are asynchronous iterators::
+
+        with avr.events(keys={'Z1VOL', 'Z1MUT'}) as stream:
+            async for change in stream:
+                ...
+
+    (or ``change = yield from stream.get()`` in generator based coroutines).
+    Delivering a change never waits for the consumer: a full stream discards
+    changes according to its policy, counting them in dropped, or with the
+    block policy pauses reading from the device until the queue has drained
+    to half its size.  Reading stops at the end of the received data
+    being parsed, so a blocking stream can briefly exceed maxsize by the
+    changes in that data.
+    """
+
+    def __init__(self, avr, keys=None, maxsize=100, policy='drop_oldest'):
+        """Create a stream; use AVR.events() rather than calling this.
+
+            :param avr: device the changes come from
+            :param keys: only deliver changes to these keys (default all)
+            :param maxsize: number of changes queued before the policy applies
+            :param policy: one of POLICIES
+            :type avr: anthemav.AVR
+            :type keys: iterable of str
+            :type maxsize: int
+            :type policy: str
+        """
+        if policy not in POLICIES:
+            raise ValueError('Invalid policy: %r' % (policy))
+        assert maxsize >= 1, 'Invalid maxsize value: %r' % (maxsize)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._avr = avr
+        if policy == 'coalesce':
+            self._queue = collections.OrderedDict()
+        else:
+            self._queue = collections.deque()
+        self._waiter = None
+        self._blocking = False
+        self._subscription = avr._subscribers.add(keys, self.put, immediate=True)
+
+    def __len__(self):
+        """Number of changes waiting to be read."""
+        return len(self._queue)
+
+    def __enter__(self):
+        """Return the stream itself; it is closed on exit."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the stream."""
+        self.close()
+
+    def __aiter__(self):
+        """Return the stream itself."""
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        """Wait for the next change, ending the iteration once closed."""
+        change = yield from self.get()
+        if change is None:
+            raise StopAsyncIteration  # noqa: F821 (Python 3.5+)
+        return change
+
+    def put(self, change):
+        """Queue a change, applying the policy if the stream is full."""
+        if self.closed:
+            return
+
+        queue = self._queue
+        if self.policy == 'coalesce':
+            queued = queue.get(change.key)
+            if queued is not None:
+                queue[change.key] = Change(change.key, queued.oldvalue, change.value)
+            else:
+                if len(queue) >= self.maxsize:
+                    queue.popitem(last=False)
+                    self._drop()
+                queue[change.key] = change
+        else:
+            if self.policy == 'drop_oldest' and len(queue) >= self.maxsize:
+                queue.popleft()
+                self._drop()
+            queue.append(change)
+            if self.policy == 'block' and len(queue) >= self.maxsize:
+                if not self._blocking:
+                    self._blocking = True
+                    self._avr._block_reading(self)
+
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    @asyncio.coroutine
+    def get(self):
+        """Wait for and return the next change (None once the stream is closed)."""
+        while not self._queue:
+            if self.closed:
+                return None
+            self._waiter = asyncio.Future(loop=self._avr._loop)
+            try:
+                yield from self._waiter
+            finally:
+                self._waiter = None
+
+        if self.policy == 'coalesce':
+            change = self._queue.popitem(last=False)[1]
+        else:
+            change = self._queue.popleft()
+        if self._blocking and len(self._queue) <= self.maxsize // 2:
+            self._unblock()
+        return change
+
+    def close(self):
+        """Stop delivering changes; queued changes can still be read."""
+        if self.closed:
+            return
+        self.closed = True
+        self._subscription.cancel()
+        self._unblock()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _unblock(self):
+        if self._blocking:
+            self._blocking = False
+            self._avr._unblock_reading(self)
+
+    def _drop(self):
+        self.dropped += 1
+        if self._avr.metrics is not None:
+            self._avr.metrics.inc('events_dropped')
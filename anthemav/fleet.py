@@ -0,0 +1,175 @@
+"""Module for managing connections to many AVRs on one event loop."""
+import asyncio
+import logging
+
+from .connection import Connection
+
+__all__ = ('ConnectionManager', 'ReconnectScheduler')
+
+
+class ReconnectScheduler:
+    """Gate shared by many Connections for their connection attempts.
+
+    At most max_concurrent connection attempts are in progress at once, and
+    attempts are started no faster than attempts_per_second.  When a whole
+    building of receivers drops off the network together, their reconnects
+    are spread out instead of all hitting the network in the same instant.
+    """
+
+    def __init__(self, max_concurrent=10, attempts_per_second=20, loop=None):
+        """Create a scheduler.
+
+            :param max_concurrent: simultaneous connection attempts allowed
+            :param attempts_per_second: rate at which attempts may start
+            :param loop: asyncio event loop (optional)
+            :type max_concurrent: int
+            :type attempts_per_second: int or float
+            :type loop: asyncio.loop
+        """
+        assert max_concurrent >= 1, \
+            'Invalid max_concurrent value: %r' % (max_concurrent)
+        assert attempts_per_second > 0, \
+            'Invalid attempts_per_second value: %r' % (attempts_per_second)
+        self._loop = loop or asyncio.get_event_loop()
+        self._semaphore = asyncio.Semaphore(max_concurrent, loop=self._loop)
+        self._interval = 1 / attempts_per_second
+        self._next_slot = 0
+
+    @asyncio.coroutine
+    def acquire(self):
+        """Wait until a connection attempt may start.
+
+        Every successful acquire() must be paired with a release().
+        """
+        yield from self._semaphore.acquire()
+        try:
+            now = self._loop.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+            if slot > now:
+                yield from asyncio.sleep(slot - now, loop=self._loop)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self):
+        """Signal that a connection attempt has finished."""
+        self._semaphore.release()
+
+
+class ConnectionManager:
+    """Maintain connections to a fleet of AVRs.
+
+    Devices are added and removed at runtime.  Each device gets a regular
+    Connection, created in the background so that add() never waits on the
+    network, and every Connection shares one ReconnectScheduler.
+    """
+
+    def __init__(self, loop=None, max_concurrent=10, attempts_per_second=20,
+                 **options):
+        """Create an empty fleet.
+
+            :param loop: asyncio event loop (optional)
+            :param max_concurrent: simultaneous connection attempts allowed
+            :param attempts_per_second: rate at which attempts may start
+            :param options: default keyword arguments for Connection.create
+
+            :type loop: asyncio.loop
+            :type max_concurrent: int
+            :type attempts_per_second: int or float
+        """
+        self.log = logging.getLogger(__name__)
+        self._loop = loop or asyncio.get_event_loop()
+        self._options = options
+        self.scheduler = ReconnectScheduler(
+            max_concurrent, attempts_per_second, loop=self._loop)
+        self.connections = {}
+
+    def __contains__(self, name):
+        """Report if a device of that name is part of the fleet."""
+        return name in self.connections
+
+    def __len__(self):
+        """Number of devices in the fleet."""
+        return len(self.connections)
+
+    @asyncio.coroutine
+    def add(self, host, port=14999, name=None, **options):
+        """Add a device to the fleet and start connecting to it.
+
+            :param host: Hostname or IP address of the device
+            :param port: TCP port number of the device
+            :param name: key for the device in the fleet (default host:port)
+            :param options: keyword arguments for Connection.create, which
+                override the fleet defaults
+
+        returns the new Connection, which may not be connected yet
+        """
+        if name is None:
+            name = '%s:%d' % (host, port)
+        if name in self.connections:
+            raise ValueError('Device already in fleet: %s' % (name))
+
+        kwargs = dict(self._options)
+        kwargs.update(options)
+        kwargs.update(host=host, port=port, loop=self._loop, wait=False,
+                      scheduler=self.scheduler)
+        conn = yield from Connection.create(**kwargs)
+        self.connections[name] = conn
+        self.log.info('Added %s to fleet (%d devices)', name, len(self))
+        return conn
+
+    @asyncio.coroutine
+    def add_many(self, hosts, **options):
+        """Add many devices at once.
+
+            :param hosts: (host, port) tuples or plain host names
+            :param options: keyword arguments for Connection.create
+
+        returns the list of new Connections
+        """
+        connections = []
+        for host in hosts:
+            if isinstance(host, str):
+                host = (host,)
+            connections.append((yield from self.add(*host, **options)))
+        return connections
+
+    def remove(self, name):
+        """Close the connection to a device and drop it from the fleet."""
+        conn = self.connections.pop(name)
+        conn.close()
+        self.log.info('Removed %s from fleet (%d devices)', name, len(self))
+
+    def close(self):
+        """Close every connection in the fleet."""
+        for name in list(self.connections):
+            self.remove(name)
+
+    @property
+    def connected_count(self):
+        """Number of devices currently connected."""
+        return sum(1 for conn in self.connections.values() if conn.connected)
+
+    def health(self):
+        """Return Connection.health() for every device, keyed by name."""
+        return {name: conn.health() for name, conn in self.connections.items()}
+
+    def state(self):
+        """Return the current attribute values of every device, keyed by name."""
+        return {name: conn.protocol.state.as_dict()
+                for name, conn in self.connections.items()}
+
+    @asyncio.coroutine
+    def wait_connected(self, timeout=None):
+        """Wait until every device in the fleet is connected.
+
+            :param timeout: seconds to wait (None waits forever)
+            :type timeout: int or float
+
+        returns True if they all connected within timeout seconds
+        """
+        results = yield from asyncio.gather(
+            *[conn.wait_connected(timeout) for conn in self.connections.values()],
+            loop=self._loop)
+        return all(results)
@@ -0,0 +1,154 @@
+"""Module containing lightweight runtime metrics for the AVR interface."""
+import bisect
+
+__all__ = ('Metrics')
+
+# Latency buckets (seconds) shared by every histogram
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+           0.1, 0.5, 1.0, 5.0)
+
+# name: (type, help text, label name)
+METRICS = {}
+
+METRICS['bytes_received'] = ('counter', 'Bytes received from the device', None)
+METRICS['bytes_sent'] = ('counter', 'Bytes written to the device', None)
+METRICS['messages_received'] = ('counter', 'Datagrams received from the device', None)
+METRICS['messages_sent'] = ('counter', 'Commands written to the device', None)
+METRICS['messages_by_key'] = ('counter', 'Datagrams received per protocol key', 'key')
+METRICS['errors'] = ('counter', 'Error responses received from the device', 'code')
+METRICS['unrecognized'] = ('counter', 'Datagrams not matching any known key', None)
+METRICS['parse_seconds'] = ('histogram', 'Time spent parsing each datagram', None)
+METRICS['callback_latency_seconds'] = (
+    'histogram', 'Delay between a state change and its update callback', None)
+METRICS['queue_depth'] = ('gauge', 'Commands waiting in the outbound queue', None)
+METRICS['reconnect_attempts'] = ('counter', 'Connection attempts after the first', None)
+METRICS['disconnected_seconds'] = (
+    'counter', 'Time spent without a connection to the device', None)
+METRICS['heartbeat_failures'] = (
+    'counter', 'Connections dropped for missing a heartbeat', None)
+METRICS['events_dropped'] = (
+    'counter', 'State changes discarded by full event streams', None)
+
+
+class Histogram:
+    """Fixed-bucket histogram of observed values."""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        """Create an empty histogram over BUCKETS."""
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record a single observation."""
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters, gauges and histograms for one device.
+
+    Instances are attached to AVR and Connection objects as their ``metrics``
+    attribute when metrics are enabled.  When they are disabled that
+    attribute is None and the hot paths skip all bookkeeping, so the only
+    cost is a single attribute check.
+    """
+
+    def __init__(self):
+        """Create an empty metrics registry."""
+        self._values = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, label=None):
+        """Increment a counter, optionally for a single label value."""
+        key = (name, label)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, label=None):
+        """Set a gauge to an absolute value."""
+        self._values[(name, label)] = value
+
+    def observe(self, name, value):
+        """Record an observation in a histogram."""
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def get(self, name, label=None):
+        """Return the current value of a counter or gauge."""
+        return self._values.get((name, label), 0)
+
+    def histogram(self, name):
+        """Return the Histogram recorded under name (or None)."""
+        return self._histograms.get(name)
+
+    def render_prometheus(self, namespace='anthemav', labels=None):
+        """Render all metrics in the Prometheus text exposition format.
+
+            :param namespace: prefix applied to every metric name
+            :param labels: constant labels added to every sample
+            :type namespace: str
+            :type labels: dict
+
+        returns the exposition text as a str
+        """
+        lines = []
+        for name in sorted(METRICS):
+            kind, description, label_name = METRICS[name]
+            fullname = '%s_%s' % (namespace, name)
+            if kind == 'counter':
+                fullname += '_total'
+
+            if kind == 'histogram':
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    continue
+                samples = self._histogram_samples(fullname, histogram, labels)
+            else:
+                samples = []
+                for (metric, label), value in sorted(
+                        self._values.items(), key=lambda item: str(item[0])):
+                    if metric != name:
+                        continue
+                    sample_labels = dict(labels or {})
+                    if label_name is not None:
+                        sample_labels[label_name] = label
+                    samples.append(_sample(fullname, sample_labels, value))
+                if not samples:
+                    continue
+
+            lines.append('# HELP %s %s' % (fullname, description))
+            lines.append('# TYPE %s %s' % (fullname, kind))
+            lines.extend(samples)
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram_samples(fullname, histogram, labels):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            bucket_labels = dict(labels or {})
+            bucket_labels['le'] = str(bound)
+            samples.append(_sample(fullname+'_bucket', bucket_labels, cumulative))
+        samples.append(_sample(fullname+'_sum', labels, histogram.total))
+        samples.append(_sample(fullname+'_count', labels, histogram.count))
+        return samples
+
+
+def _sample(name, labels, value):
+    """Format a single exposition line."""
+    if labels:
+        pairs = ','.join('%s="%s"' % (key, _escape(labels[key]))
+                         for key in sorted(labels))
+        return '%s{%s} %s' % (name, pairs, value)
+    return '%s %s' % (name, value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
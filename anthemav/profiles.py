@@ -0,0 +1,111 @@
+"""Module containing per-model capability profiles for the AVR interface."""
+import asyncio
+import json
+import logging
+import os
+
+__all__ = ('Profiles')
+
+# Attributes known to be unsupported, keyed by the model name reported in IDM.
+# Learned and user-supplied profiles are merged on top of these.
+PROFILES = {}
+
+
+class Profiles:
+    """Sets of unsupported attributes for each receiver model.
+
+    An AVR consults its model's profile to leave out queries the device is
+    known to reject, and adds every attribute it sees rejected to it.  One
+    instance can be shared by any number of devices (e.g. a whole fleet),
+    and with a path the learned profiles are kept in a JSON file of
+    {model: [key, ...]} which is loaded on creation.  Like StateCache,
+    writes are debounced: the file is rewritten at most once every delay
+    seconds after a profile changes.
+    """
+
+    def __init__(self, path=None, profiles=None, delay=5, loop=None):
+        """Create the profile table.
+
+            :param path: JSON file to load from and save to (optional)
+            :param profiles: {model: keys} to seed the table with, in
+                addition to the built-in PROFILES (optional)
+            :param delay: seconds to gather changes before writing the file
+            :param loop: asyncio event loop (optional)
+            :type path: str
+            :type profiles: dict
+            :type delay: int or float
+            :type loop: asyncio.loop
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.delay = delay
+        self._loop = loop or asyncio.get_event_loop()
+        self._profiles = {}
+        self._dirty = False
+        self._handle = None
+        self.update(PROFILES)
+        if path is not None and os.path.exists(path):
+            self.load(path)
+        self.update(profiles or {})
+
+    def __contains__(self, model):
+        """Report if there is a profile for model."""
+        return model in self._profiles
+
+    def unsupported(self, model):
+        """Return the set of attributes model is known not to support."""
+        return frozenset(self._profiles.get(model, ()))
+
+    def update(self, profiles):
+        """Merge {model: keys} into the table."""
+        for model, keys in profiles.items():
+            self._profiles.setdefault(model, set()).update(keys)
+
+    def record(self, model, key):
+        """Note that model rejected key, scheduling a save if it is new."""
+        keys = self._profiles.setdefault(model, set())
+        if key in keys:
+            return
+        keys.add(key)
+        self.log.info('Model %s does not support %s', model, key)
+        self.changed()
+
+    def forget(self, model, key):
+        """Note that model answered key after all, scheduling a save."""
+        keys = self._profiles.get(model)
+        if not keys or key not in keys:
+            return
+        keys.discard(key)
+        self.log.info('Model %s supports %s after all', model, key)
+        self.changed()
+
+    def changed(self):
+        """Schedule a write of the table (if it has a path)."""
+        if self.path is None:
+            return
+        self._dirty = True
+        if self._handle is None:
+            self._handle = self._loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        """Write pending changes to the profile file now."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._dirty:
+            self._dirty = False
+            self.save()
+
+    def load(self, path):
+        """Merge the profiles stored in a JSON file into the table."""
+        with open(path) as profile_file:
+            self.update(json.load(profile_file))
+
+    def save(self, path=None):
+        """Write the table to a JSON file (default: the path it came from)."""
+        path = path or self.path
+        data = {model: sorted(keys) for model, keys in self._profiles.items()}
+        temp = path + '.tmp'
+        with open(temp, 'w') as profile_file:
+            json.dump(data, profile_file, indent=2, sort_keys=True)
+        os.replace(temp, path)
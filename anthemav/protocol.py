@@ -1,9 +1,17 @@
 """Module to maintain AVR state information and network interface."""
 import asyncio
+import collections
 import logging
 import time
 
-__all__ = ('AVR')
+from .capture import INBOUND, OUTBOUND, Recorder
+from .events import Change, EventStream, SubscriberIndex
+from .metrics import Metrics
+from .state import State, StateSchema
+from .zone import (REQUEST_TIMEOUT, ZONE_CODECS, ZONE_KEYS, ZONE_LOOKUP, ZONES,
+                   Zone, ZoneControl, zone_lookup)
+
+__all__ = ('AVR', 'CommandError')
 
 # In Python 3.4.4, `async` was renamed to `ensure_future`.
 try:
@@ -16,11 +24,8 @@ ATTR_CORE = {'Z1POW', 'IDM'}
 
 LOOKUP = {}
 
-LOOKUP['Z1POW'] = {'description': 'Zone 1 Power',
-                   '0': 'Off', '1': 'On'}
 LOOKUP['FPB'] = {'description': 'Front Panel Brightness',
                  '0': 'Off', '1': 'Low', '2': 'Medium', '3': 'High'}
-LOOKUP['Z1VOL'] = {'description': 'Zone 1 Volume'}
 LOOKUP['IDR'] = {'description': 'Region'}
 LOOKUP['IDM'] = {'description': 'Model'}
 LOOKUP['IDS'] = {'description': 'Software version'}
@@ -32,46 +37,123 @@ LOOKUP['ECH'] = {'description': 'Tx status',
 LOOKUP['SIP'] = {'description': 'Standby IP control',
                  '0': 'Off', '1': 'On'}
 LOOKUP['ICN'] = {'description': 'Active input count'}
-LOOKUP['Z1INP'] = {'description': 'Zone 1 current input'}
-LOOKUP['Z1MUT'] = {'description': 'Zone 1 mute',
-                   '0': 'Unmuted', '1': 'Muted'}
-LOOKUP['Z1ARC'] = {'description': 'Zone 1 ARC',
-                   '0': 'Off', '1': 'On'}
-LOOKUP['Z1VIR'] = {'description': 'Video input resolution',
-                   '0': 'No video', '1': 'Other', '2': '1080p60', '3': '1080p50',
-                   '4': '1080p24', '5': '1080i60', '6': '1080i50', '7': '720p60',
-                   '8': '720p50', '9': '576p50', '10': '576i50', '11': '480p60',
-                   '12': '480i60', '13': '3D', '14': '4K'}
-LOOKUP['Z1IRH'] = {'description': 'Active horizontal video resolution (pixels)'}
-LOOKUP['Z1IRV'] = {'description': 'Active vertical video resolution (pixels)'}
-LOOKUP['Z1AIC'] = {'description': 'Audio input channels',
-                   '0': 'No audio', '1': 'Other', '2': 'Mono (center channel)',
-                   '3': '2 channel', '4': '5.1 channel', '5': '6.1 channel',
-                   '6': '7.1 channel', '7': 'Atmos'}
-LOOKUP['Z1AIF'] = {'description': 'Audio input format',
-                   '0': 'No audio', '1': 'Analog', '2': 'PCM', '3': 'Dolby',
-                   '4': 'DSD', '5': 'DTS', '6': 'Atmos'}
-LOOKUP['Z1BRT'] = {'description': 'Audio input bitrate (kbps)'}
-LOOKUP['Z1SRT'] = {'description': 'Audio input sampling rate (hKz)'}
-LOOKUP['Z1AIN'] = {'description': 'Audio input name'}
-LOOKUP['Z1AIR'] = {'description': 'Audio input rate name'}
-LOOKUP['Z1ALM'] = {'description': 'Audio listening mode',
-                   '00': 'None', '01': 'AnthemLogic Movie', '02': 'AnthemLogic Music',
-                   '03': 'PLIIx Movie', '04': 'PLIIx Music', '05': 'Neo:6 Cinema',
-                   '06': 'Neo:6 Music', '07': 'All Channel Stereo',
-                   '08': 'All Channel Mono', '09': 'Mono', '10': 'Mono-Academy',
-                   '11': 'Mono (L)', '12': 'Mono (R)', '13': 'High Blend',
-                   '14': 'Dolby Surround', '15': 'Neo:X Cinema', '16': 'Neo:X Music'}
-LOOKUP['Z1DYN'] = {'description': 'Dolby digital dynamic range',
-                   '0': 'Normal', '1': 'Reduced', '2': 'Late Night'}
-LOOKUP['Z1DIA'] = {'description': 'Dolby digital dialog normalization (dB)'}
 
+# Zone 1 attributes are part of LOOKUP, the other zones are only in ATTRIBUTES
+LOOKUP.update(zone_lookup(1))
+
+# Every attribute the AVR keeps state for
+ATTRIBUTES = dict(LOOKUP)
+for _zone in ZONES[1:]:
+    ATTRIBUTES.update(zone_lookup(_zone))
+
+ERRORS = {'!I': 'Invalid command',
+          '!R': 'Out-of-range command',
+          '!E': 'Cannot execute recognized command',
+          '!Z': 'Ignoring command for powered-off zone'}
+
+
+class CommandError(Exception):
+    """The device rejected a command with one of the ERRORS responses."""
+
+    def __init__(self, code, command):
+        """Record the error code and the command that caused it."""
+        super().__init__('%s: %s' % (ERRORS.get(code, code), command))
+        self.code = code
+        self.command = command
+
+
+def _build_dispatch():
+    """Compile the tables routing each incoming datagram to its handler.
+
+    Keys map to the name of the AVR method that handles them.  Zone messages
+    (Z<n> followed by a three letter suffix) are routed on the suffix alone
+    through ZONE_DISPATCH, so adding zones costs nothing at parse time.  All
+    other datagrams are routed by slicing off a prefix of each distinct key
+    length (longest first) and looking it up in DISPATCH, so parse cost
+    depends only on the handful of key lengths and not on how many keys the
+    protocol defines.  Matching the longest key first also makes the result
+    independent of LOOKUP ordering when one key is a prefix of another.
+    """
+    dispatch = {key: '_handle_attribute' for key in LOOKUP
+                if not key.startswith('Z1')}
+    dispatch.update({key: '_handle_error' for key in ERRORS})
+    dispatch['ICN'] = '_handle_input_count'
+    dispatch['IDM'] = '_handle_model'
+    dispatch['IDN'] = '_handle_mac'
+    dispatch['ISN'] = '_handle_input_name'
+    lengths = tuple(sorted({len(key) for key in dispatch}, reverse=True))
+
+    zone_dispatch = {suffix: '_handle_attribute' for suffix in ZONE_LOOKUP}
+    zone_dispatch['POW'] = '_handle_power'
+    return dispatch, lengths, zone_dispatch
+
+DISPATCH, DISPATCH_LENGTHS, ZONE_DISPATCH = _build_dispatch()
+
+# Second character of every zone prefix we track
+ZONE_DIGITS = frozenset(str(zone) for zone in ZONES)
+
+
+def match_key(data):
+    """Find the key a datagram (or command) starts with.
+
+    returns a tuple of (key, handler name), or (None, None) if the datagram
+    does not start with any known key
+    """
+    if data[:1] == 'Z' and data[1:2] in ZONE_DIGITS:
+        handler = ZONE_DISPATCH.get(data[2:5])
+        if handler is not None:
+            return data[:5], handler
+    for length in DISPATCH_LENGTHS:
+        key = data[:length]
+        handler = DISPATCH.get(key)
+        if handler is not None:
+            return key, handler
+    return None, None
+
+# How each attribute is decoded, see anthemav.state.DECODERS
+CODECS = {'FPB': 'enum', 'ECH': 'bool', 'SIP': 'bool', 'ICN': 'int'}
+for _zone in ZONES:
+    CODECS.update((key, ZONE_CODECS[suffix])
+                  for suffix, key in ZONE_KEYS[_zone].items()
+                  if suffix in ZONE_CODECS)
+
+# Slot layout of the per-device state table
+SCHEMA = StateSchema(
+    ATTRIBUTES, CODECS,
+    {key: {raw: text for raw, text in entry.items() if raw != 'description'}
+     for key, entry in ATTRIBUTES.items()})
+
+# Power-on refresh retry schedule (seconds): first retry delay and the cap
+# it doubles up to
+POWERON_RETRY_INITIAL = 2
+POWERON_RETRY_MAX = 16
+
+# Seconds after a power on refresh ends before an !E reply is taken to mean
+# the attribute is unsupported rather than not ready yet
+POWERON_SETTLE = 10
+
+# Pre-encoded query datagrams for every known attribute
+QUERIES = {key: (key+'?;').encode() for key in ATTRIBUTES}
 
-# pylint: disable=too-many-instance-attributes, too-many-public-methods
-class AVR(asyncio.Protocol):
-    """The Anthem AVR IP control protocol handler."""
 
-    def __init__(self, update_callback=None, loop=None, connection_lost_callback=None):
+# pylint: disable=too-many-instance-attributes, too-many-public-methods
+class AVR(ZoneControl, asyncio.Protocol):
+    """The Anthem AVR IP control protocol handler.
+
+    The zone properties inherited from ZoneControl (power, volume, input and
+    so on) address Zone 1.  Use zone() to reach the other zones.  Attributes
+    the device rejects as unsupported are collected in the unsupported set
+    and left out of later refreshes.  Attributes restored from a state cache
+    are listed in the stale set until the device reports them again.
+    """
+
+    _keys = ZONE_KEYS[1]
+
+    def __init__(self, update_callback=None, loop=None, connection_lost_callback=None,
+                 commands_per_second=100, command_burst=1, max_frame_size=1024,
+                 metrics=None, max_write_size=256, poweron_timeout=60,
+                 update_window=None, zones=1, capture=None, coalesce=False,
+                 profiles=None, state_cache=None, device_name=None):
         """Protocol handler that handles all status and changes on AVR.
 
         This class is expected to be wrapped inside a Connection class object
@@ -83,6 +165,44 @@ class AVR(asyncio.Protocol):
                 called when connection is lost to device (optional)
             :param loop:
                 asyncio event loop (optional)
+            :param commands_per_second:
+                maximum rate at which commands are written to the device
+            :param command_burst:
+                maximum number of queued commands sent in a single write
+            :param max_frame_size:
+                longest unterminated datagram (in bytes) kept while waiting
+                for the rest of it to arrive
+            :param metrics:
+                True to collect runtime metrics, or a Metrics object to
+                record into (optional)
+            :param max_write_size:
+                largest single write (in bytes) sent to the device
+            :param poweron_timeout:
+                seconds to keep retrying queries after the device powers on
+            :param update_window:
+                if set, gather changes for this many seconds (0 for the end of
+                the current burst of received data) and call update_callback
+                once with a dict of {key: (oldvalue, newvalue)} instead of
+                once per changed datagram (optional)
+            :param zones:
+                number of zones included in refresh_all (state for every zone
+                is tracked regardless)
+            :param capture:
+                record all traffic to and from the device in this capture
+                file (optional, see start_recording)
+            :param coalesce:
+                replace a command that is still waiting in the outbound queue
+                when another command for the same key is issued, so only the
+                latest value is sent
+            :param profiles:
+                capability profiles consulted and extended with the
+                attributes this device's model rejects (optional)
+            :param state_cache:
+                cache to start from and keep updated with the last known
+                state of the device (optional)
+            :param device_name:
+                name the device is cached under besides its MAC address,
+                e.g. host:port (optional)
 
             :type update_callback:
                 callable
@@ -90,21 +210,96 @@ class AVR(asyncio.Protocol):
                 callable
             :type loop:
                 asyncio.loop
+            :type commands_per_second:
+                int or float
+            :type command_burst:
+                int
+            :type max_frame_size:
+                int
+            :type metrics:
+                boolean or Metrics
+            :type max_write_size:
+                int
+            :type poweron_timeout:
+                int or float
+            :type update_window:
+                int or float
+            :type zones:
+                int
+            :type capture:
+                str
+            :type coalesce:
+                boolean
+            :type profiles:
+                anthemav.profiles.Profiles
+            :type state_cache:
+                anthemav.cache.StateCache
+            :type device_name:
+                str
         """
-        self._loop = loop
+        assert zones in ZONES, 'Invalid zones value: %r' % (zones)
+        assert commands_per_second > 0, \
+            'Invalid commands_per_second value: %r' % (commands_per_second)
+        assert command_burst >= 1, 'Invalid command_burst value: %r' % (command_burst)
+        self._loop = loop or asyncio.get_event_loop()
         self.log = logging.getLogger(__name__)
         self._connection_lost_callback = connection_lost_callback
         self._update_callback = update_callback
-        self.buffer = ''
+        self._update_window = update_window
+        self._changes = {}
+        self._changes_since = None
+        self._subscribers = SubscriberIndex()
+        self._blocked = set()
+        self.buffer = bytearray()
+        self._resync = False
+        self._max_frame_size = max_frame_size
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
         self._input_names = {}
         self._input_numbers = {}
         self._poweron_refresh_successful = False
+        self._poweron_timeout = poweron_timeout
+        self._poweron_pending = set()
+        self._poweron_future = None
+        self._poweron_handle = None
+        self._poweron_deadline = 0
+        self._poweron_ended = None
+        self._poweron_delay = POWERON_RETRY_INITIAL
+        self._pending_requests = {}
+        self._inflight = {}
         self.transport = None
-
-        for key in LOOKUP:
-            setattr(self, '_'+key, '')
-
-        self._Z1POW = '0'
+        # Loop time of the last data received (or of connecting)
+        self.last_received = None
+
+        self._write_rate = commands_per_second
+        self._write_burst = command_burst
+        self._max_write_size = max_write_size
+        self._write_queue = collections.deque()
+        self._write_tokens = command_burst
+        self._write_stamp = self._loop.time()
+        self._write_handle = None
+        self._coalesce = coalesce
+        self._queued_commands = {}
+
+        self.state = State(SCHEMA)
+        for zone in ZONES:
+            self.state.set(ZONE_KEYS[zone]['POW'], '0')
+        self._zones = {}
+        self._refresh_zones = tuple(range(2, zones + 1))
+        self._profiles = profiles
+        self.unsupported = set()
+        self._recorder = None
+        if capture is not None:
+            self.start_recording(capture)
+
+        self.device_name = device_name
+        self.stale = set()
+        self._state_cache = state_cache
+        if state_cache is not None and device_name is not None:
+            entry = state_cache.lookup(device_name)
+            if entry is not None:
+                self.import_state(entry)
 
     def refresh_core(self):
         """Query device for all attributes that exist regardless of power state.
@@ -116,25 +311,86 @@ class AVR(asyncio.Protocol):
         This does not return any data, it just issues the queries.
         """
         self.log.info('Sending out mass query for all attributes')
-        for key in ATTR_CORE:
-            self.query(key)
+        self.query_many(ATTR_CORE)
 
     def poweron_refresh(self):
-        """Keep requesting all attributes until it works.
+        """Keep requesting attributes until they have all been answered.
 
         Immediately after a power on event (POW1) the AVR is inconsistent with
         which attributes can be successfully queried.  When we detect that
-        power has just been turned on, we loop every second making a bulk
-        query for every known attribute.  This continues until we detect that
-        values have been returned for at least one input name (this seems to
-        be the laggiest of all the attributes)
+        power has just been turned on, we make a bulk query for every
+        attribute that has not answered since the power on (an !E reply
+        means it is not ready yet and does not count), backing off
+        exponentially between rounds.  This continues until every attribute
+        (including the input names, which seem to be the laggiest of all) has
+        been returned, or until poweron_timeout expires.
         """
-        if self._poweron_refresh_successful:
+        self._poweron_handle = None
+        if self._poweron_refresh_successful or not self._poweron_pending:
+            return
+
+        remaining = self._poweron_deadline - self._loop.time()
+        if remaining <= 0:
+            self.log.warning('Power on refresh gave up waiting for: %s',
+                             ', '.join(sorted(self._poweron_pending)))
+            self._finish_poweron_refresh()
             return
-        else:
-            self.refresh_all()
-            self._loop.call_later(2, self.poweron_refresh)
 
+        self.log.info('Power on refresh querying %d missing attributes',
+                      len(self._poweron_pending))
+        self.query_many(sorted(self._poweron_pending))
+
+        delay = min(self._poweron_delay, remaining)
+        self._poweron_delay = min(2 * self._poweron_delay, POWERON_RETRY_MAX)
+        self._poweron_handle = self._loop.call_later(delay, self.poweron_refresh)
+
+    @property
+    def poweron_complete(self):
+        """Future for the current power on refresh (or None).
+
+        The result is the set of attributes that never answered before the
+        refresh finished, which is empty if the refresh fully succeeded.
+        """
+        return self._poweron_future
+
+    def _start_poweron_refresh(self):
+        self._cancel_poweron_refresh()
+        self._poweron_refresh_successful = False
+        self._poweron_pending = set(LOOKUP) - self.unsupported
+        self._poweron_pending.discard('Z1POW')
+        self._poweron_future = asyncio.Future(loop=self._loop)
+        self._poweron_deadline = self._loop.time() + self._poweron_timeout
+        self._poweron_delay = POWERON_RETRY_INITIAL
+        self._poweron_handle = self._loop.call_later(1, self.poweron_refresh)
+
+    def _cancel_poweron_refresh(self):
+        if self._poweron_handle is not None:
+            self._poweron_handle.cancel()
+            self._poweron_handle = None
+        if self._poweron_future is not None and not self._poweron_future.done():
+            self._poweron_future.set_result(set(self._poweron_pending))
+            self._poweron_ended = self._loop.time()
+        self._poweron_pending = set()
+
+    def _finish_poweron_refresh(self):
+        self._poweron_refresh_successful = True
+        self._cancel_poweron_refresh()
+
+    def _poweron_settled(self):
+        """Report if the device has been on long enough to trust !E replies."""
+        if not self.power or self._poweron_ended is None:
+            return False
+        if self._poweron_future is not None and not self._poweron_future.done():
+            return False
+        return self._loop.time() - self._poweron_ended >= POWERON_SETTLE
+
+    def _poweron_answered(self, key):
+        pending = self._poweron_pending
+        if key in pending:
+            pending.discard(key)
+            if not pending:
+                self.log.info('Power on refresh complete')
+                self._finish_poweron_refresh()
 
     def refresh_all(self):
         """Query device for all attributes that are known.
@@ -146,8 +402,44 @@ class AVR(asyncio.Protocol):
         This does not return any data, it just issues the queries.
         """
         self.log.info('refresh_all')
-        for key in LOOKUP:
-            self.query(key)
+        self.query_many(LOOKUP)
+        for zone in self._refresh_zones:
+            self.zone(zone).refresh()
+
+    def zone(self, number):
+        """Return the Zone object controlling zone number.
+
+        Zone 1 is also controlled by the properties of the AVR itself.
+
+            :param number: zone number (1-3)
+            :type number: int
+
+        :Example:
+
+        >>> zone(2).volume = 40
+        """
+        zone = self._zones.get(number)
+        if zone is None:
+            if number not in ZONES:
+                raise ValueError('Invalid zone number: %r' % (number))
+            zone = self._zones[number] = Zone(self, number)
+        return zone
+
+    def start_recording(self, path):
+        """Record all traffic to and from the device in a capture file.
+
+        Frames are appended to path with monotonic timestamps; see
+        anthemav.capture.replay() to feed a capture back through an AVR.
+        """
+        self.stop_recording()
+        self._recorder = Recorder(path)
+        self.log.info('Recording AVR traffic to %s', path)
+
+    def stop_recording(self):
+        """Stop recording and close the capture file (if any)."""
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
 
 
     #
@@ -158,18 +450,28 @@ class AVR(asyncio.Protocol):
         """Called when asyncio.Protocol establishes the network connection."""
         self.log.info('Connection established to AVR')
         self.transport = transport
+        self.last_received = self._loop.time()
+        self._write_tokens = self._write_burst
+        self._write_stamp = self._loop.time()
 
         #self.transport.set_write_buffer_limits(0)
         limit_low, limit_high = self.transport.get_write_buffer_limits()
         self.log.debug('Write buffer limits %d to %d', limit_low, limit_high)
+        if self._blocked:
+            self.transport.pause_reading()
 
         self.command('ECH1')
         self.refresh_core()
 
     def data_received(self, data):
         """Called when asyncio.Protocol detects received data from network."""
-        self.buffer += data.decode()
-        self.log.debug('Received %d bytes from AVR: %s', len(self.buffer), self.buffer)
+        self.last_received = self._loop.time()
+        self.buffer.extend(data)
+        self.log.debug('Received %d bytes from AVR: %s', len(data), data)
+        if self._recorder is not None:
+            self._recorder.record(INBOUND, data)
+        if self.metrics is not None:
+            self.metrics.inc('bytes_received', len(data))
         self._assemble_buffer()
 
     def connection_lost(self, exc):
@@ -179,31 +481,82 @@ class AVR(asyncio.Protocol):
         else:
             self.log.warning('Lost connection to receiver: %s', exc)
 
-        self.transport = None
-
+        self._drop_transport()
         if self._connection_lost_callback:
             self._loop.call_soon(self._connection_lost_callback)
 
+    def detach(self):
+        """Drop the transport without calling connection_lost_callback.
+
+        This cleans up the way connection_lost() does, for a transport that
+        was attached by hand (replay() uses it) rather than a lost device
+        connection that should be re-established.
+        """
+        self._drop_transport()
+
+    def _drop_transport(self):
+        self.transport = None
+        self._clear_write_queue()
+        self._cancel_poweron_refresh()
+        self._fail_requests(ConnectionError('Lost connection to receiver'))
+        del self.buffer[:]
+        self._resync = False
+        if self._recorder is not None:
+            self._recorder.flush()
+        if self._state_cache is not None:
+            self._state_cache.flush()
+        if self._profiles is not None:
+            self._profiles.flush()
+
     def _assemble_buffer(self):
         """Split up received data from device into individual commands.
 
         Data sent by the device is a sequence of datagrams separated by
         semicolons.  It's common to receive a burst of them all in one
-        submission when there's a lot of device activity.  This function
-        disassembles the chain of datagrams into individual messages which
-        are then passed on for interpretation.
+        submission when there's a lot of device activity, and just as common
+        for a datagram to be split across two TCP segments.  This function
+        disassembles every complete datagram in the buffer into individual
+        messages which are then passed on for interpretation, and keeps any
+        unterminated tail around until the rest of it arrives.  A tail longer
+        than max_frame_size is thrown away, along with the rest of it up to
+        the next semicolon, so that its end is not mistaken for a datagram.
         """
-        self.transport.pause_reading()
-
-        for message in self.buffer.split(';'):
-            if message != '':
-                self.log.debug('assembled message '+message)
-                self._parse_message(message)
-
-        self.buffer = ""
-
-        self.transport.resume_reading()
-        return
+        if self._resync:
+            end = self.buffer.find(b';')
+            if end < 0:
+                del self.buffer[:]
+                return
+            del self.buffer[:end + 1]
+            self._resync = False
+
+        start = 0
+        with memoryview(self.buffer) as view:
+            while True:
+                end = self.buffer.find(b';', start)
+                if end < 0:
+                    break
+                if end > start:
+                    message = str(view[start:end], 'utf-8', 'replace')
+                    self.log.debug('assembled message '+message)
+                    if self.metrics is None:
+                        self._parse_message(message)
+                    else:
+                        self._timed_parse_message(message)
+                start = end + 1
+        del self.buffer[:start]
+
+        if len(self.buffer) > self._max_frame_size:
+            self.log.warning('Discarding %d bytes of unterminated data from AVR',
+                             len(self.buffer))
+            del self.buffer[:]
+            self._resync = True
+
+    def _timed_parse_message(self, data):
+        """Parse a datagram while recording metrics about it."""
+        started = time.perf_counter()
+        self._parse_message(data)
+        self.metrics.observe('parse_seconds', time.perf_counter() - started)
+        self.metrics.inc('messages_received')
 
     def _populate_inputs(self, total):
         """Request the names for all active, configured inputs on the device.
@@ -212,101 +565,306 @@ class AVR(asyncio.Protocol):
         which will ask for the name of each active input.
         """
         total = total + 1
-        for input_number in range(1, total):
-            self.query('ISN'+str(input_number).zfill(2))
+        self.query_many('ISN'+str(input_number).zfill(2)
+                        for input_number in range(1, total))
 
     def _parse_message(self, data):
         """Interpret each message datagram from device and do the needful.
 
         This function receives datagrams from _assemble_buffer and inerprets
-        what they mean.  It's responsible for maintaining the internal state
-        table for each device attribute and also for firing the update_callback
-        function (if one was supplied)
+        what they mean.  Each datagram is routed by match_key() to the handler
+        for its key, which is responsible for maintaining the internal state
+        table for that attribute.  If the handler reports new data we also
+        fire the update_callback function (if one was supplied)
         """
-        recognized = False
-        newdata = False
-
-        if data.startswith('!I'):
-            self.log.warning('Invalid command: %s', data[2:])
-            recognized = True
-        elif data.startswith('!R'):
-            self.log.warning('Out-of-range command: %s', data[2:])
-            recognized = True
-        elif data.startswith('!E'):
-            self.log.warning('Cannot execute recognized command: %s', data[2:])
-            recognized = True
-        elif data.startswith('!Z'):
-            self.log.warning('Ignoring command for powered-off zone: %s', data[2:])
-            recognized = True
+        key, handler = match_key(data)
+        if handler is None:
+            self.log.warning('Unrecognized response: %s', data)
+            if self.metrics is not None:
+                self.metrics.inc('unrecognized')
+            return
+
+        if self.metrics is not None:
+            self.metrics.inc('messages_by_key', label=key)
+
+        newdata = getattr(self, handler)(key, data[len(key):])
+
+        if newdata:
+            if self._update_callback and self._update_window is None:
+                if self.metrics is None:
+                    self._loop.call_soon(self._update_callback, data)
+                else:
+                    self._loop.call_soon(self._timed_update_callback,
+                                         self._loop.time(), data)
         else:
+            self.log.debug('no new data encountered')
 
-            for key in LOOKUP:
-                if data.startswith(key):
-                    recognized = True
+    def _timed_update_callback(self, scheduled, data):
+        self.metrics.observe('callback_latency_seconds',
+                             self._loop.time() - scheduled)
+        self._update_callback(data)
 
-                    value = data[len(key):]
-                    oldvalue = getattr(self, '_'+key)
-                    if oldvalue != value:
-                        changeindicator = 'New Value'
-                        newdata = True
-                    else:
-                        changeindicator = 'Unchanged'
-
-                    if key in LOOKUP:
-                        if 'description' in LOOKUP[key]:
-                            if value in LOOKUP[key]:
-                                self.log.info('%s: %s (%s) -> %s (%s)',
-                                              changeindicator,
-                                              LOOKUP[key]['description'], key,
-                                              LOOKUP[key][value], value)
-                            else:
-                                self.log.info('%s: %s (%s) -> %s',
-                                              changeindicator,
-                                              LOOKUP[key]['description'], key,
-                                              value)
-                    else:
-                        self.log.info('%s: %s -> %s', changeindicator, key, value)
+    def _changed(self, key, oldvalue, value):
+        """Record a state change for delivery to the update callback.
+
+        In coalescing mode (update_window set) changes are gathered per key,
+        keeping the oldest previous value, and handed to update_callback as a
+        single dict once the window closes.  A key that changes back to its
+        original value within the window is dropped.  Every change is also
+        published to the subscribers of its key, see subscribe().
+        """
+        if self._subscribers:
+            self._subscribers.publish(Change(key, oldvalue, value), self._loop)
 
-                    setattr(self, '_'+key, value)
+        if self._update_window is None or not self._update_callback:
+            return
 
-                    if key == 'Z1POW' and value == '1' and oldvalue == '0':
-                        self.log.info('Power on detected, refreshing all attributes')
-                        self._poweron_refresh_successful = False
-                        self._loop.call_later(1, self.poweron_refresh)
+        if key in self._changes:
+            oldvalue = self._changes[key][0]
+            if oldvalue == value:
+                del self._changes[key]
+                return
+        self._changes[key] = (oldvalue, value)
+
+        if self._changes_since is None:
+            self._changes_since = self._loop.time()
+            if self._update_window:
+                self._loop.call_later(self._update_window, self._flush_changes)
+            else:
+                self._loop.call_soon(self._flush_changes)
+
+    def _flush_changes(self):
+        changes = self._changes
+        scheduled = self._changes_since
+        self._changes = {}
+        self._changes_since = None
+        if not changes:
+            return
+        if self.metrics is not None:
+            self.metrics.observe('callback_latency_seconds',
+                                 self._loop.time() - scheduled)
+        self._update_callback(changes)
 
-                    if key == 'Z1POW' and value == '0' and oldvalue == '1':
-                        self._poweron_refresh_successful = False
+    def events(self, keys=None, maxsize=100, policy='drop_oldest'):
+        """Open a stream of state changes for one consumer.
 
-                    break
+        Each stream has its own bounded queue of Change(key, oldvalue, value)
+        tuples, so any number of consumers can follow the device without
+        update_callback fan-out, and a slow one never holds up parsing.  See
+        EventStream for the policies applied when the queue is full.
 
-        if data.startswith('ICN'):
-            self.log.warning('ICN update received')
-            recognized = True
-            self._populate_inputs(int(value))
+            :param keys: only deliver changes to these keys (default all)
+            :param maxsize: number of changes queued before the policy applies
+            :param policy: 'drop_oldest', 'coalesce' or 'block'
+            :type keys: iterable of str
+            :type maxsize: int
+            :type policy: str
 
-        if data.startswith('ISN'):
-            recognized = True
-            self._poweron_refresh_successful = True
+        returns an EventStream, to be closed when no longer needed
 
-            input_number = int(data[3:5])
-            value = data[5:]
+        :Example:
 
-            oldname = self._input_names.get(input_number, '')
+        >>> async for change in avr.events(keys={'Z1VOL'}):
+        ...     print(change.key, change.value)
+        """
+        return EventStream(self, keys, maxsize, policy)
 
-            if oldname != value:
-                self._input_numbers[value] = input_number
-                self._input_names[input_number] = value
-                self.log.info('New Value: Input %d is called %s', input_number, value)
-                newdata = True
+    def subscribe(self, keys, callback):
+        """Call callback whenever one of keys changes.
 
-        if newdata:
-            if self._update_callback:
-                self._loop.call_soon(self._update_callback, data)
+        Subscriptions are indexed by key, so a change only reaches the
+        callbacks subscribed to it and costs nothing for anybody else.  The
+        callback is scheduled on the event loop with a Change(key, oldvalue,
+        value) tuple; input names are reported under ISNnn keys.
+
+            :param keys: attribute keys to watch, or None for every key
+            :param callback: called with each Change
+            :type keys: iterable of str
+            :type callback: callable
+
+        returns a Subscription; call its cancel() method to unsubscribe
+
+        :Example:
+
+        >>> handle = subscribe({'Z1VOL', 'Z1MUT'}, print)
+        >>> handle.cancel()
+        """
+        return self._subscribers.add(keys, callback)
+
+    def _block_reading(self, stream):
+        """Stop reading from the device while stream is full."""
+        if not self._blocked and self.transport:
+            self.log.debug('Event stream full, pausing reads from AVR')
+            self.transport.pause_reading()
+        self._blocked.add(stream)
+
+    def _unblock_reading(self, stream):
+        self._blocked.discard(stream)
+        if not self._blocked and self.transport:
+            self.log.debug('Event streams drained, resuming reads from AVR')
+            # Time spent paused is not silence from the device
+            self.last_received = self._loop.time()
+            self.transport.resume_reading()
+
+    @property
+    def reading_paused(self):
+        """Report if a full blocking event stream has paused reading."""
+        return bool(self._blocked)
+
+    #
+    # Message handlers, one per DISPATCH entry.  Each receives the matched key
+    # and the remainder of the datagram, and returns True if state changed.
+    #
+
+    def _handle_error(self, key, value):
+        self.log.warning('%s: %s', ERRORS[key], value)
+        if self._pending_requests:
+            self._reject_request(key, value)
+        if key != '!Z' and value.endswith('?'):
+            if key == '!I' or (key == '!E' and self._poweron_settled()):
+                self._learn_unsupported(value[:-1])
+            # !E only means the device is not ready yet, so the key stays
+            # pending and is asked for again in the next power on round
+            if key != '!E':
+                self._poweron_answered(value[:-1])
+        if self.metrics is not None:
+            self.metrics.inc('errors', label=key)
+        return False
+
+    def _handle_attribute(self, key, value):
+        oldvalue = self.state.set(key, value, self._loop.time())
+        if self.stale:
+            self.stale.discard(key)
+        if key in self.unsupported:
+            self._forget_unsupported(key)
+        if self._poweron_pending:
+            self._poweron_answered(key)
+        if self._pending_requests:
+            self._resolve_request(key, value)
+        if oldvalue != value:
+            changeindicator = 'New Value'
+            newdata = True
+            self._changed(key, oldvalue, value)
+            if self._state_cache is not None:
+                self._state_cache.changed(self)
         else:
-            self.log.debug('no new data encountered')
+            changeindicator = 'Unchanged'
+            newdata = False
 
-        if not recognized:
-            self.log.warning('Unrecognized response: %s', data)
+        description = ATTRIBUTES[key]['description']
+        if value in ATTRIBUTES[key]:
+            self.log.info('%s: %s (%s) -> %s (%s)', changeindicator,
+                          description, key, ATTRIBUTES[key][value], value)
+        else:
+            self.log.info('%s: %s (%s) -> %s', changeindicator,
+                          description, key, value)
+
+        return newdata
+
+    def _handle_model(self, key, value):
+        oldmodel = self.state.get(key)
+        newdata = self._handle_attribute(key, value)
+        if oldmodel and oldmodel != value:
+            self.unsupported = set()
+        if self._profiles is not None and value:
+            for unsupported in self.unsupported:
+                self._profiles.record(value, unsupported)
+            self.unsupported.update(self._profiles.unsupported(value))
+        return newdata
+
+    def _handle_mac(self, key, value):
+        oldmac = self.state.get(key)
+        newdata = self._handle_attribute(key, value)
+        if oldmac and oldmac != value and self.stale:
+            self.log.warning('Cached state belongs to %s, discarding it', oldmac)
+            self._discard_stale()
+        return newdata
+
+    def _learn_unsupported(self, key):
+        """Stop querying an attribute the device rejected as unsupported.
+
+        Keys are learned from !I answers, and from !E answers once the power
+        on refresh has been over for POWERON_SETTLE seconds (before that !E
+        only means not ready yet).
+        """
+        if key not in SCHEMA or key in self.unsupported:
+            return
+        self.unsupported.add(key)
+        model = self.state.get('IDM')
+        if self._profiles is not None and model:
+            self._profiles.record(model, key)
+
+    def _forget_unsupported(self, key):
+        """Resume querying an attribute the device has now answered."""
+        self.unsupported.discard(key)
+        self.log.info('%s answered after all, querying it again', key)
+        model = self.state.get('IDM')
+        if self._profiles is not None and model:
+            self._profiles.forget(model, key)
+
+    def _handle_power(self, key, value):
+        # A cached power state says nothing about what happened since, so
+        # treat it as off to refresh everything if the device is on
+        oldvalue = '0' if key in self.stale else self.state.get(key)
+        newdata = self._handle_attribute(key, value)
+
+        if key != 'Z1POW':
+            if value == '1' and oldvalue == '0':
+                self.log.info('Power on detected for zone %s', key[1])
+                self.zone(int(key[1])).refresh()
+            return newdata
+
+        if value == '1' and oldvalue == '0':
+            self.log.info('Power on detected, refreshing all attributes')
+            self._start_poweron_refresh()
+
+        if value == '0' and oldvalue == '1':
+            self._cancel_poweron_refresh()
+            self._poweron_refresh_successful = False
+
+        return newdata
+
+    def _handle_input_count(self, key, value):
+        self.log.warning('ICN update received')
+        try:
+            total = int(value)
+        except ValueError:
+            self.log.warning('Invalid input count: %s', value)
+            return self._handle_attribute(key, value)
+
+        if self._poweron_pending:
+            self._poweron_pending.update(
+                'ISN'+str(input_number).zfill(2)
+                for input_number in range(1, total + 1))
+        newdata = self._handle_attribute(key, value)
+        self._populate_inputs(total)
+        return newdata
+
+    def _handle_input_name(self, key, value):
+        try:
+            input_number = int(value[:2])
+        except ValueError:
+            self.log.warning('Invalid input name response: %s%s', key, value)
+            return False
+        if self._poweron_pending:
+            self._poweron_answered(key+value[:2])
+        if self._pending_requests:
+            self._resolve_request(key+value[:2], value[2:])
+        if self.stale:
+            self.stale.discard(key+value[:2])
+        value = value[2:]
+
+        oldname = self._input_names.get(input_number, '')
+
+        if oldname != value:
+            self._changed('ISN'+str(input_number).zfill(2), oldname, value)
+            self._input_numbers[value] = input_number
+            self._input_names[input_number] = value
+            self.log.info('New Value: Input %d is called %s', input_number, value)
+            if self._state_cache is not None:
+                self._state_cache.changed(self)
+            return True
+        return False
 
     def query(self, item):
         """Issue a raw query to the device for an item.
@@ -331,6 +889,49 @@ class AVR(asyncio.Protocol):
         item = item+'?'
         self.command(item)
 
+    def query_many(self, items):
+        """Issue raw queries to the device for many items at once.
+
+        The encoded query datagrams are concatenated and handed to the
+        outbound queue in chunks of at most max_write_size bytes, so a bulk
+        refresh goes out in a handful of writes instead of one write per item.
+        Each chunk counts as a single command against the write rate limit.
+        Items the device is known not to support (see unsupported) are left
+        out.
+
+        This function does not return the results, it merely issues the
+        requests.
+
+            :param items: Any of the data items from the API
+            :type items: iterable of str
+
+        :Example:
+
+        >>> query_many(['Z1VOL', 'Z1MUT'])
+
+        """
+        if not self.transport:
+            self.log.warning('No transport found, unable to send command')
+            return
+
+        chunk = []
+        size = 0
+        for item in items:
+            if item in self.unsupported:
+                continue
+            frame = QUERIES.get(item) or (item+'?;').encode()
+            if chunk and size + len(frame) > self._max_write_size:
+                self._queue_batch(chunk)
+                chunk = []
+                size = 0
+            chunk.append(frame)
+            size += len(frame)
+        if chunk:
+            self._queue_batch(chunk)
+
+        if self._write_handle is None:
+            self._flush_write_queue()
+
     def command(self, command):
         """Issue a raw command to the device.
 
@@ -367,125 +968,308 @@ class AVR(asyncio.Protocol):
 
         >>> formatted_command('Z1VOL-50')
         """
-        command = command
-        command = command.encode()
-
-        self.log.debug('> %s', command)
-        try:
-            self.transport.write(command)
-            time.sleep(0.01)
-        except:
+        if not self.transport:
             self.log.warning('No transport found, unable to send command')
+            return
 
-    #
-    # Volume and Attenuation handlers.  The Anthem tracks volume internally as
-    # an attenuation level ranging from -90dB (silent) to 0dB (bleeding ears)
-    #
-    # We expose this in three methods for the convenience of downstream apps
-    # which will almost certainly be doing things their own way:
-    #
-    #   - attenuation (-90 to 0)
-    #   - volume (0-100)
-    #   - volume_as_percentage (0-1 floating point)
-    #
+        if self._coalesce and not command.endswith('?;'):
+            key = match_key(command)[0]
+            if key is not None:
+                self._coalesce_command(key, command.encode())
+                return
 
-    def attenuation_to_volume(self, value):
-        """Convert a native attenuation value to a volume value.
+        command = command.encode()
+        self.log.debug('> %s', command)
+        self._write_queue.append(command)
+        if self._write_handle is None:
+            self._flush_write_queue()
+
+    def _coalesce_command(self, key, command):
+        """Queue a command, replacing any queued command for the same key.
+
+        Coalesced commands sit in the write queue as a [key, command] slot
+        that later commands for the key overwrite in place, so a burst of
+        changes keeps its position in the queue but only the latest value is
+        written.  The flush is deferred to the next loop iteration, which lets
+        commands issued back to back (like the repeated power command)
+        collapse even when the rate limit would let the first one out.
+        """
+        slot = self._queued_commands.get(key)
+        if slot is not None:
+            self.log.debug('> %s (replaces %s)', command, slot[1])
+            self._supersede_requests(key, slot[1], command)
+            slot[1] = command
+            return
 
-        Takes an attenuation in dB from the Anthem (-90 to 0) and converts it
-        into a normal volume value (0-100).
+        self.log.debug('> %s', command)
+        slot = self._queued_commands[key] = [key, command]
+        self._write_queue.append(slot)
+        if self._write_handle is None:
+            self._write_handle = self._loop.call_soon(self._flush_write_queue)
 
-            :param arg1: attenuation in dB (negative integer from -90 to 0)
-            :type arg1: int
+    def _queue_batch(self, frames):
+        payload = b''.join(frames)
+        self.log.debug('> %s', payload)
+        self._write_queue.append(payload)
 
-        returns an integer value representing volume
+    @property
+    def queue_depth(self):
+        """Number of commands waiting in the outbound write queue."""
+        return len(self._write_queue)
+
+    def _flush_write_queue(self):
+        """Write as many queued commands as the rate limit currently allows.
+
+        Outbound commands are paced with a token bucket refilled at
+        commands_per_second.  Adjacent commands are joined into a single
+        transport write when more than one token is available (up to
+        command_burst), and whenever the queue is not drained a loop timer is
+        armed for the moment the next token becomes available.  Nothing here
+        ever blocks the event loop.
         """
-        try:
-            return round((90.00 + int(value)) / 90 * 100)
-        except ValueError:
-            return 0
-
-    def volume_to_attenuation(self, value):
-        """Convert a volume value to a native attenuation value.
-
-        Takes a volume value and turns it into an attenuation value suitable
-        to send to the Anthem AVR.
+        self._write_handle = None
+
+        now = self._loop.time()
+        self._write_tokens = min(
+            self._write_burst,
+            self._write_tokens + (now - self._write_stamp) * self._write_rate)
+        self._write_stamp = now
+
+        chunk = []
+        size = 0
+        while self._write_queue and self._write_tokens >= 1:
+            entry = self._write_queue[0]
+            data = entry[1] if isinstance(entry, list) else entry
+            if chunk and size + len(data) > self._max_write_size:
+                break
+            self._write_queue.popleft()
+            if data is not entry:
+                del self._queued_commands[entry[0]]
+            chunk.append(data)
+            size += len(data)
+            self._write_tokens -= 1
+
+        if chunk:
+            payload = b''.join(chunk)
+            self.transport.write(payload)
+            if self._recorder is not None:
+                self._recorder.record(OUTBOUND, payload)
+            if self.metrics is not None:
+                self.metrics.inc('messages_sent', payload.count(b';'))
+                self.metrics.inc('bytes_sent', size)
+
+        if self.metrics is not None:
+            self.metrics.set('queue_depth', len(self._write_queue))
+
+        if self._write_queue:
+            delay = max(0, 1 - self._write_tokens) / self._write_rate
+            self._write_handle = self._loop.call_later(
+                delay, self._flush_write_queue)
+
+    def _clear_write_queue(self):
+        """Drop any pending outbound commands and stop the write timer."""
+        if self._write_handle is not None:
+            self._write_handle.cancel()
+            self._write_handle = None
+        if self._write_queue:
+            self.log.warning('Discarding %d unsent commands',
+                             len(self._write_queue))
+            self._write_queue.clear()
+            self._queued_commands.clear()
 
-            :param arg1: volume (integer from 0 to 100)
-            :type arg1: int
+    #
+    # Awaitable requests.  Each request registers a future in a per-key FIFO
+    # which _parse_message resolves with the next response for that key, or
+    # rejects with a CommandError if the device answers with an error.
+    #
 
-        returns a negative integer value representing attenuation in dB
+    @staticmethod
+    def _request_key(command):
+        """Return the attribute key a raw command or query refers to."""
+        key = match_key(command)[0]
+        if key is None:
+            return command.rstrip('?')
+        if key == 'ISN':
+            key += command[3:5]
+        return key
+
+    def _expect(self, key, expected=None):
+        """Register a request for key.
+
+        A request with an expected value (a command) only completes on a
+        response carrying that value, so the answer to an earlier plain
+        query for the same key cannot be mistaken for the command's echo.
         """
+        if not self.transport:
+            raise ConnectionError('No transport found, unable to send command')
+        future = asyncio.Future(loop=self._loop)
+        waiting = self._pending_requests.setdefault(key, collections.deque())
+        waiting.append((future, expected))
+        return future
+
+    @asyncio.coroutine
+    def _wait_request(self, key, future, timeout):
         try:
-            return round((value / 100) * 90) - 90
-        except ValueError:
-            return -90
+            return (yield from asyncio.wait_for(future, timeout, loop=self._loop))
+        finally:
+            waiting = self._pending_requests.get(key)
+            if waiting is not None:
+                for request in waiting:
+                    if request[0] is future:
+                        waiting.remove(request)
+                        break
+                if not waiting:
+                    del self._pending_requests[key]
+
+    def _next_request(self, key, value=None, exact=False):
+        """Take the oldest request for key that a response with value answers.
+
+        Queries (expected None) take any value unless exact is set, commands
+        only the value they sent; with exact and no value only queries match.
+        """
+        waiting = self._pending_requests.get(key)
+        if not waiting:
+            return None
+        for request in waiting:
+            future, expected = request
+            if future.done():
+                continue
+            if expected == value or (expected is None and not exact):
+                waiting.remove(request)
+                return future
+        return None
+
+    def _resolve_request(self, key, value):
+        """Complete the next request for key, and every command expecting value."""
+        future = self._next_request(key, value)
+        while future is not None:
+            future.set_result(value)
+            future = self._next_request(key, value, exact=True)
+
+    def _reject_request(self, code, command):
+        """Fail the request that sent command: a query or the same command."""
+        key = self._request_key(command)
+        value = command[len(key):]
+        future = self._next_request(key, None if value == '?' else value,
+                                    exact=True)
+        if future is not None:
+            future.set_exception(CommandError(code, command))
+
+    def _supersede_requests(self, key, old, new):
+        """Make requests waiting for a replaced command expect its successor."""
+        waiting = self._pending_requests.get(key)
+        if not waiting:
+            return
+        oldvalue = old[len(key):-1].decode()
+        newvalue = new[len(key):-1].decode()
+        for index in range(len(waiting)):
+            future, expected = waiting[index]
+            if expected == oldvalue:
+                waiting[index] = (future, newvalue)
+
+    def _fail_requests(self, exc):
+        pending = self._pending_requests
+        self._pending_requests = {}
+        for waiting in pending.values():
+            for future, _ in waiting:
+                if not future.done():
+                    future.set_exception(exc)
+
+    @asyncio.coroutine
+    def fetch(self, item, timeout=REQUEST_TIMEOUT):
+        """Query the device for an item and wait for the answer.
+
+        This is the awaitable counterpart of query().  It raises CommandError
+        if the device rejects the query and asyncio.TimeoutError if no answer
+        arrives within timeout seconds.
 
-    @property
-    def attenuation(self):
-        """Current volume attenuation in dB (read/write).
+            :param item: Any of the data items from the API
+            :param timeout: seconds to wait for the answer (None waits forever)
+            :type item: str
+            :type timeout: int or float
 
-        You can get or set the current attenuation value on the device with this
-        property.  Valid range from -90 to 0.
+        returns the raw value string reported by the device
 
-        :Examples:
+        :Example:
 
-        >>> attvalue = attenuation
-        >>> attenuation = -50
-        """
-        try:
-            return int(self._Z1VOL)
-        except ValueError:
-            return -90
-        except NameError:
-            return -90
+        >>> value = yield from fetch('Z1VOL')
 
-    @attenuation.setter
-    def attenuation(self, value):
-        if isinstance(value, int) and -90 <= value <= 0:
-            self.log.debug('Setting attenuation to '+str(value))
-            self.command('Z1VOL'+str(value))
+        """
+        future = self._expect(item)
+        self.query(item)
+        return (yield from self._wait_request(item, future, timeout))
+
+    @asyncio.coroutine
+    def execute(self, command, timeout=REQUEST_TIMEOUT):
+        """Issue a raw command and wait for the device to apply it.
+
+        This is the awaitable counterpart of command().  With Tx status (ECH)
+        enabled the device echoes every applied change, and the echo of the
+        command's key and value completes the request.  It raises CommandError if the
+        device rejects the command and asyncio.TimeoutError if nothing
+        arrives within timeout seconds.  When commands are coalesced, a
+        command replaced before it was sent completes with the echo of the
+        command that replaced it.
 
-    @property
-    def volume(self):
-        """Current volume level (read/write).
+            :param command: Any command as documented in the Anthem API
+            :param timeout: seconds to wait for the echo (None waits forever)
+            :type command: str
+            :type timeout: int or float
 
-        You can get or set the current volume value on the device with this
-        property.  Valid range from 0 to 100.
+        returns the raw value string echoed by the device
 
-        :Examples:
+        :Example:
 
-        >>> volvalue = volume
-        >>> volume = 20
+        >>> yield from execute('Z1VOL-50')
         """
-        return self.attenuation_to_volume(self.attenuation)
+        key = self._request_key(command)
+        future = self._expect(key, command[len(key):])
+        self.command(command)
+        return (yield from self._wait_request(key, future, timeout))
+
+    @asyncio.coroutine
+    def get(self, key, max_age=None, timeout=REQUEST_TIMEOUT):
+        """Return the value of an attribute, querying only if it is stale.
+
+        The cached value is returned as-is if the device reported it within
+        the last max_age seconds (or ever, if max_age is None).  Otherwise the
+        device is queried as with fetch(), except that concurrent callers
+        asking for the same key share a single outstanding query.
+
+            :param key: Any of the data items from the API
+            :param max_age: oldest acceptable value in seconds (0 always
+                queries)
+            :param timeout: seconds to wait for the answer (None waits forever)
+            :type key: str
+            :type max_age: int or float
+            :type timeout: int or float
+
+        returns the raw value string
 
-    @volume.setter
-    def volume(self, value):
-        if isinstance(value, int) and 0 <= value <= 100:
-            self.attenuation = self.volume_to_attenuation(value)
-
-    @property
-    def volume_as_percentage(self):
-        """Current volume as percentage (read/write).
-
-        You can get or set the current volume value as a percentage.  Valid
-        range from 0 to 1 (float).
+        :Example:
 
-        :Examples:
+        >>> bitrate = yield from get('Z1BRT', max_age=5)
 
-        >>> volper = volume_as_percentage
-        >>> volume_as_percentage = 0.20
         """
-        volume_per = self.volume / 100
-        return volume_per
-
-    @volume_as_percentage.setter
-    def volume_as_percentage(self, value):
-        if isinstance(value, float) or isinstance(value, int):
-            if 0 <= value <= 1:
-                value = round(value * 100)
-                self.volume = value
+        if key in SCHEMA:
+            stamp = self.state.updated(key)
+            if stamp is not None and (
+                    max_age is None or self._loop.time() - stamp <= max_age):
+                return self.state.get(key)
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = ensure_future(self.fetch(key, timeout), loop=self._loop)
+            task.add_done_callback(
+                lambda task, key=key: self._inflight_done(key, task))
+            self._inflight[key] = task
+        return (yield from asyncio.shield(task, loop=self._loop))
+
+    def _inflight_done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()
 
     #
     # Internal assistant functions for unified handling of boolean
@@ -493,14 +1277,7 @@ class AVR(asyncio.Protocol):
     #
 
     def _get_boolean(self, key):
-        keyname = '_'+key
-        try:
-            value = getattr(self, keyname)
-            return bool(int(value))
-        except ValueError:
-            return False
-        except AttributeError:
-            return False
+        return self.state.decoded(key)
 
     def _set_boolean(self, key, value):
         if value is True:
@@ -512,19 +1289,6 @@ class AVR(asyncio.Protocol):
     # Boolean properties and corresponding setters
     #
 
-    @property
-    def power(self):
-        """Report if device powered on or off (read/write).
-
-        Returns and expects a boolean value.
-        """
-        return self._get_boolean('Z1POW')
-
-    @power.setter
-    def power(self, value):
-        self._set_boolean('Z1POW', value)
-        self._set_boolean('Z1POW', value)
-
     @property
     def txstatus(self):
         """Current TX Status of the device (read/write).
@@ -564,24 +1328,6 @@ class AVR(asyncio.Protocol):
     def standby_control(self, value):
         self._set_boolean('SIP', value)
 
-    @property
-    def arc(self):
-        """Current ARC (Anthem Room Correction) on or off (read/write)."""
-        return self._get_boolean('Z1ARC')
-
-    @arc.setter
-    def arc(self, value):
-        self._set_boolean('Z1ARC', value)
-
-    @property
-    def mute(self):
-        """Mute on or off (read/write)."""
-        return self._get_boolean('Z1MUT')
-
-    @mute.setter
-    def mute(self, value):
-        self._set_boolean('Z1MUT', value)
-
     #
     # Read-only text properties
     #
@@ -589,109 +1335,49 @@ class AVR(asyncio.Protocol):
     @property
     def model(self):
         """Device Model Name (read-only)."""
-        return self._IDM or "Unknown Model"
+        return self.state.get('IDM') or "Unknown Model"
 
     @property
     def swversion(self):
         """Software version (read-only)."""
-        return self._IDS or "Unknown Version"
+        return self.state.get('IDS') or "Unknown Version"
 
     @property
     def region(self):
         """Region (read-only)."""
-        return self._IDR or "Unknown Region"
+        return self.state.get('IDR') or "Unknown Region"
 
     @property
     def build_date(self):
         """Software build date (read-only)."""
-        return self._IDB or "Unknown Build Date"
+        return self.state.get('IDB') or "Unknown Build Date"
 
     @property
     def hwversion(self):
         """Hardware version (read-only)."""
-        return self._IDH or "Unknown Version"
+        return self.state.get('IDH') or "Unknown Version"
 
     @property
     def macaddress(self):
         """Network MCU MAC address (read-only)."""
-        return self._IDN or "00:00:00:00:00:00"
-
-    @property
-    def audio_input_name(self):
-        """Current audio input format short description (read-only)."""
-        return self._Z1AIN or "Unknown"
-
-    @property
-    def audio_input_ratename(self):
-        """Current audio input format sample or bit rate (read-only)."""
-        return self._Z1AIR or "Unknown"
+        return self.state.get('IDN') or "00:00:00:00:00:00"
 
     #
     # Read-only raw numeric properties
     #
 
     def _get_integer(self, key):
-        keyname = '_'+key
-        if hasattr(self, keyname):
-            value = getattr(self, keyname)
-        try:
-            return int(value)
-        except ValueError:
-            return
-
-    @property
-    def dolby_dialog_normalization(self):
-        """Query Dolby Digital dialog normalization amount (read-only).
-
-        Returns value in dB of normalization (if applicable).
-        """
-        return self._get_integer('Z1DIA')
-
-    @property
-    def horizontal_resolution(self):
-        """Query active horizontal video resolution (in pixels)."""
-        return self._get_integer('Z1IRH')
-
-    @property
-    def vertical_resolution(self):
-        """Query active vertical video resolution (in pixels)."""
-        return self._get_integer('Z1IRV')
-
-    @property
-    def audio_input_bitrate(self):
-        """Query audio input bitrate (in kbps).
-
-        For Analog/PCM inputs this is equal to the sample rate multiplied by
-        the bit depth and the number of channels.
-        """
-        return self._get_integer('Z1BRT')
-
-    @property
-    def audio_input_samplerate(self):
-        """Query audio input sampling rate (kHz)."""
-        return self._get_integer('Z1SRT')
+        return self.state.decoded(key)
 
     #
     # Helper functions for working with raw/text multi-property items
     #
     #
     def _get_multiprop(self, key, mode='raw'):
-        keyname = '_'+key
-
-        if hasattr(self, keyname):
-            rawvalue = getattr(self, keyname)
-            value = rawvalue
-
-            if key in LOOKUP:
-                if rawvalue in LOOKUP[key]:
-                    value = LOOKUP[key][rawvalue]
-
-            if mode == 'raw':
-                return rawvalue
-            else:
-                return value
+        if mode == 'raw':
+            return self.state.decoded(key)
         else:
-            return
+            return self.state.text(key)
 
     #
     # Read/write properties with raw and text options
@@ -717,101 +1403,6 @@ class AVR(asyncio.Protocol):
                 self.log.info('Switching panel brightness to '+str(number))
                 self.command('FPB'+str(number))
 
-    @property
-    def audio_listening_mode(self):
-        """Current audio listening mode (00-16) (read-write).
-
-        Audio Listening Mode: 00=None, 01=AnthemLogic-Movie,
-        02=AnthemLogic-Music, 03=PLIIx Movie, 04=PLIIx Music, 05=Neo:6 Cinema,
-        06=Neo:6 Music, 07=All Channel Stereo*, 08=All-Channel Mono*, 09=Mono*,
-        10=Mono-Academy*, 11=Mono(L)*, 12=Mono(R)*, 13=High Blend*, 14=Dolby
-        Surround, 15=Neo:X-Cinema, 16=Neo:X-Music, na=cycle to next applicable,
-        pa=cycle to previous applicable.  *Applicable to 2-channel source only.
-        Some options are not available in all models or under all
-        circumstances.
-        """
-        return self._get_multiprop('Z1ALM', mode='raw')
-
-    @property
-    def audio_listening_mode_text(self):
-        """Current audio listening mode (str) (read-only)."""
-        return self._get_multiprop('Z1ALM', mode='text')
-
-    @audio_listening_mode.setter
-    def audio_listening_mode(self, number):
-        if isinstance(number, int):
-            if 0 <= number <= 16:
-                self.log.info('Switching audio listening mode to '+str(number))
-                self.command('Z1ALM'+str(number).zfill(2))
-
-    @property
-    def dolby_dynamic_range(self):
-        """Current Dolby Dynamic Range setting (0-2) (read-write).
-
-        Applies to Dolby Digital 5.1 source only.
-
-        0=Normal, 1=Reduced, 2=Late Night.
-        """
-        return self._get_multiprop('Z1DYN', mode='raw')
-
-    @property
-    def dolby_dynamic_range_text(self):
-        """Current Dolby Dynamic Range setting (str) (read-only)."""
-        return self._get_multiprop('Z1DYN', mode='text')
-
-    @dolby_dynamic_range.setter
-    def dolby_dynamic_range(self, number):
-        if isinstance(number, int):
-            if 0 <= number <= 2:
-                self.log.info('Switching Dolby dynamic range to '+str(number))
-                self.command('Z1DYN'+str(number))
-
-    #
-    # Read-only properties with raw and text options
-    #
-
-    @property
-    def video_input_resolution(self):
-        """Current video input resolution (0-14) (read-only).
-
-        0=no input, 1=other, 2=1080p60, 3=1080p50, 4=1080p24, 5=1080i60,
-        6=1080i50, 7=720p60, 8=720p50, 9=576p50, 10=576i50, 11=480p60,
-        12=480i60, 13=3D, 14=4k
-        """
-        return self._get_multiprop('Z1VIR', mode='raw')
-
-    @property
-    def video_input_resolution_text(self):
-        """Current video input resolution (str) (read-only)."""
-        return self._get_multiprop('Z1VIR', mode='text')
-
-    @property
-    def audio_input_channels(self):
-        """Current audio input channels (0-7) (read-only).
-
-        0=no input, 1=other, 2=mono (center channel only), 3=2-channel,
-        4=5.1-channel, 5=6.1-channel, 6=7.1-channel, 7=Atmos
-        """
-        return self._get_multiprop('Z1AIC', mode='raw')
-
-    @property
-    def audio_input_channels_text(self):
-        """Current audio input channels (str) (read-only)."""
-        return self._get_multiprop('Z1AIC', mode='text')
-
-    @property
-    def audio_input_format(self):
-        """Current audio input format (0-6) (read-only).
-
-        0=no input, 1=Analog, 2=PCM, 3=Dolby, 4= DSD, 5=DTS, 6=Atmos.
-        """
-        return self._get_multiprop('Z1AIF', mode='raw')
-
-    @property
-    def audio_input_format_text(self):
-        """Current audio input format (str) (read-only)."""
-        return self._get_multiprop('Z1AIF', mode='text')
-
     #
     # Input number and lists
     #
@@ -821,32 +1412,51 @@ class AVR(asyncio.Protocol):
         """List of all enabled inputs."""
         return list(self._input_numbers.keys())
 
-    @property
-    def input_name(self):
-        """Name of currently active input (read-write)."""
-        return self._input_names.get(self.input_number, "Unknown")
+    #
+    # Miscellany
+    #
 
-    @input_name.setter
-    def input_name(self, value):
-        number = self._input_numbers.get(value, 0)
-        if number > 0:
-            self.input_number = number
+    #
+    # State persistence, see anthemav.cache.StateCache
+    #
 
-    @property
-    def input_number(self):
-        """Number of currently active input (read-write)."""
-        return self._get_integer('Z1INP')
+    def export_state(self):
+        """Return the known attribute values and input names as a dict.
 
-    @input_number.setter
-    def input_number(self, number):
-        if isinstance(number, int):
-            if 1 <= number <= 99:
-                self.log.info('Switching input to '+str(number))
-                self.command('Z1INP'+str(number))
+        returns {'state': {key: value}, 'inputs': {number: name}} with every
+        attribute that has a value, suitable for import_state() and JSON
+        """
+        return {'state': {key: value for key, value in self.state.as_dict().items()
+                          if value},
+                'inputs': {str(number): name
+                           for number, name in self._input_names.items()}}
 
-    #
-    # Miscellany
-    #
+    def import_state(self, entry):
+        """Restore values from export_state() and mark them all stale.
+
+        Restored values are visible through the properties right away, but
+        stay listed in stale until the device reports them itself.  No update
+        callbacks are made for them.
+        """
+        for key, value in entry.get('state', {}).items():
+            if key in SCHEMA:
+                self.state.set(key, value)
+                self.stale.add(key)
+        for number, name in entry.get('inputs', {}).items():
+            number = int(number)
+            self._input_names[number] = name
+            self._input_numbers[name] = number
+            self.stale.add('ISN'+str(number).zfill(2))
+
+    def _discard_stale(self):
+        """Forget every restored value that was not confirmed by the device."""
+        for key in self.stale:
+            if key.startswith('ISN'):
+                name = self._input_names.pop(int(key[3:]), None)
+                self._input_numbers.pop(name, None)
+            else:
+                self.state.set(key, '0' if key.endswith('POW') else '')
+        self.stale = set()
 
     @property
     def dump_rawdata(self):
@@ -0,0 +1,233 @@
+"""Multiplexing proxy letting many clients share one receiver connection."""
+import argparse
+import asyncio
+import logging
+
+from .connection import Connection
+from .protocol import SCHEMA, CommandError, ensure_future, match_key
+
+__all__ = ('Proxy', 'main')
+
+
+class Proxy:
+    """Asyncio TCP server sharing one upstream AVR between many clients.
+
+    Clients speak the Anthem IP control protocol to the proxy as if it were
+    the receiver.  KEY? queries are answered from the state of the upstream
+    AVR, which only goes to the device when it has no live value for the
+    key (or the value is older than max_age), and concurrent queries for a
+    key share one upstream request.  Commands are forwarded upstream, with
+    identical commands from several clients merged into one while it is
+    outstanding; errors are returned to the clients that sent the command.
+    Commands for keys the AVR class does not know are refused with !I.
+    Every state change is sent to all clients that enabled Tx status (ECH1),
+    the way the receiver itself reports changes.
+    """
+
+    def __init__(self, connection, host='127.0.0.1', port=14999, loop=None,
+                 max_age=None, timeout=5):
+        """Create a proxy for connection (call start() to begin listening).
+
+            :param connection: upstream device connection
+            :param host: address to listen on
+            :param port: TCP port to listen on (0 picks a free port)
+            :param loop: asyncio event loop (optional)
+            :param max_age: seconds a cached value may be used to answer a
+                query (None uses any live value)
+            :param timeout: seconds to wait for the device before answering
+                a client with !E
+
+            :type connection: anthemav.Connection
+            :type host: str
+            :type port: int
+            :type loop: asyncio.loop
+            :type max_age: int or float
+            :type timeout: int or float
+        """
+        self.log = logging.getLogger(__name__)
+        self.connection = connection
+        self.avr = connection.protocol
+        self.host = host
+        self.port = port
+        self.max_age = max_age
+        self.timeout = timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self.clients = set()
+        self._commands = {}
+        self._server = None
+        self._subscription = None
+
+    @asyncio.coroutine
+    def start(self):
+        """Start listening; self.port is updated with the actual port."""
+        self._server = yield from self._loop.create_server(
+            lambda: _ProxyProtocol(self), self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._subscription = self.avr.subscribe(None, self._broadcast)
+        self.log.info('Proxying Anthem AVR at %s:%d on %s:%d',
+                      self.connection.host, self.connection.port,
+                      self.host, self.port)
+
+    def close(self):
+        """Stop listening and drop every client (the upstream stays open)."""
+        if self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for client in list(self.clients):
+            client.transport.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        """Wait until the server has shut down."""
+        if self._server is not None:
+            yield from self._server.wait_closed()
+
+    #
+    # Protocol implementation
+    #
+
+    def handle(self, client, message):
+        """Act on one datagram received from a client."""
+        if message.endswith('?'):
+            ensure_future(self._query(client, message), loop=self._loop)
+            return
+
+        if message[:3] == 'ECH' and message[3:] in ('0', '1'):
+            client.echo = message[3:] == '1'
+            client.send(message)
+            return
+
+        key = match_key(message)[0]
+        if key is None:
+            # The device's answer could not be told apart from unsolicited
+            # data or relayed, so refuse it like the device refuses a command
+            # it does not support
+            client.send('!I'+message)
+            return
+        ensure_future(self._command(client, message), loop=self._loop)
+
+    @asyncio.coroutine
+    def _query(self, client, message):
+        key = message[:-1]
+        if key[:3] == 'ISN' and key[3:].isdigit():
+            name = self.avr._input_names.get(int(key[3:]))
+            if name is not None and key not in self.avr.stale:
+                client.send(key+name)
+                return
+        elif key not in SCHEMA:
+            client.send('!I'+message)
+            return
+
+        try:
+            value = yield from self.avr.get(key, self.max_age, self.timeout)
+        except CommandError as err:
+            client.send(err.code+message)
+        except (asyncio.TimeoutError, ConnectionError):
+            client.send('!E'+message)
+        else:
+            client.send(key+value)
+
+    @asyncio.coroutine
+    def _command(self, client, message):
+        key = match_key(message)[0]
+        before = self.avr.state.get(key) if key in SCHEMA else None
+
+        task = self._commands.get(message)
+        if task is None:
+            task = ensure_future(self.avr.execute(message, self.timeout),
+                                 loop=self._loop)
+            task.add_done_callback(lambda task: self._command_done(message, task))
+            self._commands[message] = task
+        try:
+            value = yield from asyncio.shield(task, loop=self._loop)
+        except CommandError as err:
+            client.send(err.code+message)
+        except (asyncio.TimeoutError, ConnectionError):
+            client.send('!E'+message)
+        else:
+            # Changes reach every client through _broadcast; a command that
+            # changed nothing is still echoed to its sender like the device does
+            if value == before and client.echo:
+                client.send(key+value)
+
+    def _command_done(self, message, task):
+        if self._commands.get(message) is task:
+            del self._commands[message]
+        if not task.cancelled():
+            task.exception()
+
+    def _broadcast(self, change):
+        message = change.key+change.value
+        for client in self.clients:
+            if client.echo:
+                client.send(message)
+
+
+class _ProxyProtocol(asyncio.Protocol):
+    """One client connection to the proxy."""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.transport = None
+        self.buffer = bytearray()
+        self.echo = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.proxy.clients.add(self)
+        self.proxy.log.info('Client connected from %s',
+                            transport.get_extra_info('peername'))
+
+    def connection_lost(self, exc):
+        self.proxy.clients.discard(self)
+        self.transport = None
+
+    def data_received(self, data):
+        self.buffer.extend(data)
+        *messages, tail = self.buffer.split(b';')
+        self.buffer = bytearray(tail)
+        for message in messages:
+            if message:
+                self.proxy.handle(self, message.decode('utf-8', 'replace'))
+
+    def send(self, message):
+        """Write one datagram to the client."""
+        if self.transport is not None:
+            self.transport.write((message+';').encode())
+
+
+def main():
+    """Run a proxy from the command line until interrupted."""
+    parser = argparse.ArgumentParser(description=Proxy.__doc__.split('\n')[0])
+    parser.add_argument('--upstream', default='127.0.0.1',
+                        help='IP or FQDN of the AVR')
+    parser.add_argument('--upstream-port', default='14999', help='Port of the AVR')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', default='14999', help='Port to listen on')
+    parser.add_argument('--max-age', default=None,
+                        help='Seconds a cached value may answer a query')
+    parser.add_argument('--zones', default='1', help='Number of zones to track')
+    parser.add_argument('--verbose', '-v', action='count')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    conn = loop.run_until_complete(Connection.create(
+        host=args.upstream, port=int(args.upstream_port), loop=loop,
+        zones=int(args.zones), coalesce=True))
+    conn.protocol.refresh_all()
+    proxy = Proxy(conn, host=args.host, port=int(args.port), loop=loop,
+                  max_age=float(args.max_age) if args.max_age else None)
+    loop.run_until_complete(proxy.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+        conn.close()
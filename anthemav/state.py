@@ -0,0 +1,143 @@
+"""Module containing the compact attribute state store for the AVR."""
+
+__all__ = ('StateSchema', 'State')
+
+
+def _decode_bool(raw):
+    try:
+        return bool(int(raw))
+    except ValueError:
+        return False
+
+
+def _decode_int(raw):
+    try:
+        return int(raw)
+    except ValueError:
+        return None
+
+
+def _decode_raw(raw):
+    return raw
+
+# Codec name: function turning a raw value string into its typed value
+DECODERS = {'bool': _decode_bool,
+            'int': _decode_int,
+            'enum': _decode_raw,
+            'str': _decode_raw}
+
+
+class StateSchema:
+    """Fixed set of attribute keys, interned to integer slot indices.
+
+    A schema is built once per key table and shared by every State that uses
+    it, so the per-device cost of a state table is a few lists of values.
+    It also holds the codec of every slot, which turns raw value strings into
+    typed values, and the text labels of enumerated values.
+    """
+
+    __slots__ = ('keys', 'index', 'decoders', 'labels')
+
+    def __init__(self, keys, codecs=None, labels=None):
+        """Intern keys to slot indices in iteration order.
+
+            :param keys: attribute keys (e.g. LOOKUP)
+            :param codecs: {key: codec name} for keys that are not 'str'
+            :param labels: {key: {raw value: text}} for enumerated keys
+            :type keys: iterable of str
+            :type codecs: dict
+            :type labels: dict
+        """
+        codecs = codecs or {}
+        labels = labels or {}
+        self.keys = tuple(keys)
+        self.index = {key: slot for slot, key in enumerate(self.keys)}
+        self.decoders = tuple(DECODERS[codecs.get(key, 'str')] for key in self.keys)
+        self.labels = tuple(labels.get(key, {}) for key in self.keys)
+
+    def __contains__(self, key):
+        """Report if the schema has a slot for key."""
+        return key in self.index
+
+    def __len__(self):
+        """Number of slots in the schema."""
+        return len(self.keys)
+
+
+class State:
+    """Slot-backed table of current attribute values.
+
+    Values are held in a plain list indexed through the shared schema, which
+    gives O(1) get/set without a per-instance attribute dictionary.
+    snapshot() copies the list into an immutable tuple which diff() can
+    compare against a later snapshot.  Parallel lists hold the decoded value
+    and text label of each slot, computed once when the value is stored, and
+    when each slot was last reported, changed or not, for freshness checks.
+    """
+
+    __slots__ = ('schema', 'values', 'typed', 'texts', 'stamps')
+
+    def __init__(self, schema, default=''):
+        """Create a state table with every slot set to default.
+
+            :param schema: key layout shared by all tables of this kind
+            :param default: initial value for every slot
+            :type schema: StateSchema
+            :type default: str
+        """
+        self.schema = schema
+        self.values = [default] * len(schema)
+        self.typed = [decode(default) for decode in schema.decoders]
+        self.texts = [labels.get(default, default) for labels in schema.labels]
+        self.stamps = [None] * len(schema)
+
+    def get(self, key):
+        """Return the current value of key (KeyError if not in schema)."""
+        return self.values[self.schema.index[key]]
+
+    def set(self, key, value, stamp=None):
+        """Store a new value for key and return the previous one.
+
+        If stamp is given it is recorded as the time the value was reported.
+        """
+        slot = self.schema.index[key]
+        oldvalue = self.values[slot]
+        if value != oldvalue:
+            self.values[slot] = value
+            self.typed[slot] = self.schema.decoders[slot](value)
+            self.texts[slot] = self.schema.labels[slot].get(value, value)
+        if stamp is not None:
+            self.stamps[slot] = stamp
+        return oldvalue
+
+    def decoded(self, key):
+        """Return the current value of key converted by its codec."""
+        return self.typed[self.schema.index[key]]
+
+    def text(self, key):
+        """Return the text label of the current value (or the raw value)."""
+        return self.texts[self.schema.index[key]]
+
+    def updated(self, key):
+        """Return when key was last reported (None if it never was)."""
+        return self.stamps[self.schema.index[key]]
+
+    def snapshot(self):
+        """Return an immutable copy of all current values."""
+        return tuple(self.values)
+
+    def diff(self, old, new):
+        """Compare two snapshots of this table.
+
+        returns a dict of {key: (oldvalue, newvalue)} for every slot that
+        differs between the snapshots
+        """
+        return {key: (oldvalue, newvalue)
+                for key, oldvalue, newvalue in zip(self.schema.keys, old, new)
+                if oldvalue != newvalue}
+
+    def as_dict(self, snapshot=None):
+        """Return the current values (or a snapshot) as a {key: value} dict."""
+        if snapshot is None:
+            snapshot = self.values
+        return dict(zip(self.schema.keys, snapshot))
@@ -0,0 +1,277 @@
+"""Module containing a blocking client facade for the AVR interface."""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+
+from .connection import Connection
+from .events import EventStream, Subscription
+from .protocol import ensure_future
+from .zone import Zone
+
+__all__ = ('SyncAVR')
+
+# asyncio.run_coroutine_threadsafe was added in Python 3.5.1
+try:
+    run_coroutine_threadsafe = asyncio.run_coroutine_threadsafe
+except AttributeError:
+    def run_coroutine_threadsafe(coro, loop):
+        """Submit a coroutine to loop from another thread.
+
+        returns a concurrent.futures.Future for its result
+        """
+        future = concurrent.futures.Future()
+
+        def start():
+            if future.cancelled():
+                return
+            task = ensure_future(coro, loop=loop)
+            task.add_done_callback(functools.partial(_copy_result, future))
+            future.add_done_callback(
+                lambda future: future.cancelled() and
+                loop.call_soon_threadsafe(task.cancel))
+        loop.call_soon_threadsafe(start)
+        return future
+
+    def _copy_result(future, task):
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+class SyncAVR:
+    """Blocking, thread-safe client for code that does not use asyncio.
+
+    A SyncAVR owns an event loop running in a background thread and keeps
+    one Connection open on it for its whole life, so every call reuses the
+    same connection and the state it has already learned.  Any attribute of
+    the AVR protocol handler can be used directly and is run on the loop
+    thread:
+
+    - coroutines (fetch, get, execute, set_volume, ...) become blocking
+      calls returning their result
+    - properties (power, volume, model, ...) are read from the cached state
+      without a round trip to the device, and can be assigned to
+    - other methods (query, command, refresh_all, ...) are called as-is
+    - other attributes (unsupported, stale, ...) are read on the loop thread
+
+    Objects tied to the loop that are returned this way (the Zone from
+    zone(), the EventStream from events() and the Subscription from
+    subscribe()) are wrapped in a SyncProxy giving the same blocking access
+    to them; an event stream can be iterated over in a plain for loop.
+    Several coroutines can be run concurrently and waited for together with
+    batch().  Callbacks passed in the connection options or to subscribe()
+    run on the loop thread.
+
+    :Example:
+
+    >>> with SyncAVR('10.0.0.100') as client:
+    ...     client.set_volume(40)
+    ...     print(client.volume, client.get('Z1BRT', max_age=5))
+    """
+
+    def __init__(self, host='localhost', port=14999, timeout=10, **options):
+        """Start the background loop and connect to the device.
+
+            :param host: Hostname or IP address of the device
+            :param port: TCP port number of the device
+            :param timeout: default seconds a blocking call may take
+            :param options: further keyword arguments for Connection.create
+            :type host: str
+            :type port: int
+            :type timeout: int or float
+        """
+        self.log = logging.getLogger(__name__)
+        self.timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run_loop, name='anthemav-%s:%d' % (host, port))
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            self.connection = self.run(Connection.create(
+                host=host, port=port, loop=self._loop, **options))
+        except:
+            self._stop_loop()
+            raise
+        self.avr = self.connection.protocol
+
+    def __enter__(self):
+        """Return the client itself; it is closed on exit."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the client."""
+        self.close()
+
+    def __getattr__(self, name):
+        """Expose the attributes of the AVR, see the class description."""
+        if 'avr' not in self.__dict__:
+            raise AttributeError(name)
+        return self._delegate(self.avr, name)
+
+    def __setattr__(self, name, value):
+        """Assign to the AVR's properties on the loop thread."""
+        if 'avr' in self.__dict__ and isinstance(
+                getattr(type(self.avr), name, None), property):
+            self.call(setattr, self.avr, name, value)
+        else:
+            super().__setattr__(name, value)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop thread and return its result.
+
+        Raises concurrent.futures.TimeoutError (after cancelling the
+        coroutine) if it takes longer than timeout, which defaults to the
+        timeout the client was created with.
+        """
+        future = run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def batch(self, *coros, timeout=None):
+        """Run several coroutines concurrently and return all their results.
+
+        :Example:
+
+        >>> volume, _ = client.batch(client.avr.fetch('Z1VOL'),
+        ...                            client.avr.set_mute(False))
+        """
+        @asyncio.coroutine
+        def gather():
+            return (yield from asyncio.gather(*coros, loop=self._loop))
+        return self.run(gather(), timeout)
+
+    def call(self, func, *args):
+        """Call a plain function on the loop thread and return its result."""
+        future = concurrent.futures.Future()
+
+        def wrapper():
+            try:
+                future.set_result(func(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+        self._loop.call_soon_threadsafe(wrapper)
+        return future.result(self.timeout)
+
+    def close(self):
+        """Close the connection and stop the background loop."""
+        if not self._thread.is_alive():
+            return
+        self.call(self.connection.close)
+        # Let the transport finish closing before the loop stops
+        self.run(asyncio.sleep(0, loop=self._loop))
+        self._stop_loop()
+
+    def _delegate(self, target, name):
+        """Return attribute name of a loop-bound object, see SyncAVR."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(type(target), name, None)
+        if isinstance(attr, property):
+            return self._wrap(self.call(getattr, target, name))
+        if asyncio.iscoroutinefunction(attr):
+            return functools.partial(self._run_method, target, name)
+        if callable(attr):
+            return functools.partial(self._call_method, target, name)
+        return self._wrap(self.call(getattr, target, name))
+
+    def _wrap(self, value):
+        if isinstance(value, EventStream):
+            return SyncEventStream(self, value)
+        if isinstance(value, (Zone, Subscription)):
+            return SyncProxy(self, value)
+        return value
+
+    def _run_method(self, target, name, *args, **kwargs):
+        return self._wrap(self.run(getattr(target, name)(*args, **kwargs)))
+
+    def _call_method(self, target, name, *args, **kwargs):
+        method = getattr(target, name)
+        return self._wrap(self.call(lambda: method(*args, **kwargs)))
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _stop_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+class SyncProxy:
+    """Blocking access to an object of a SyncAVR that lives on its loop.
+
+    Properties, coroutines and methods of the object are used the same way
+    as those of the AVR through SyncAVR itself.
+    """
+
+    def __init__(self, client, target):
+        """Wrap target, an object running on the loop of client."""
+        self.__dict__['_client'] = client
+        self.__dict__['_target'] = target
+
+    def __getattr__(self, name):
+        """Expose the attributes of the object on the loop thread."""
+        return self._client._delegate(self._target, name)
+
+    def __setattr__(self, name, value):
+        """Assign to the object's attributes on the loop thread."""
+        self._client.call(setattr, self._target, name, value)
+
+    def __repr__(self):
+        return '<%s for %r>' % (type(self).__name__, self._target)
+
+
+class SyncEventStream(SyncProxy):
+    """Blocking view of an EventStream that can be iterated over.
+
+    :Example:
+
+    >>> with client.events(keys={'Z1VOL'}) as stream:
+    ...     for change in stream:
+    ...         print(change.key, change.value)
+    """
+
+    def __len__(self):
+        """Number of changes waiting to be read."""
+        return self._client.call(len, self._target)
+
+    def __enter__(self):
+        """Return the stream itself; it is closed on exit."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the stream."""
+        self.close()
+
+    def __iter__(self):
+        """Return the stream itself."""
+        return self
+
+    def __next__(self):
+        """Wait for the next change, ending the iteration once closed."""
+        change = self.get()
+        if change is None:
+            raise StopIteration
+        return change
+
+    def get(self):
+        """Wait for and return the next change (None once the stream is closed).
+
+        This blocks without a time limit, until a change arrives or the
+        stream is closed (which can be done from any thread).
+        """
+        future = run_coroutine_threadsafe(self._target.get(),
+                                          self._client._loop)
+        return future.result()
@@ -0,0 +1,540 @@
+"""Module containing the per-zone attributes and controls of the AVR."""
+import asyncio
+
+__all__ = ('Zone', 'ZoneControl')
+
+# Zones addressed with a Z<n> key prefix
+ZONES = (1, 2, 3)
+
+# Default number of seconds an awaitable request waits for its response
+REQUEST_TIMEOUT = 5
+
+# Attributes present in every zone, keyed by the suffix following Z<n>
+ZONE_LOOKUP = {}
+
+ZONE_LOOKUP['POW'] = {'description': 'Power',
+                      '0': 'Off', '1': 'On'}
+ZONE_LOOKUP['VOL'] = {'description': 'Volume'}
+ZONE_LOOKUP['INP'] = {'description': 'current input'}
+ZONE_LOOKUP['MUT'] = {'description': 'mute',
+                      '0': 'Unmuted', '1': 'Muted'}
+ZONE_LOOKUP['ARC'] = {'description': 'ARC',
+                      '0': 'Off', '1': 'On'}
+ZONE_LOOKUP['VIR'] = {'description': 'video input resolution',
+                      '0': 'No video', '1': 'Other', '2': '1080p60', '3': '1080p50',
+                      '4': '1080p24', '5': '1080i60', '6': '1080i50', '7': '720p60',
+                      '8': '720p50', '9': '576p50', '10': '576i50', '11': '480p60',
+                      '12': '480i60', '13': '3D', '14': '4K'}
+ZONE_LOOKUP['IRH'] = {'description': 'active horizontal video resolution (pixels)'}
+ZONE_LOOKUP['IRV'] = {'description': 'active vertical video resolution (pixels)'}
+ZONE_LOOKUP['AIC'] = {'description': 'audio input channels',
+                      '0': 'No audio', '1': 'Other', '2': 'Mono (center channel)',
+                      '3': '2 channel', '4': '5.1 channel', '5': '6.1 channel',
+                      '6': '7.1 channel', '7': 'Atmos'}
+ZONE_LOOKUP['AIF'] = {'description': 'audio input format',
+                      '0': 'No audio', '1': 'Analog', '2': 'PCM', '3': 'Dolby',
+                      '4': 'DSD', '5': 'DTS', '6': 'Atmos'}
+ZONE_LOOKUP['BRT'] = {'description': 'audio input bitrate (kbps)'}
+ZONE_LOOKUP['SRT'] = {'description': 'audio input sampling rate (hKz)'}
+ZONE_LOOKUP['AIN'] = {'description': 'audio input name'}
+ZONE_LOOKUP['AIR'] = {'description': 'audio input rate name'}
+ZONE_LOOKUP['ALM'] = {'description': 'audio listening mode',
+                      '00': 'None', '01': 'AnthemLogic Movie', '02': 'AnthemLogic Music',
+                      '03': 'PLIIx Movie', '04': 'PLIIx Music', '05': 'Neo:6 Cinema',
+                      '06': 'Neo:6 Music', '07': 'All Channel Stereo',
+                      '08': 'All Channel Mono', '09': 'Mono', '10': 'Mono-Academy',
+                      '11': 'Mono (L)', '12': 'Mono (R)', '13': 'High Blend',
+                      '14': 'Dolby Surround', '15': 'Neo:X Cinema', '16': 'Neo:X Music'}
+ZONE_LOOKUP['DYN'] = {'description': 'Dolby digital dynamic range',
+                      '0': 'Normal', '1': 'Reduced', '2': 'Late Night'}
+ZONE_LOOKUP['DIA'] = {'description': 'Dolby digital dialog normalization (dB)'}
+
+# How each zone attribute is decoded (see anthemav.state.DECODERS), keyed by
+# suffix; anything not listed is kept as a string
+ZONE_CODECS = {'POW': 'bool', 'MUT': 'bool', 'ARC': 'bool',
+               'VOL': 'int', 'INP': 'int', 'IRH': 'int', 'IRV': 'int',
+               'BRT': 'int', 'SRT': 'int', 'DIA': 'int',
+               'VIR': 'enum', 'AIC': 'enum', 'AIF': 'enum', 'ALM': 'enum',
+               'DYN': 'enum'}
+
+
+def zone_lookup(number):
+    """Return the LOOKUP entries for one zone, generated from ZONE_LOOKUP."""
+    table = {}
+    for suffix, entry in ZONE_LOOKUP.items():
+        entry = dict(entry)
+        entry['description'] = 'Zone %d %s' % (number, entry['description'])
+        table['Z%d%s' % (number, suffix)] = entry
+    return table
+
+# Full key for every zone attribute, e.g. ZONE_KEYS[2]['VOL'] == 'Z2VOL'
+ZONE_KEYS = {number: {suffix: 'Z%d%s' % (number, suffix) for suffix in ZONE_LOOKUP}
+             for number in ZONES}
+
+
+class ZoneControl:
+    """Properties and setters shared by every zone.
+
+    Each property addresses its attribute through self._keys, the ZONE_KEYS
+    entry of the zone.  AVR mixes this in for Zone 1, which keeps the
+    historic top-level properties, and Zone provides the same interface for
+    any other zone.  Implementations supply state, log, _loop, command(),
+    execute(), the _get_*/_set_boolean helpers and the input name tables.
+    """
+
+    __slots__ = ()
+
+    #
+    # Awaitable setters, see AVR.execute()
+    #
+
+    @asyncio.coroutine
+    def set_attenuation(self, value, timeout=REQUEST_TIMEOUT):
+        """Set the volume attenuation (-90 to 0 dB) and wait for the echo."""
+        if not isinstance(value, int) or not -90 <= value <= 0:
+            raise ValueError('Invalid attenuation value: %r' % (value))
+        return (yield from self.execute(self._keys['VOL']+str(value), timeout))
+
+    @asyncio.coroutine
+    def set_volume(self, value, timeout=REQUEST_TIMEOUT):
+        """Set the volume level (0-100) and wait for the echo."""
+        if not isinstance(value, int) or not 0 <= value <= 100:
+            raise ValueError('Invalid volume value: %r' % (value))
+        return (yield from self.set_attenuation(
+            self.volume_to_attenuation(value), timeout))
+
+    @asyncio.coroutine
+    def ramp_volume(self, target, duration, timeout=REQUEST_TIMEOUT):
+        """Move the volume level to target (0-100) gradually.
+
+        The attenuation is stepped 1 dB at a time, spread evenly over
+        duration seconds, and the final step waits for the echo like
+        set_attenuation().  Intermediate steps are sent with command(), so
+        with coalesce enabled any step the device cannot keep up with is
+        replaced by the next one instead of piling up.
+
+            :param target: volume level to reach (0-100)
+            :param duration: seconds the ramp should take
+            :param timeout: seconds to wait for the final echo
+            :type target: int
+            :type duration: int or float
+            :type timeout: int or float
+
+        returns the raw value string echoed by the device
+        """
+        if not isinstance(target, int) or not 0 <= target <= 100:
+            raise ValueError('Invalid volume value: %r' % (target))
+        start = self.attenuation
+        end = self.volume_to_attenuation(target)
+        steps = abs(end - start)
+        if steps > 1 and duration > 0:
+            direction = 1 if end > start else -1
+            interval = duration / steps
+            began = self._loop.time()
+            for step in range(1, steps):
+                self.command(self._keys['VOL']+str(start + direction * step))
+                delay = began + step * interval - self._loop.time()
+                yield from asyncio.sleep(max(0, delay), loop=self._loop)
+        return (yield from self.set_attenuation(end, timeout))
+
+    @asyncio.coroutine
+    def set_power(self, value, timeout=REQUEST_TIMEOUT):
+        """Switch the device on or off and wait for the echo."""
+        value = '1' if value is True else '0'
+        return (yield from self.execute(self._keys['POW']+value, timeout))
+
+    @asyncio.coroutine
+    def set_mute(self, value, timeout=REQUEST_TIMEOUT):
+        """Mute or unmute and wait for the echo."""
+        value = '1' if value is True else '0'
+        return (yield from self.execute(self._keys['MUT']+value, timeout))
+
+    @asyncio.coroutine
+    def set_input_number(self, number, timeout=REQUEST_TIMEOUT):
+        """Switch to input number (1-99) and wait for the echo."""
+        if not isinstance(number, int) or not 1 <= number <= 99:
+            raise ValueError('Invalid input number: %r' % (number))
+        return (yield from self.execute(self._keys['INP']+str(number), timeout))
+
+    #
+    # Volume and Attenuation handlers.  The Anthem tracks volume internally as
+    # an attenuation level ranging from -90dB (silent) to 0dB (bleeding ears)
+    #
+    # We expose this in three methods for the convenience of downstream apps
+    # which will almost certainly be doing things their own way:
+    #
+    #   - attenuation (-90 to 0)
+    #   - volume (0-100)
+    #   - volume_as_percentage (0-1 floating point)
+    #
+
+    def attenuation_to_volume(self, value):
+        """Convert a native attenuation value to a volume value.
+
+        Takes an attenuation in dB from the Anthem (-90 to 0) and converts it
+        into a normal volume value (0-100).
+
+            :param arg1: attenuation in dB (negative integer from -90 to 0)
+            :type arg1: int
+
+        returns an integer value representing volume
+        """
+        try:
+            return round((90.00 + int(value)) / 90 * 100)
+        except ValueError:
+            return 0
+
+    def volume_to_attenuation(self, value):
+        """Convert a volume value to a native attenuation value.
+
+        Takes a volume value and turns it into an attenuation value suitable
+        to send to the Anthem AVR.
+
+            :param arg1: volume (integer from 0 to 100)
+            :type arg1: int
+
+        returns a negative integer value representing attenuation in dB
+        """
+        try:
+            return round((value / 100) * 90) - 90
+        except ValueError:
+            return -90
+
+    @property
+    def attenuation(self):
+        """Current volume attenuation in dB (read/write).
+
+        You can get or set the current attenuation value on the device with this
+        property.  Valid range from -90 to 0.
+
+        :Examples:
+
+        >>> attvalue = attenuation
+        >>> attenuation = -50
+        """
+        value = self.state.decoded(self._keys['VOL'])
+        return -90 if value is None else value
+
+    @attenuation.setter
+    def attenuation(self, value):
+        if isinstance(value, int) and -90 <= value <= 0:
+            self.log.debug('Setting attenuation to '+str(value))
+            self.command(self._keys['VOL']+str(value))
+
+    @property
+    def volume(self):
+        """Current volume level (read/write).
+
+        You can get or set the current volume value on the device with this
+        property.  Valid range from 0 to 100.
+
+        :Examples:
+
+        >>> volvalue = volume
+        >>> volume = 20
+        """
+        return self.attenuation_to_volume(self.attenuation)
+
+    @volume.setter
+    def volume(self, value):
+        if isinstance(value, int) and 0 <= value <= 100:
+            self.attenuation = self.volume_to_attenuation(value)
+
+    @property
+    def volume_as_percentage(self):
+        """Current volume as percentage (read/write).
+
+        You can get or set the current volume value as a percentage.  Valid
+        range from 0 to 1 (float).
+
+        :Examples:
+
+        >>> volper = volume_as_percentage
+        >>> volume_as_percentage = 0.20
+        """
+        volume_per = self.volume / 100
+        return volume_per
+
+    @volume_as_percentage.setter
+    def volume_as_percentage(self, value):
+        if isinstance(value, float) or isinstance(value, int):
+            if 0 <= value <= 1:
+                value = round(value * 100)
+                self.volume = value
+
+    #
+    # Boolean properties and corresponding setters
+    #
+
+    @property
+    def power(self):
+        """Report if device powered on or off (read/write).
+
+        Returns and expects a boolean value.
+        """
+        return self._get_boolean(self._keys['POW'])
+
+    @power.setter
+    def power(self, value):
+        self._set_boolean(self._keys['POW'], value)
+        self._set_boolean(self._keys['POW'], value)
+
+    @property
+    def arc(self):
+        """Current ARC (Anthem Room Correction) on or off (read/write)."""
+        return self._get_boolean(self._keys['ARC'])
+
+    @arc.setter
+    def arc(self, value):
+        self._set_boolean(self._keys['ARC'], value)
+
+    @property
+    def mute(self):
+        """Mute on or off (read/write)."""
+        return self._get_boolean(self._keys['MUT'])
+
+    @mute.setter
+    def mute(self, value):
+        self._set_boolean(self._keys['MUT'], value)
+
+    #
+    # Read-only text properties
+    #
+
+    @property
+    def audio_input_name(self):
+        """Current audio input format short description (read-only)."""
+        return self.state.get(self._keys['AIN']) or "Unknown"
+
+    @property
+    def audio_input_ratename(self):
+        """Current audio input format sample or bit rate (read-only)."""
+        return self.state.get(self._keys['AIR']) or "Unknown"
+
+    #
+    # Read-only raw numeric properties
+    #
+
+    @property
+    def dolby_dialog_normalization(self):
+        """Query Dolby Digital dialog normalization amount (read-only).
+
+        Returns value in dB of normalization (if applicable).
+        """
+        return self._get_integer(self._keys['DIA'])
+
+    @property
+    def horizontal_resolution(self):
+        """Query active horizontal video resolution (in pixels)."""
+        return self._get_integer(self._keys['IRH'])
+
+    @property
+    def vertical_resolution(self):
+        """Query active vertical video resolution (in pixels)."""
+        return self._get_integer(self._keys['IRV'])
+
+    @property
+    def audio_input_bitrate(self):
+        """Query audio input bitrate (in kbps).
+
+        For Analog/PCM inputs this is equal to the sample rate multiplied by
+        the bit depth and the number of channels.
+        """
+        return self._get_integer(self._keys['BRT'])
+
+    @property
+    def audio_input_samplerate(self):
+        """Query audio input sampling rate (kHz)."""
+        return self._get_integer(self._keys['SRT'])
+
+    #
+    # Read/write properties with raw and text options
+    #
+
+    @property
+    def audio_listening_mode(self):
+        """Current audio listening mode (00-16) (read-write).
+
+        Audio Listening Mode: 00=None, 01=AnthemLogic-Movie,
+        02=AnthemLogic-Music, 03=PLIIx Movie, 04=PLIIx Music, 05=Neo:6 Cinema,
+        06=Neo:6 Music, 07=All Channel Stereo*, 08=All-Channel Mono*, 09=Mono*,
+        10=Mono-Academy*, 11=Mono(L)*, 12=Mono(R)*, 13=High Blend*, 14=Dolby
+        Surround, 15=Neo:X-Cinema, 16=Neo:X-Music, na=cycle to next applicable,
+        pa=cycle to previous applicable.  *Applicable to 2-channel source only.
+        Some options are not available in all models or under all
+        circumstances.
+        """
+        return self._get_multiprop(self._keys['ALM'], mode='raw')
+
+    @property
+    def audio_listening_mode_text(self):
+        """Current audio listening mode (str) (read-only)."""
+        return self._get_multiprop(self._keys['ALM'], mode='text')
+
+    @audio_listening_mode.setter
+    def audio_listening_mode(self, number):
+        if isinstance(number, int):
+            if 0 <= number <= 16:
+                self.log.info('Switching audio listening mode to '+str(number))
+                self.command(self._keys['ALM']+str(number).zfill(2))
+
+    @property
+    def dolby_dynamic_range(self):
+        """Current Dolby Dynamic Range setting (0-2) (read-write).
+
+        Applies to Dolby Digital 5.1 source only.
+
+        0=Normal, 1=Reduced, 2=Late Night.
+        """
+        return self._get_multiprop(self._keys['DYN'], mode='raw')
+
+    @property
+    def dolby_dynamic_range_text(self):
+        """Current Dolby Dynamic Range setting (str) (read-only)."""
+        return self._get_multiprop(self._keys['DYN'], mode='text')
+
+    @dolby_dynamic_range.setter
+    def dolby_dynamic_range(self, number):
+        if isinstance(number, int):
+            if 0 <= number <= 2:
+                self.log.info('Switching Dolby dynamic range to '+str(number))
+                self.command(self._keys['DYN']+str(number))
+
+    #
+    # Read-only properties with raw and text options
+    #
+
+    @property
+    def video_input_resolution(self):
+        """Current video input resolution (0-14) (read-only).
+
+        0=no input, 1=other, 2=1080p60, 3=1080p50, 4=1080p24, 5=1080i60,
+        6=1080i50, 7=720p60, 8=720p50, 9=576p50, 10=576i50, 11=480p60,
+        12=480i60, 13=3D, 14=4k
+        """
+        return self._get_multiprop(self._keys['VIR'], mode='raw')
+
+    @property
+    def video_input_resolution_text(self):
+        """Current video input resolution (str) (read-only)."""
+        return self._get_multiprop(self._keys['VIR'], mode='text')
+
+    @property
+    def audio_input_channels(self):
+        """Current audio input channels (0-7) (read-only).
+
+        0=no input, 1=other, 2=mono (center channel only), 3=2-channel,
+        4=5.1-channel, 5=6.1-channel, 6=7.1-channel, 7=Atmos
+        """
+        return self._get_multiprop(self._keys['AIC'], mode='raw')
+
+    @property
+    def audio_input_channels_text(self):
+        """Current audio input channels (str) (read-only)."""
+        return self._get_multiprop(self._keys['AIC'], mode='text')
+
+    @property
+    def audio_input_format(self):
+        """Current audio input format (0-6) (read-only).
+
+        0=no input, 1=Analog, 2=PCM, 3=Dolby, 4= DSD, 5=DTS, 6=Atmos.
+        """
+        return self._get_multiprop(self._keys['AIF'], mode='raw')
+
+    @property
+    def audio_input_format_text(self):
+        """Current audio input format (str) (read-only)."""
+        return self._get_multiprop(self._keys['AIF'], mode='text')
+
+    #
+    # Input selection
+    #
+
+    @property
+    def input_name(self):
+        """Name of currently active input (read-write)."""
+        return self._input_names.get(self.input_number, "Unknown")
+
+    @input_name.setter
+    def input_name(self, value):
+        number = self._input_numbers.get(value, 0)
+        if number > 0:
+            self.input_number = number
+
+    @property
+    def input_number(self):
+        """Number of currently active input (read-write)."""
+        return self._get_integer(self._keys['INP'])
+
+    @input_number.setter
+    def input_number(self, number):
+        if isinstance(number, int):
+            if 1 <= number <= 99:
+                self.log.info('Switching input to '+str(number))
+                self.command(self._keys['INP']+str(number))
+
+
+class Zone(ZoneControl):
+    """Control and state of a single zone of an AVR.
+
+    Obtained through AVR.zone(number); all state lives in the AVR itself.
+    """
+
+    __slots__ = ('_avr', '_keys', 'number')
+
+    def __init__(self, avr, number):
+        """Create a view of zone number on avr."""
+        self._avr = avr
+        self._keys = ZONE_KEYS[number]
+        self.number = number
+
+    def __repr__(self):
+        """Return a short description of the zone."""
+        return '<Zone %d of %r>' % (self.number, self._avr)
+
+    def refresh(self):
+        """Query the device for every attribute of this zone."""
+        self._avr.query_many(self._keys.values())
+
+    @property
+    def state(self):
+        """State table of the AVR this zone belongs to."""
+        return self._avr.state
+
+    @property
+    def log(self):
+        """Logger of the AVR this zone belongs to."""
+        return self._avr.log
+
+    @property
+    def _loop(self):
+        return self._avr._loop
+
+    @property
+    def _input_names(self):
+        return self._avr._input_names
+
+    @property
+    def _input_numbers(self):
+        return self._avr._input_numbers
+
+    def command(self, command):
+        """Issue a raw command to the device, see AVR.command()."""
+        self._avr.command(command)
+
+    @asyncio.coroutine
+    def execute(self, command, timeout=REQUEST_TIMEOUT):
+        """Issue a raw command and wait for it, see AVR.execute()."""
+        return (yield from self._avr.execute(command, timeout))
+
+    def _get_boolean(self, key):
+        return self._avr._get_boolean(key)
+
+    def _set_boolean(self, key, value):
+        self._avr._set_boolean(key, value)
+
+    def _get_integer(self, key):
+        return self._avr._get_integer(key)
+
+    def _get_multiprop(self, key, mode='raw'):
+        return self._avr._get_multiprop(key, mode)
@@ -0,0 +1,4 @@
+"""Performance benchmarks for the anthemav package.
+
+Run the whole suite with ``make bench`` or ``python -m benchmarks.run``.
+"""
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""Run the anthemav benchmark suite and emit machine-readable results.
+
+Every result is written as one JSON object per line so runs from different
+commits can be collected into a single file and compared.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import anthemav
+from anthemav.capture import INBOUND, read_capture, replay
+from anthemav.emulator import Emulator
+from anthemav.protocol import LOOKUP
+
+# A realistic mix of datagrams: mostly fluctuating audio/video attributes,
+# some control changes, input names and the occasional error or unknown key
+MESSAGES = [b'Z1BRT640', b'Z1SRT48', b'Z1BRT768', b'Z1VOL-40', b'Z1VOL-41',
+            b'Z1AIC4', b'Z1AIF3', b'Z1VIR2', b'Z1IRH1920', b'Z1IRV1080',
+            b'Z1ALM01', b'Z1MUT0', b'Z1INP2', b'ISN02Game', b'FPB2', b'ECH1',
+            b'Z2VOL-30', b'Z2POW1', b'!IZ1XYZ?', b'Z1AINDolby Digital',
+            b'Z1AIR48 kHz', b'IDMMRX 520', b'XYZ1', b'Z1DIA-27']
+
+
+class NullTransport:
+    """Transport that discards writes."""
+
+    def write(self, data):
+        pass
+
+    def get_write_buffer_limits(self):
+        return (0, 0)
+
+    def close(self):
+        pass
+
+
+def _quiet_avr(loop, **kwargs):
+    avr = anthemav.AVR(loop=loop, **kwargs)
+    avr.connection_made(NullTransport())
+    return avr
+
+
+def _result(name, value, unit, **extra):
+    result = {'benchmark': name, 'value': round(value, 6), 'unit': unit}
+    result.update(extra)
+    return result
+
+
+def bench_parse(loop, count):
+    """Messages per second through data_received for the datagram mix."""
+    results = []
+    stream = b';'.join(MESSAGES) + b';'
+    rounds = max(1, count // len(MESSAGES))
+
+    for name, chunk_size in (('parse_throughput', None),
+                             ('parse_throughput_fragmented', 7)):
+        avr = _quiet_avr(loop)
+        if chunk_size is None:
+            chunks = [stream]
+        else:
+            chunks = [stream[start:start+chunk_size]
+                      for start in range(0, len(stream), chunk_size)]
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for chunk in chunks:
+                avr.data_received(chunk)
+        elapsed = time.perf_counter() - started
+        results.append(_result(name, rounds * len(MESSAGES) / elapsed, 'msg/s'))
+    return results
+
+
+def bench_commands(loop, count):
+    """Cost of encoding and writing a command and a query."""
+    avr = _quiet_avr(loop, commands_per_second=1e12, command_burst=count)
+    results = []
+    for name, call, arg in (('command_cost', avr.command, 'Z1VOL-40'),
+                            ('query_cost', avr.query, 'Z1VOL')):
+        started = time.perf_counter()
+        for _ in range(count):
+            call(arg)
+        elapsed = time.perf_counter() - started
+        results.append(_result(name, elapsed / count * 1e6, 'us/op'))
+    return results
+
+
+def bench_memory(loop, count):
+    """Memory allocated per AVR instance."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [anthemav.AVR(loop=loop) for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del instances
+    return [_result('memory_per_avr', (after - before) / count, 'bytes')]
+
+
+@asyncio.coroutine
+def bench_device(loop, rounds):
+    """Refresh, power on and (re)connect times against a loopback emulator."""
+    results = []
+    emulator = Emulator(port=0, loop=loop, poweron_lag=0.2)
+    yield from emulator.start()
+
+    started = loop.time()
+    conn = yield from anthemav.Connection.create(
+        host=emulator.host, port=emulator.port, loop=loop,
+        retry_base=0.01, retry_cap=0.05)
+    results.append(_result('connect_latency', loop.time() - started, 's'))
+    avr = conn.protocol
+    yield from avr.fetch('IDM')
+
+    started = loop.time()
+    yield from avr.set_power(True)
+    missing = yield from avr.poweron_complete
+    results.append(_result('poweron_refresh_time', loop.time() - started, 's',
+                           missing=len(missing)))
+
+    samples = []
+    for _ in range(rounds):
+        started = loop.time()
+        avr.refresh_all()
+        # Replies come back in order, so the answer to a query outside the
+        # batch marks the end of it (a key in LOOKUP would be answered by
+        # the batch's own query for it)
+        yield from avr.fetch('Z2POW')
+        samples.append(loop.time() - started)
+    results.append(_result('refresh_all_time', min(samples), 's',
+                           keys=len(LOOKUP)))
+
+    samples = []
+    for _ in range(rounds):
+        transport = conn.transport
+        started = loop.time()
+        emulator.disconnect_all()
+        # The reconnect can finish between polls, so wait for a new transport
+        while conn.transport is None or conn.transport is transport:
+            yield from asyncio.sleep(0.001, loop=loop)
+        samples.append(loop.time() - started)
+    results.append(_result('reconnect_latency', min(samples), 's'))
+
+    conn.close()
+    emulator.close()
+    return results
+
+
+@asyncio.coroutine
+def bench_capture(loop, path):
+    """Replay a recorded capture through a fresh AVR at full speed."""
+    messages = sum(data.count(b';') for _, direction, data in read_capture(path)
+                   if direction == INBOUND)
+    avr = anthemav.AVR(loop=loop)
+    started = time.perf_counter()
+    chunks = yield from replay(avr, path, speed=None, loop=loop)
+    elapsed = time.perf_counter() - started
+    return [_result('capture_replay_throughput', messages / elapsed, 'msg/s',
+                    chunks=chunks, capture=path)]
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Run every benchmark and write the results as JSON lines."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', '-o', help='Append results to this file')
+    parser.add_argument('--count', default='20000',
+                        help='Iterations for the micro benchmarks')
+    parser.add_argument('--rounds', default='5',
+                        help='Rounds for the emulator benchmarks')
+    parser.add_argument('--capture', action='append', default=[],
+                        help='Also time replaying this capture file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    loop = asyncio.get_event_loop()
+    count = int(args.count)
+
+    results = []
+    results.extend(bench_parse(loop, count))
+    results.extend(bench_commands(loop, count))
+    results.extend(bench_memory(loop, 1000))
+    results.extend(loop.run_until_complete(bench_device(loop, int(args.rounds))))
+    for path in args.capture:
+        results.extend(loop.run_until_complete(bench_capture(loop, path)))
+
+    context = {'commit': _commit(), 'python': platform.python_version(),
+               'timestamp': int(time.time())}
+    lines = []
+    for result in results:
+        result.update(context)
+        lines.append(json.dumps(result, sort_keys=True))
+
+    if args.output:
+        with open(args.output, 'a') as output:
+            output.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -36,6 +36,8 @@ setup(
     zip_safe=True,
 
     entry_points={
-        'console_scripts': [ 'anthemav_monitor = anthemav.tools:monitor', ]
+        'console_scripts': [ 'anthemav_monitor = anthemav.tools:monitor',
+                             'anthemav_emulator = anthemav.emulator:main',
+                             'anthemav_proxy = anthemav.proxy:main', ]
     }
 )
@@ -1,10 +1,84 @@
 #!/usr/bin/env python3
 
 import asyncio
+import functools
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 import logging
 
 import anthemav
+from anthemav import protocol
+from anthemav.emulator import Emulator
+from anthemav.fleet import ReconnectScheduler
+from anthemav.proxy import Proxy
+from anthemav.sync import SyncEventStream, SyncProxy
+
+
+class EmulatorTestCase(unittest.TestCase):
+    """Base for tests run against an Emulator on a fresh event loop."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        # Runs before the loop is closed but after the cleanups added later
+        self.addCleanup(self.loop.run_until_complete,
+                        asyncio.sleep(0.01, loop=self.loop))
+
+    def run_async(self, coro, timeout=10):
+        """Run a coroutine on the test loop and return its result."""
+        return self.loop.run_until_complete(
+            asyncio.wait_for(coro, timeout, loop=self.loop))
+
+    @asyncio.coroutine
+    def start_emulator(self, **options):
+        """Start an emulator on a free port, closed when the test ends."""
+        emulator = Emulator(host='127.0.0.1', port=0, loop=self.loop, **options)
+        yield from emulator.start()
+        self.addCleanup(emulator.close)
+        return emulator
+
+    @asyncio.coroutine
+    def connect(self, emulator, **options):
+        """Connect to emulator, closed when the test ends."""
+        options.setdefault('auto_reconnect', False)
+        conn = yield from anthemav.Connection.create(
+            host=emulator.host, port=emulator.port, loop=self.loop, **options)
+        self.addCleanup(conn.close)
+        return conn
+
+    @asyncio.coroutine
+    def power_on(self, conn):
+        """Power the device on and wait for the power on refresh."""
+        yield from conn.protocol.set_power(True, timeout=1.0)
+        return (yield from conn.protocol.poweron_complete)
+
+    @asyncio.coroutine
+    def wait_until(self, condition, timeout=5):
+        """Poll condition until it is true, failing after timeout seconds."""
+        deadline = self.loop.time() + timeout
+        while not condition():
+            if self.loop.time() > deadline:
+                self.fail('Timed out waiting for condition')
+            yield from asyncio.sleep(0.01, loop=self.loop)
+
+    @staticmethod
+    def record_arrivals(emulator):
+        """Return a list of (time, message) for every datagram emulator gets."""
+        arrivals = []
+        handle = emulator.handle
+
+        def record(client, message):
+            arrivals.append((emulator._loop.time(), message))
+            handle(client, message)
+        emulator.handle = record
+        return arrivals
 
 @asyncio.coroutine
 def test():
@@ -14,12 +88,1550 @@ def test():
         log.info('Callback invoked: %s' % message)
 
     host = '127.0.0.1'
-    port = 14999
+    port = 0
+
+    emulator = Emulator(host=host, port=port, loop=loop, poweron_lag=0.5,
+                        fragment=7, latency=0.01)
+    yield from emulator.start()
+    port = emulator.port
 
     log.info('Connecting to Anthem AVR at %s:%i' % (host, port))
 
-    # conn = yield from anthemav.Connection.create(host=host,port=port,loop=loop,update_callback=log_callback,auto_reconnect=False)
+    conn = yield from anthemav.Connection.create(host=host,port=port,loop=loop,update_callback=log_callback,auto_reconnect=False)
+
+    yield from conn.protocol.set_power(True, timeout=1.0)
+    missing = yield from asyncio.wait_for(conn.protocol.poweron_complete, 10,
+                                          loop=loop)
+    assert not missing, missing
+
+    assert conn.protocol.power is True
+    assert conn.protocol.model == 'MRX 520'
+    assert conn.protocol.input_name == 'Blu-ray'
+    assert conn.protocol.attenuation == -40
+
+    yield from conn.protocol.set_volume(50, timeout=1.0)
+    assert emulator.state['Z1VOL'] == '-45'
+    assert conn.protocol.volume == 50
+
+    conn.close()
+    emulator.close()
+
+class WritePacingTest(EmulatorTestCase):
+    """Outbound commands are queued and paced, never blocking the caller."""
+
+    def test_commands_are_paced(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            arrivals = self.record_arrivals(emulator)
+            conn = yield from self.connect(emulator, commands_per_second=20)
+            avr = conn.protocol
+            yield from avr.fetch('IDM')
+            yield from asyncio.sleep(0.1, loop=self.loop)
+            del arrivals[:]
+
+            started = self.loop.time()
+            for _ in range(5):
+                avr.query('IDS')
+            self.assertLess(self.loop.time() - started, 0.01)
+            self.assertEqual(avr.queue_depth, 4)
+
+            yield from self.wait_until(lambda: len(arrivals) == 5)
+            # One command per 1/20 second after the first
+            self.assertGreaterEqual(arrivals[-1][0] - arrivals[0][0], 0.15)
+            self.assertEqual(avr.queue_depth, 0)
+        self.run_async(run())
+
+    def test_burst_is_sent_without_waiting(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, commands_per_second=5,
+                                           command_burst=4)
+            avr = conn.protocol
+            yield from avr.fetch('IDM')
+            yield from asyncio.sleep(1, loop=self.loop)
+
+            writes = []
+            write = conn.transport.write
+            conn.transport.write = lambda data: (writes.append(data), write(data))
+            for key in ('IDS', 'IDR', 'IDB', 'IDH', 'IDN'):
+                avr.query(key)
+            self.assertEqual(writes, [b'IDS?;', b'IDR?;', b'IDB?;', b'IDH?;'])
+            self.assertEqual(avr.queue_depth, 1)
+        self.run_async(run())
+
+    def test_bulk_queries_are_split_and_filtered(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, max_write_size=20)
+            avr = conn.protocol
+            yield from avr.fetch('IDM')
+            yield from asyncio.sleep(0.1, loop=self.loop)
+
+            writes = []
+            write = conn.transport.write
+            conn.transport.write = lambda data: (writes.append(data), write(data))
+            avr.unsupported.add('IDS')
+            avr.query_many(['Z1VOL', 'Z1MUT', 'IDM', 'IDS', 'IDR', 'IDB'])
+            yield from self.wait_until(lambda: len(writes) == 2)
+            self.assertEqual(writes, [b'Z1VOL?;Z1MUT?;IDM?;', b'IDR?;IDB?;'])
+            self.assertTrue(all(len(data) <= 20 for data in writes))
+        self.run_async(run())
+
+    def test_queue_is_dropped_on_disconnect(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, commands_per_second=1)
+            avr = conn.protocol
+            for _ in range(5):
+                avr.query('IDS')
+            self.assertGreater(avr.queue_depth, 0)
+            emulator.disconnect_all()
+            yield from self.wait_until(lambda: not conn.connected)
+            self.assertEqual(avr.queue_depth, 0)
+        self.run_async(run())
+
+
+class DispatchTest(unittest.TestCase):
+    """Datagrams are routed to their handler by the dispatch tables."""
+
+    def test_every_attribute_is_matched(self):
+        for key in protocol.ATTRIBUTES:
+            self.assertEqual(protocol.match_key(key+'1')[0], key)
+
+    def test_value_starting_with_another_key(self):
+        self.assertEqual(protocol.match_key('IDMZ1POW1'),
+                         ('IDM', '_handle_model'))
+        self.assertEqual(protocol.match_key('Z2AINIDM'),
+                         ('Z2AIN', '_handle_attribute'))
+        self.assertEqual(protocol.match_key('!EZ1VOL?'),
+                         ('!E', '_handle_error'))
+
+    def test_zone_routing(self):
+        self.assertEqual(protocol.match_key('Z1POW1'), ('Z1POW', '_handle_power'))
+        self.assertEqual(protocol.match_key('Z3VOL-40'),
+                         ('Z3VOL', '_handle_attribute'))
+        # Only zones 1-3 exist
+        self.assertEqual(protocol.match_key('Z4VOL-40'), (None, None))
+
+    def test_unknown_datagram(self):
+        self.assertEqual(protocol.match_key('XYZ1'), (None, None))
+        self.assertEqual(protocol.match_key(''), (None, None))
+
+    def test_longest_key_wins(self):
+        # A key that is a prefix of another must not shadow it, whatever
+        # order the keys were defined in
+        with unittest.mock.patch.dict(protocol.DISPATCH, {'IDMX': '_handle_x'}), \
+                unittest.mock.patch.object(protocol, 'DISPATCH_LENGTHS', (4, 3, 2)):
+            self.assertEqual(protocol.match_key('IDMX1'), ('IDMX', '_handle_x'))
+            self.assertEqual(protocol.match_key('IDMMRX 520'),
+                             ('IDM', '_handle_model'))
+
+    def test_handlers_exist(self):
+        for handler in set(protocol.DISPATCH.values()) | set(protocol.ZONE_DISPATCH.values()):
+            self.assertTrue(callable(getattr(anthemav.AVR, handler)), handler)
+
+
+class StateTest(unittest.TestCase):
+    """The state table stores values in schema slots and compares snapshots."""
+
+    def setUp(self):
+        self.schema = anthemav.state.StateSchema(('IDM', 'Z1VOL', 'Z1MUT'),
+                                                 {'Z1VOL': 'int'})
+        self.state = anthemav.state.State(self.schema)
+
+    def test_get_and_set(self):
+        self.assertEqual(self.state.get('Z1VOL'), '')
+        self.assertEqual(self.state.set('Z1VOL', '-40', 12.5), '')
+        self.assertEqual(self.state.set('Z1VOL', '-40'), '-40')
+        self.assertEqual(self.state.get('Z1VOL'), '-40')
+        self.assertEqual(self.state.updated('Z1VOL'), 12.5)
+        self.assertIsNone(self.state.updated('IDM'))
+        with self.assertRaises(KeyError):
+            self.state.get('Z2VOL')
+
+    def test_snapshot_and_diff(self):
+        self.state.set('IDM', 'MRX 520')
+        old = self.state.snapshot()
+        self.assertIsInstance(old, tuple)
+        self.state.set('Z1VOL', '-40')
+        self.state.set('Z1MUT', '1')
+        self.state.set('IDM', 'MRX 520')
+        new = self.state.snapshot()
+        self.assertEqual(old, ('MRX 520', '', ''))
+        self.assertEqual(self.state.diff(old, new),
+                         {'Z1VOL': ('', '-40'), 'Z1MUT': ('', '1')})
+        self.assertEqual(self.state.diff(new, new), {})
+
+    def test_as_dict(self):
+        old = self.state.snapshot()
+        self.state.set('Z1VOL', '-40')
+        self.assertEqual(self.state.as_dict(),
+                         {'IDM': '', 'Z1VOL': '-40', 'Z1MUT': ''})
+        self.assertEqual(self.state.as_dict(old),
+                         {'IDM': '', 'Z1VOL': '', 'Z1MUT': ''})
+
+
+class CodecTest(unittest.TestCase):
+    """Raw values are decoded once by the codec of their key."""
+
+    def test_zone_codecs(self):
+        for zone in (1, 2, 3):
+            self.assertEqual(protocol.CODECS['Z%dVOL' % zone], 'int')
+            self.assertEqual(protocol.CODECS['Z%dPOW' % zone], 'bool')
+            self.assertEqual(protocol.CODECS['Z%dALM' % zone], 'enum')
+            self.assertNotIn('Z%dAIN' % zone, protocol.CODECS)
+        for key in protocol.CODECS:
+            self.assertIn(key, protocol.SCHEMA)
+
+    def test_undecodable_values(self):
+        state = anthemav.state.State(protocol.SCHEMA)
+        for value in ('', 'abc', '1.5'):
+            state.set('Z1VOL', value)
+            state.set('Z1POW', value)
+            self.assertIsNone(state.decoded('Z1VOL'))
+            self.assertIs(state.decoded('Z1POW'), False)
+        state.set('Z1VOL', '-35')
+        state.set('Z1POW', '1')
+        self.assertEqual(state.decoded('Z1VOL'), -35)
+        self.assertIs(state.decoded('Z1POW'), True)
+
+    def test_text_labels(self):
+        state = anthemav.state.State(protocol.SCHEMA)
+        state.set('Z1ALM', '03')
+        self.assertEqual(state.decoded('Z1ALM'), '03')
+        self.assertEqual(state.text('Z1ALM'), 'PLIIx Movie')
+        state.set('Z1ALM', '99')
+        self.assertEqual(state.text('Z1ALM'), '99')
+        state.set('IDM', 'MRX 520')
+        self.assertEqual(state.text('IDM'), 'MRX 520')
+
+    def test_getter_types(self):
+        avr = anthemav.AVR(loop=asyncio.new_event_loop())
+        self.addCleanup(avr._loop.close)
+        for key, value in (('Z1VOL', '-35'), ('Z1POW', '1'), ('Z1BRT', '640'),
+                           ('Z1ALM', '03'), ('FPB', '2'), ('ICN', '3')):
+            avr.state.set(key, value)
+        self.assertEqual(avr.attenuation, -35)
+        self.assertIsInstance(avr.volume, int)
+        self.assertIs(avr.power, True)
+        self.assertIs(avr.mute, False)
+        self.assertEqual(avr.audio_input_bitrate, 640)
+        self.assertEqual(avr.audio_listening_mode, '03')
+        self.assertEqual(avr.audio_listening_mode_text, 'PLIIx Movie')
+        self.assertEqual(avr.panel_brightness, '2')
+        self.assertEqual(avr.panel_brightness_text, 'Medium')
+
+        avr.state.set('Z1VOL', '')
+        avr.state.set('Z1BRT', 'n/a')
+        self.assertEqual(avr.attenuation, -90)
+        self.assertIsNone(avr.audio_input_bitrate)
+
+
+class FramingTest(EmulatorTestCase):
+    """Datagrams split across reads are put back together."""
+
+    def test_split_at_every_byte(self):
+        avr = anthemav.AVR(loop=self.loop)
+        for byte in b'IDMMRX 520;Z1VOL-35;IDSa.b;':
+            avr.data_received(bytes((byte,)))
+        self.assertEqual(avr.model, 'MRX 520')
+        self.assertEqual(avr.attenuation, -35)
+        self.assertEqual(avr.swversion, 'a.b')
+        self.assertEqual(avr.buffer, b'')
+
+    def test_partial_tail_is_kept(self):
+        avr = anthemav.AVR(loop=self.loop)
+        avr.data_received(b'IDMMRX 5')
+        self.assertEqual(avr.model, 'Unknown Model')
+        avr.data_received(b'20;;;IDRU')
+        self.assertEqual(avr.model, 'MRX 520')
+        self.assertEqual(avr.buffer, b'IDRU')
+        avr.data_received(b'S;')
+        self.assertEqual(avr.region, 'US')
+
+    def test_oversized_frame_is_discarded(self):
+        avr = anthemav.AVR(loop=self.loop, max_frame_size=16)
+        avr.data_received(b'IDM' + b'x' * 20)
+        self.assertEqual(avr.buffer, b'')
+        # The rest of the oversized frame is skipped up to its terminator
+        avr.data_received(b'xxxx')
+        self.assertEqual(avr.buffer, b'')
+        avr.data_received(b'Z1VOL-10;IDMMRX 520;')
+        self.assertEqual(avr.state.get('Z1VOL'), '')
+        self.assertEqual(avr.model, 'MRX 520')
+        self.assertEqual(avr.buffer, b'')
+
+    def test_fragmented_device(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator(fragment=2)
+            conn = yield from self.connect(emulator)
+            avr = conn.protocol
+            self.assertEqual((yield from avr.fetch('IDM')), 'MRX 520')
+            self.assertEqual((yield from avr.fetch('IDN')), '00:11:22:33:44:55')
+            self.assertEqual(avr.buffer, b'')
+        self.run_async(run())
+
+
+class PowerOnRefreshTest(EmulatorTestCase):
+    """Attributes are re-queried after power on until they answer."""
+
+    def test_not_ready_keys_are_retried(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator(poweron_lag=1.5,
+                                                      unsupported={'Z1DIA'})
+            arrivals = self.record_arrivals(emulator)
+            profiles = anthemav.Profiles(loop=self.loop)
+            conn = yield from self.connect(emulator, profiles=profiles)
+            avr = conn.protocol
+            missing = yield from self.power_on(conn)
+
+            self.assertEqual(missing, set())
+            self.assertEqual(avr.attenuation, -40)
+            self.assertEqual(avr.input_list, ['Blu-ray', 'Game', 'TV'])
+            self.assertEqual(avr.macaddress, '00:11:22:33:44:55')
+            # !E during the boot lag is not mistaken for unsupported
+            self.assertEqual(avr.unsupported, {'Z1DIA'})
+            self.assertEqual(profiles.unsupported('MRX 520'), {'Z1DIA'})
+
+            queries = [message for _, message in arrivals]
+            # Refused with !E once, then answered
+            self.assertEqual(queries.count('Z1VOL?'), 2)
+            # !I is a final answer
+            self.assertEqual(queries.count('Z1DIA?'), 1)
+        self.run_async(run())
+
+    def test_missing_keys_are_reported(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator(poweron_lag=30)
+            conn = yield from self.connect(
+                emulator,
+                protocol_class=functools.partial(anthemav.AVR, poweron_timeout=2))
+            missing = yield from self.power_on(conn)
+            self.assertLessEqual({'Z1VOL', 'IDN', 'ICN'}, missing)
+            self.assertNotIn('IDM', missing)
+        self.run_async(run())
+
+    def test_power_off_cancels_refresh(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator(poweron_lag=30)
+            conn = yield from self.connect(emulator)
+            avr = conn.protocol
+            yield from avr.set_power(True, timeout=1.0)
+            future = avr.poweron_complete
+            yield from avr.set_power(False, timeout=1.0)
+            self.assertTrue(future.done())
+            self.assertIn('Z1VOL', future.result())
+        self.run_async(run())
+
+
+class RequestTest(EmulatorTestCase):
+    """fetch() and execute() are matched to the responses they caused."""
+
+    @asyncio.coroutine
+    def connect_powered(self, **options):
+        emulator = yield from self.start_emulator(**options)
+        conn = yield from self.connect(emulator)
+        yield from conn.protocol.set_power(True, timeout=1.0)
+        return emulator, conn.protocol
+
+    def test_fetch_and_execute(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr = yield from self.connect_powered()
+            self.assertEqual((yield from avr.fetch('Z1VOL')), '-40')
+            self.assertEqual((yield from avr.execute('Z1VOL-30')), '-30')
+            self.assertEqual(emulator.state['Z1VOL'], '-30')
+            self.assertEqual((yield from avr.fetch('ISN02')), 'Game')
+        self.run_async(run())
+
+    def test_get_uses_fresh_cache(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr = yield from self.connect_powered()
+            yield from avr.poweron_complete
+            arrivals = self.record_arrivals(emulator)
+            self.assertEqual((yield from avr.get('Z1VOL', max_age=5)), '-40')
+            self.assertEqual((yield from avr.get('Z1VOL')), '-40')
+            self.assertEqual(arrivals, [])
+        self.run_async(run())
+
+    def test_get_queries_stale_value(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr = yield from self.connect_powered()
+            yield from avr.poweron_complete
+            arrivals = self.record_arrivals(emulator)
+            emulator.state['Z1VOL'] = '-33'
+            yield from asyncio.sleep(0.1, loop=self.loop)
+            self.assertEqual((yield from avr.get('Z1VOL', max_age=0.05)), '-33')
+            self.assertEqual([message for _, message in arrivals], ['Z1VOL?'])
+        self.run_async(run())
+
+    def test_concurrent_gets_share_one_query(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr = yield from self.connect_powered(latency=0.05)
+            yield from avr.poweron_complete
+            arrivals = self.record_arrivals(emulator)
+            values = yield from asyncio.gather(
+                *[avr.get('Z1VOL', max_age=0) for _ in range(3)],
+                loop=self.loop)
+            self.assertEqual(values, ['-40'] * 3)
+            self.assertEqual([message for _, message in arrivals], ['Z1VOL?'])
+            self.assertEqual(avr._inflight, {})
+        self.run_async(run())
+
+    def test_concurrent_requests(self):
+        @asyncio.coroutine
+        def run():
+            _, avr = yield from self.connect_powered(latency=0.02)
+            values = yield from asyncio.gather(
+                avr.fetch('IDM'), avr.fetch('IDN'), avr.execute('Z1VOL-25'),
+                avr.fetch('Z1INP'), avr.fetch('IDM'), loop=self.loop)
+            self.assertEqual(values, ['MRX 520', '00:11:22:33:44:55', '-25',
+                                      '1', 'MRX 520'])
+            self.assertEqual(avr._pending_requests, {})
+        self.run_async(run())
+
+    def test_query_answer_does_not_complete_command(self):
+        @asyncio.coroutine
+        def run():
+            _, avr = yield from self.connect_powered(latency=0.05)
+            avr.query('Z1VOL')
+            self.assertEqual((yield from avr.execute('Z1VOL-30')), '-30')
+            self.assertEqual(avr.attenuation, -30)
+        self.run_async(run())
+
+    def test_rejected_requests(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr = yield from self.connect_powered()
+            for command, code in (('Z1VOL10', '!R'), ('Z2VOL-30', '!Z'),
+                                  ('Z1XYZ1', '!I')):
+                with self.assertRaises(anthemav.CommandError) as caught:
+                    yield from avr.execute(command, timeout=1.0)
+                self.assertEqual(caught.exception.code, code)
+                self.assertEqual(caught.exception.command, command)
+            with self.assertRaises(anthemav.CommandError) as caught:
+                yield from avr.fetch('Z1XYZ', timeout=1.0)
+            self.assertEqual(caught.exception.code, '!I')
+            self.assertEqual(emulator.state['Z1VOL'], '-40')
+            self.assertEqual(avr._pending_requests, {})
+        self.run_async(run())
+
+    def test_error_goes_to_its_own_request(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr = yield from self.connect_powered()
+            # Answer queries late, so the error for the command arrives
+            # while the query before it is still pending
+            handle = emulator.handle
+
+            def slow_queries(client, message):
+                if message.endswith('?'):
+                    self.loop.call_later(0.1, handle, client, message)
+                else:
+                    handle(client, message)
+            emulator.handle = slow_queries
+            fetched, executed, queried = yield from asyncio.gather(
+                avr.fetch('Z1VOL', timeout=1.0),
+                avr.execute('Z1VOL10', timeout=1.0),
+                avr.fetch('Z1VOL', timeout=1.0),
+                loop=self.loop, return_exceptions=True)
+            self.assertEqual(fetched, '-40')
+            self.assertIsInstance(executed, anthemav.CommandError)
+            self.assertEqual(executed.command, 'Z1VOL10')
+            self.assertEqual(queried, '-40')
+
+            errors = yield from asyncio.gather(
+                avr.execute('Z2VOL-30', timeout=1.0),
+                avr.fetch('Z2VOL', timeout=1.0),
+                loop=self.loop, return_exceptions=True)
+            self.assertEqual([error.command for error in errors],
+                             ['Z2VOL-30', 'Z2VOL?'])
+            self.assertEqual(avr._pending_requests, {})
+        self.run_async(run())
+
+    def test_timeout(self):
+        @asyncio.coroutine
+        def run():
+            _, avr = yield from self.connect_powered(latency=0.3)
+            with self.assertRaises(asyncio.TimeoutError):
+                yield from avr.fetch('IDM', timeout=0.05)
+            self.assertEqual(avr._pending_requests, {})
+            self.assertEqual((yield from avr.fetch('IDN', timeout=1.0)),
+                             '00:11:22:33:44:55')
+        self.run_async(run())
+
+    def test_lost_connection_fails_requests(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr = yield from self.connect_powered()
+            emulator.handle = lambda client, message: None
+            request = protocol.ensure_future(avr.fetch('IDM'), loop=self.loop)
+            yield from asyncio.sleep(0.05, loop=self.loop)
+            emulator.disconnect_all()
+            with self.assertRaises(ConnectionError):
+                yield from request
+            with self.assertRaises(ConnectionError):
+                yield from avr.fetch('IDM')
+        self.run_async(run())
+
+
+class ReconnectTest(EmulatorTestCase):
+    """Lost connections are re-established, at once after a resume()."""
+
+    def test_reconnect_after_disconnect(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, auto_reconnect=True,
+                                           retry_base=0.05)
+            transport = conn.transport
+            emulator.disconnect_all()
+            yield from self.wait_until(
+                lambda: conn.transport not in (None, transport))
+            self.assertTrue((yield from conn.wait_connected(1)))
+        self.run_async(run())
+
+    def test_reconnects_are_counted(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, auto_reconnect=True,
+                                           retry_base=0.05, metrics=True)
+            self.assertEqual(conn.metrics.get('reconnect_attempts'), 0)
+            for _ in range(3):
+                transport = conn.transport
+                emulator.disconnect_all()
+                yield from self.wait_until(
+                    lambda: conn.transport not in (None, transport))
+            self.assertEqual(conn.metrics.get('reconnect_attempts'), 3)
+        self.run_async(run())
+
+    def test_first_connect_is_not_an_outage(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, auto_reconnect=True,
+                                           retry_base=0.05, metrics=True)
+            self.assertEqual(conn.metrics.get('disconnected_seconds'), 0)
+            transport = conn.transport
+            emulator.disconnect_all()
+            yield from self.wait_until(
+                lambda: conn.transport not in (None, transport))
+            self.assertGreater(conn.metrics.get('disconnected_seconds'), 0)
+        self.run_async(run())
+
+    def test_resume_cuts_backoff_short(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            port = emulator.port
+            conn = yield from self.connect(emulator, auto_reconnect=True,
+                                           retry_base=30, retry_cap=30)
+            emulator.close()
+            yield from emulator.wait_closed()
+            # The reconnect fails and backs off for 30 seconds
+            yield from self.wait_until(lambda: conn.health()['last_error'])
+            conn.halt()
+
+            emulator = Emulator(host='127.0.0.1', port=port, loop=self.loop)
+            yield from emulator.start()
+            self.addCleanup(emulator.close)
+            conn.resume()
+            self.assertTrue((yield from conn.wait_connected(2)))
+        self.run_async(run())
+
+    def test_halted_connection_stays_down(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, auto_reconnect=True,
+                                           retry_base=0.05)
+            conn.halt()
+            yield from asyncio.sleep(0.3, loop=self.loop)
+            self.assertFalse(conn.connected)
+            conn.resume()
+            self.assertTrue((yield from conn.wait_connected(1)))
+        self.run_async(run())
+
+
+class FleetTest(EmulatorTestCase):
+    """A ConnectionManager keeps many devices connected through one scheduler."""
+
+    def manager(self, **options):
+        """Create a ConnectionManager, closed when the test ends."""
+        fleet = anthemav.ConnectionManager(loop=self.loop, **options)
+        self.addCleanup(fleet.close)
+        return fleet
+
+    def test_add_and_remove_at_runtime(self):
+        @asyncio.coroutine
+        def run():
+            first = yield from self.start_emulator()
+            second = yield from self.start_emulator()
+            fleet = self.manager()
+            conn = yield from fleet.add(first.host, first.port, name='den')
+            self.assertTrue((yield from fleet.wait_connected(2)))
+            self.assertIn('den', fleet)
+            with self.assertRaises(ValueError):
+                yield from fleet.add(second.host, second.port, name='den')
+
+            yield from fleet.add(second.host, second.port)
+            name = '%s:%d' % (second.host, second.port)
+            self.assertTrue((yield from fleet.wait_connected(2)))
+            self.assertEqual(len(fleet), 2)
+            self.assertEqual(fleet.connected_count, 2)
+
+            fleet.remove('den')
+            self.assertNotIn('den', fleet)
+            self.assertEqual(list(fleet.connections), [name])
+            yield from self.wait_until(lambda: not conn.connected)
+        self.run_async(run())
+
+    def test_health_and_wait_connected(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            gone = yield from self.start_emulator()
+            gone.close()
+            yield from gone.wait_closed()
+            fleet = self.manager(retry_base=0.05)
+            yield from fleet.add(emulator.host, emulator.port, name='up')
+            yield from fleet.add(gone.host, gone.port, name='down')
+            self.assertFalse((yield from fleet.wait_connected(0.5)))
+
+            health = fleet.health()
+            self.assertEqual(set(health), {'up', 'down'})
+            self.assertTrue(health['up']['connected'])
+            self.assertFalse(health['down']['connected'])
+            self.assertIsNotNone(health['down']['last_error'])
+            self.assertEqual(fleet.connected_count, 1)
+        self.run_async(run())
+
+    def test_max_concurrent_gates_attempts(self):
+        @asyncio.coroutine
+        def run():
+            scheduler = ReconnectScheduler(max_concurrent=2,
+                                           attempts_per_second=1000,
+                                           loop=self.loop)
+            acquires = [protocol.ensure_future(scheduler.acquire(),
+                                               loop=self.loop)
+                        for _ in range(3)]
+            yield from asyncio.sleep(0.05, loop=self.loop)
+            self.assertEqual([task.done() for task in acquires],
+                             [True, True, False])
+            scheduler.release()
+            yield from asyncio.wait_for(acquires[2], 1, loop=self.loop)
+            scheduler.release()
+            scheduler.release()
+        self.run_async(run())
+
+    def test_attempts_are_spread_out(self):
+        @asyncio.coroutine
+        def run():
+            scheduler = ReconnectScheduler(attempts_per_second=20,
+                                           loop=self.loop)
+            started = []
+
+            @asyncio.coroutine
+            def attempt():
+                yield from scheduler.acquire()
+                started.append(self.loop.time())
+                scheduler.release()
+
+            yield from asyncio.gather(*[attempt() for _ in range(5)],
+                                      loop=self.loop)
+            self.assertGreaterEqual(started[-1] - started[0], 0.19)
+        self.run_async(run())
+
+
+class ZoneTest(EmulatorTestCase):
+    """Zones 2 and 3 have the properties and setters of the main zone."""
+
+    def test_zone_properties(self):
+        avr = anthemav.AVR(loop=self.loop)
+        self.assertIs(avr.zone(2), avr.zone(2))
+        with self.assertRaises(ValueError):
+            avr.zone(4)
+        avr.data_received(b'ISN02Game;Z2VOL-45;Z2MUT1;Z2INP2;Z2ALM03;Z1VOL-20;')
+        zone = avr.zone(2)
+        self.assertEqual(zone.attenuation, -45)
+        self.assertEqual(zone.volume, 50)
+        self.assertIs(zone.mute, True)
+        self.assertIs(zone.power, False)
+        self.assertEqual(zone.input_number, 2)
+        self.assertEqual(zone.input_name, 'Game')
+        self.assertEqual(zone.audio_listening_mode_text, 'PLIIx Movie')
+        self.assertEqual(avr.attenuation, -20)
+        self.assertEqual(avr.zone(3).attenuation, -90)
+
+    def test_zone_setters(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator(
+                state={'Z1POW': '1', 'Z2POW': '1'})
+            conn = yield from self.connect(emulator)
+            zone = conn.protocol.zone(2)
+            yield from conn.protocol.fetch('IDN')
+            zone.volume = 50
+            zone.mute = True
+            zone.input_number = 3
+            yield from self.wait_until(lambda: zone.input_number == 3)
+            self.assertEqual(emulator.state['Z2VOL'], '-45')
+            self.assertEqual(emulator.state['Z2MUT'], '1')
+            self.assertEqual((yield from zone.set_attenuation(-30)), '-30')
+            self.assertEqual(zone.attenuation, -30)
+            self.assertEqual(emulator.state['Z1VOL'], '-40')
+            with self.assertRaises(ValueError):
+                yield from zone.set_volume(101)
+        self.run_async(run())
+
+    def test_zone_power_on_refresh(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, zones=3)
+            avr = conn.protocol
+            yield from self.power_on(conn)
+            self.assertIs(avr.zone(2).power, False)
+
+            arrivals = self.record_arrivals(emulator)
+            for number in (2, 3):
+                del arrivals[:]
+                emulator.push('Z%dPOW' % number, '1')
+                yield from self.wait_until(
+                    lambda: ('Z%dVOL?' % number) in
+                    [message for _, message in arrivals])
+                queried = {message[:2] for _, message in arrivals
+                           if message.endswith('?')}
+                self.assertEqual(queried, {'Z%d' % number})
+                self.assertIs(avr.zone(number).power, True)
+        self.run_async(run())
+
+
+class CaptureTest(EmulatorTestCase):
+    """Recorded traffic can be replayed through another AVR."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'session.cap')
+
+    def test_record_and_replay(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, capture=self.path)
+            yield from self.power_on(conn)
+            yield from conn.protocol.set_volume(50, timeout=1.0)
+            conn.protocol.stop_recording()
+            self.assertEqual(
+                {direction for _, direction, _ in anthemav.capture.read_capture(self.path)},
+                {anthemav.capture.INBOUND, anthemav.capture.OUTBOUND})
+
+            lost = []
+            avr = anthemav.AVR(loop=self.loop,
+                               connection_lost_callback=lambda: lost.append(1))
+            chunks = yield from anthemav.replay(avr, self.path, speed=None,
+                                                loop=self.loop)
+            self.assertGreater(chunks, 0)
+            self.assertEqual(avr.volume, 50)
+            self.assertEqual(avr.input_list, ['Blu-ray', 'Game', 'TV'])
+            self.assertIsNone(avr.transport)
+            yield from asyncio.sleep(0.01, loop=self.loop)
+            # Ending the replay is not a lost connection
+            self.assertEqual(lost, [])
+        self.run_async(run())
+
+    def write_volumes(self, count):
+        recorder = anthemav.Recorder(self.path)
+        for value in range(count):
+            recorder.record(anthemav.capture.INBOUND,
+                            ('Z1VOL-%d;' % (value % 90)).encode())
+        recorder.close()
+
+    def test_replay_into_blocking_stream(self):
+        @asyncio.coroutine
+        def run():
+            self.write_volumes(10)
+            avr = anthemav.AVR(loop=self.loop)
+            with avr.events(keys={'Z1VOL'}, maxsize=2, policy='block') as stream:
+                chunks = yield from anthemav.replay(avr, self.path, speed=None,
+                                                    loop=self.loop)
+                self.assertEqual(chunks, 10)
+                self.assertEqual(len(stream), 10)
+        self.run_async(run())
+
+    def test_full_speed_replay_yields(self):
+        @asyncio.coroutine
+        def run():
+            self.write_volumes(1000)
+            ticks = []
+
+            @asyncio.coroutine
+            def ticker():
+                while True:
+                    ticks.append(1)
+                    yield from asyncio.sleep(0, loop=self.loop)
+            task = protocol.ensure_future(ticker(), loop=self.loop)
+            yield from asyncio.sleep(0, loop=self.loop)
+            del ticks[:]
+            avr = anthemav.AVR(loop=self.loop)
+            yield from anthemav.replay(avr, self.path, speed=None, loop=self.loop)
+            task.cancel()
+            self.assertGreaterEqual(len(ticks), 1000 // 64 - 1)
+        self.run_async(run())
+
+    def test_replay_speed(self):
+        @asyncio.coroutine
+        def run():
+            recorder = anthemav.Recorder(self.path)
+            recorder.record(anthemav.capture.INBOUND, b'IDMMRX 520;')
+            yield from asyncio.sleep(0.2, loop=self.loop)
+            recorder.record(anthemav.capture.INBOUND, b'IDSa.b;')
+            recorder.close()
+
+            avr = anthemav.AVR(loop=self.loop)
+            started = self.loop.time()
+            yield from anthemav.replay(avr, self.path, speed=2, loop=self.loop)
+            self.assertGreaterEqual(self.loop.time() - started, 0.09)
+            self.assertEqual(avr.swversion, 'a.b')
+        self.run_async(run())
+
+
+class CoalesceTest(EmulatorTestCase):
+    """Queued commands for the same key collapse to the latest one."""
+
+    @asyncio.coroutine
+    def connect_powered(self, **options):
+        emulator = yield from self.start_emulator()
+        conn = yield from self.connect(emulator, **options)
+        yield from conn.protocol.set_power(True, timeout=1.0)
+        arrivals = self.record_arrivals(emulator)
+        return emulator, conn.protocol, arrivals
+
+    @staticmethod
+    def commands(arrivals):
+        return [message for _, message in arrivals if not message.endswith('?')]
+
+    def test_latest_command_wins(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr, arrivals = yield from self.connect_powered(coalesce=True)
+            for value in range(-50, -44):
+                avr.command('Z1VOL%d' % value)
+                if value == -48:
+                    avr.command('Z1MUT1')
+            yield from self.wait_until(lambda: avr.mute)
+            self.assertEqual(self.commands(arrivals), ['Z1VOL-45', 'Z1MUT1'])
+            self.assertEqual(emulator.state['Z1VOL'], '-45')
+        self.run_async(run())
+
+    def test_every_command_sent_without_coalesce(self):
+        @asyncio.coroutine
+        def run():
+            _, avr, arrivals = yield from self.connect_powered()
+            for value in range(-50, -44):
+                avr.command('Z1VOL%d' % value)
+            yield from self.wait_until(lambda: avr.attenuation == -45)
+            self.assertEqual(self.commands(arrivals),
+                             ['Z1VOL%d' % value for value in range(-50, -44)])
+        self.run_async(run())
+
+    def test_replaced_execute_completes(self):
+        @asyncio.coroutine
+        def run():
+            _, avr, arrivals = yield from self.connect_powered(coalesce=True)
+            values = yield from asyncio.gather(
+                avr.execute('Z1VOL-50'), avr.execute('Z1VOL-44'),
+                avr.set_attenuation(-44), loop=self.loop)
+            self.assertEqual(values, ['-44', '-44', '-44'])
+            self.assertEqual(self.commands(arrivals), ['Z1VOL-44'])
+        self.run_async(run())
+
+    def test_ramp_volume(self):
+        @asyncio.coroutine
+        def run():
+            emulator, avr, arrivals = yield from self.connect_powered(
+                coalesce=True, commands_per_second=20)
+            started = self.loop.time()
+            self.assertEqual((yield from avr.ramp_volume(50, 0.3)), '-45')
+            self.assertGreaterEqual(self.loop.time() - started, 0.2)
+            sent = [int(message[5:]) for message in self.commands(arrivals)]
+            self.assertEqual(sent, sorted(sent))
+            self.assertEqual(sent[-1], -45)
+            self.assertEqual(emulator.state['Z1VOL'], '-45')
+            self.assertEqual(avr.volume, 50)
+        self.run_async(run())
+
+
+class StateCacheTest(EmulatorTestCase):
+    """Known state is saved debounced and restored before the device answers."""
+
+    def setUp(self):
+        # Removed last, the cache is flushed when the connections drop
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'state.json')
+        super().setUp()
+
+    def write_cache(self, emulator, mac, state):
+        """Store state for mac, aliased to the address of emulator."""
+        name = '%s:%d' % (emulator.host, emulator.port)
+        with open(self.path, 'w') as cache_file:
+            json.dump({'devices': {mac: {'state': state, 'inputs': {}}},
+                       'aliases': {name: mac}}, cache_file)
+
+    def test_save_is_debounced(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            cache = anthemav.StateCache(self.path, delay=0.3, loop=self.loop)
+            save = unittest.mock.patch.object(cache, 'save', wraps=cache.save)
+            with save as saved:
+                conn = yield from self.connect(emulator, state_cache=cache)
+                yield from conn.protocol.fetch('IDN')
+                self.assertFalse(saved.called)
+                yield from self.wait_until(lambda: saved.called)
+                yield from asyncio.sleep(0.4, loop=self.loop)
+                self.assertEqual(saved.call_count, 1)
+
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+            mac = '00:11:22:33:44:55'
+            self.assertEqual(data['aliases'],
+                             {'%s:%d' % (emulator.host, emulator.port): mac})
+            self.assertEqual(data['devices'][mac]['state']['IDM'], 'MRX 520')
+        self.run_async(run())
+
+    def test_warm_start_from_alias(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            mac = '00:11:22:33:44:55'
+            self.write_cache(emulator, mac, {'IDN': mac, 'IDM': 'MRX 520',
+                                             'IDS': '0.9'})
+            cache = anthemav.StateCache(self.path, loop=self.loop)
+            conn = yield from self.connect(emulator, state_cache=cache,
+                                           wait=False)
+            avr = conn.protocol
+            self.assertEqual(avr.model, 'MRX 520')
+            self.assertEqual(avr.swversion, '0.9')
+            self.assertEqual(avr.stale, {'IDN', 'IDM', 'IDS'})
+
+            yield from conn.wait_connected(1)
+            yield from avr.fetch('IDN')
+            self.assertEqual(avr.stale, {'IDS'})
+            self.assertEqual((yield from avr.fetch('IDS')), '1.0.0')
+            self.assertEqual(avr.stale, set())
+        self.run_async(run())
+
+    def test_other_device_is_discarded(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            mac = 'AA:BB:CC:DD:EE:FF'
+            self.write_cache(emulator, mac, {'IDN': mac, 'IDM': 'AVM 60',
+                                             'Z1VOL': '-20'})
+            cache = anthemav.StateCache(self.path, loop=self.loop)
+            conn = yield from self.connect(emulator, state_cache=cache)
+            avr = conn.protocol
+            yield from avr.fetch('IDN')
+            self.assertEqual(avr.stale, set())
+            self.assertEqual(avr.model, 'MRX 520')
+            self.assertEqual(avr.state.get('Z1VOL'), '')
+        self.run_async(run())
+
+    def test_cached_power_on_still_refreshes(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator(state={'Z1POW': '1'})
+            mac = '00:11:22:33:44:55'
+            self.write_cache(emulator, mac, {'IDN': mac, 'Z1POW': '1'})
+            cache = anthemav.StateCache(self.path, loop=self.loop)
+            conn = yield from self.connect(emulator, state_cache=cache)
+            avr = conn.protocol
+            self.assertTrue(avr.power)
+            yield from self.wait_until(lambda: avr.poweron_complete)
+            self.assertEqual((yield from avr.poweron_complete), set())
+            self.assertIn('Z1VOL?', emulator.received)
+        self.run_async(run())
+
+
+class SubscribeTest(EmulatorTestCase):
+    """Subscribers only receive changes to the keys they asked for."""
+
+    @asyncio.coroutine
+    def changes(self, avr, data):
+        """Feed data to avr and let the scheduled callbacks run."""
+        avr.data_received(data)
+        yield from asyncio.sleep(0, loop=self.loop)
+
+    def test_matching_keys_only(self):
+        @asyncio.coroutine
+        def run():
+            avr = anthemav.AVR(loop=self.loop)
+            volume, both = [], []
+            avr.subscribe({'Z1VOL'}, volume.append)
+            avr.subscribe(['Z1VOL', 'Z1MUT'], both.append)
+            yield from self.changes(avr, b'Z1VOL-40;Z1MUT1;Z2VOL-30;')
+            self.assertEqual(volume, [anthemav.Change('Z1VOL', '', '-40')])
+            self.assertEqual(both, [anthemav.Change('Z1VOL', '', '-40'),
+                                    anthemav.Change('Z1MUT', '', '1')])
+        self.run_async(run())
+
+    def test_all_keys(self):
+        @asyncio.coroutine
+        def run():
+            avr = anthemav.AVR(loop=self.loop)
+            changes = []
+            avr.subscribe(None, changes.append)
+            yield from self.changes(avr, b'Z1VOL-40;Z2VOL-30;IDMMRX 520;')
+            self.assertEqual([change.key for change in changes],
+                             ['Z1VOL', 'Z2VOL', 'IDM'])
+        self.run_async(run())
+
+    def test_cancel_stops_delivery(self):
+        @asyncio.coroutine
+        def run():
+            avr = anthemav.AVR(loop=self.loop)
+            changes, others = [], []
+            handle = avr.subscribe({'Z1VOL'}, changes.append)
+            avr.subscribe({'Z1VOL'}, others.append)
+            yield from self.changes(avr, b'Z1VOL-40;')
+            handle.cancel()
+            self.assertFalse(handle.active)
+            handle.cancel()
+            yield from self.changes(avr, b'Z1VOL-41;')
+            self.assertEqual(len(changes), 1)
+            self.assertEqual(len(others), 2)
+        self.run_async(run())
+
+    def test_index_drops_empty_keys(self):
+        index = anthemav.events.SubscriberIndex()
+        first = index.add({'Z1VOL', 'Z1MUT'}, print)
+        second = index.add(None, print)
+        self.assertTrue(index)
+        first.cancel()
+        second.cancel()
+        self.assertFalse(index)
+
+
+class UpdateWindowTest(EmulatorTestCase):
+    """With update_window set, changes reach update_callback as one dict."""
+
+    @asyncio.coroutine
+    def avr(self, update_window):
+        """Return an AVR with known volume and mute, and its callback list."""
+        calls = []
+        avr = anthemav.AVR(loop=self.loop, update_callback=calls.append,
+                           update_window=update_window)
+        avr.data_received(b'Z1VOL-40;Z1MUT0;')
+        yield from asyncio.sleep((update_window or 0) + 0.05, loop=self.loop)
+        del calls[:]
+        return avr, calls
+
+    def test_burst_is_flushed_at_once(self):
+        @asyncio.coroutine
+        def run():
+            avr, calls = yield from self.avr(0)
+            avr.data_received(b'Z1VOL-41;Z1MUT1;')
+            avr.data_received(b'Z1VOL-42;')
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(calls, [{'Z1VOL': ('-40', '-42'),
+                                      'Z1MUT': ('0', '1')}])
+
+            avr.data_received(b'Z1VOL-43;')
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(calls[1:], [{'Z1VOL': ('-42', '-43')}])
+        self.run_async(run())
+
+    def test_changes_are_gathered_for_the_window(self):
+        @asyncio.coroutine
+        def run():
+            avr, calls = yield from self.avr(0.2)
+            started = self.loop.time()
+            avr.data_received(b'Z1VOL-41;')
+            yield from asyncio.sleep(0.1, loop=self.loop)
+            avr.data_received(b'Z1MUT1;')
+            yield from asyncio.sleep(0.05, loop=self.loop)
+            self.assertEqual(calls, [])
+
+            yield from self.wait_until(lambda: calls)
+            self.assertGreaterEqual(self.loop.time() - started, 0.19)
+            self.assertEqual(calls, [{'Z1VOL': ('-40', '-41'),
+                                      'Z1MUT': ('0', '1')}])
+        self.run_async(run())
+
+    def test_change_back_is_dropped(self):
+        @asyncio.coroutine
+        def run():
+            avr, calls = yield from self.avr(0.1)
+            avr.data_received(b'Z1VOL-41;Z1MUT1;')
+            avr.data_received(b'Z1VOL-40;')
+            yield from asyncio.sleep(0.2, loop=self.loop)
+            self.assertEqual(calls, [{'Z1MUT': ('0', '1')}])
+
+            avr.data_received(b'Z1MUT0;Z1MUT1;')
+            yield from asyncio.sleep(0.2, loop=self.loop)
+            self.assertEqual(len(calls), 1)
+        self.run_async(run())
+
+    def test_datagram_callbacks_are_suppressed(self):
+        @asyncio.coroutine
+        def run():
+            avr, calls = yield from self.avr(None)
+            avr.data_received(b'Z1VOL-41;')
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(calls, ['Z1VOL-41'])
+
+            avr, calls = yield from self.avr(0)
+            avr.data_received(b'Z1VOL-41;Z1VOL-42;')
+            yield from asyncio.sleep(0.05, loop=self.loop)
+            self.assertEqual(calls, [{'Z1VOL': ('-40', '-42')}])
+        self.run_async(run())
+
+
+class ProfilesTest(EmulatorTestCase):
+    """Unsupported attributes are learned per model and saved debounced."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'profiles.json')
+
+    def test_saves_are_debounced(self):
+        @asyncio.coroutine
+        def run():
+            profiles = anthemav.Profiles(self.path, delay=0.1, loop=self.loop)
+            profiles.record('MRX 520', 'Z1DIA')
+            profiles.record('MRX 520', 'SIP')
+            self.assertFalse(os.path.exists(self.path))
+            yield from asyncio.sleep(0.2, loop=self.loop)
+            self.assertEqual(anthemav.Profiles(self.path).unsupported('MRX 520'),
+                             {'Z1DIA', 'SIP'})
+
+            profiles.forget('MRX 520', 'SIP')
+            profiles.flush()
+            self.assertEqual(anthemav.Profiles(self.path).unsupported('MRX 520'),
+                             {'Z1DIA'})
+        self.run_async(run())
+
+    def test_learn_and_forget(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator(unsupported={'Z1DIA'})
+            profiles = anthemav.Profiles(
+                self.path, {'MRX 520': ['Z1VOL']}, loop=self.loop)
+            conn = yield from self.connect(emulator, profiles=profiles)
+            avr = conn.protocol
+            missing = yield from self.power_on(conn)
+            self.assertEqual(missing, set())
+            self.assertEqual(avr.unsupported, {'Z1DIA', 'Z1VOL'})
+
+            # The device answering a key shows it is supported after all
+            yield from avr.execute('Z1VOL-30')
+            self.assertEqual(avr.unsupported, {'Z1DIA'})
+            conn.close()
+            yield from self.wait_until(lambda: avr.transport is None)
+            self.assertEqual(anthemav.Profiles(self.path).unsupported('MRX 520'),
+                             {'Z1DIA'})
+        self.run_async(run())
+
+
+class EventStreamTest(EmulatorTestCase):
+    """Event streams apply their policy when the consumer falls behind."""
+
+    @asyncio.coroutine
+    def connect_echoing(self, emulator, **options):
+        conn = yield from self.connect(emulator, **options)
+        # Once this is answered the emulator has seen ECH1 and the initial
+        # queries are out of the way
+        yield from conn.protocol.fetch('IDN')
+        return conn
+
+    @asyncio.coroutine
+    def push_volumes(self, emulator, values, gap=0.02):
+        for value in values:
+            emulator.push('Z1VOL', str(value))
+            yield from asyncio.sleep(gap, loop=self.loop)
+
+    @asyncio.coroutine
+    def drain(self, stream):
+        changes = []
+        while len(stream):
+            changes.append((yield from stream.get()))
+        return changes
+
+    def test_drop_oldest(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect_echoing(emulator)
+            with conn.protocol.events(keys={'Z1VOL'}, maxsize=2) as stream:
+                yield from self.push_volumes(emulator, range(-50, -45))
+                changes = yield from self.drain(stream)
+            self.assertEqual([change.value for change in changes], ['-47', '-46'])
+            self.assertEqual(changes[0].oldvalue, '-48')
+            self.assertEqual(stream.dropped, 3)
+        self.run_async(run())
+
+    def test_coalesce(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect_echoing(emulator, metrics=True)
+            volume = conn.protocol.state.get('Z1VOL')
+            mute = conn.protocol.state.get('Z1MUT')
+            with conn.protocol.events(maxsize=2, policy='coalesce') as stream:
+                yield from self.push_volumes(emulator, range(-50, -45))
+                emulator.push('Z1MUT', '1')
+                yield from self.wait_until(lambda: len(stream) == 2)
+                changes = yield from self.drain(stream)
+            self.assertEqual(changes, [('Z1VOL', volume, '-46'), ('Z1MUT', mute, '1')])
+            self.assertEqual(stream.dropped, 0)
+
+            with conn.protocol.events(maxsize=1, policy='coalesce') as stream:
+                emulator.push('Z1MUT', '0')
+                emulator.push('Z1VOL', '-30')
+                yield from self.wait_until(lambda: conn.protocol.attenuation == -30)
+                changes = yield from self.drain(stream)
+            self.assertEqual(changes, [('Z1VOL', '-46', '-30')])
+            self.assertEqual(stream.dropped, 1)
+            self.assertEqual(conn.metrics.get('events_dropped'), 1)
+        self.run_async(run())
+
+    def test_block_pauses_reading(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect_echoing(emulator)
+            avr = conn.protocol
+            with avr.events(keys={'Z1VOL'}, maxsize=2, policy='block') as stream:
+                yield from self.push_volumes(emulator, range(-50, -44))
+                # Reading stopped once the stream filled up
+                self.assertTrue(avr.reading_paused)
+                self.assertEqual(len(stream), 2)
+                self.assertEqual(avr.attenuation, -49)
+
+                changes = []
+                while len(changes) < 6:
+                    changes.append((yield from stream.get()))
+            self.assertEqual([change.value for change in changes],
+                             [str(value) for value in range(-50, -44)])
+            self.assertEqual(stream.dropped, 0)
+            self.assertFalse(avr.reading_paused)
+            self.assertEqual(avr.attenuation, -45)
+        self.run_async(run())
+
+    def test_close_ends_iteration(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect_echoing(emulator)
+            stream = conn.protocol.events(keys={'Z1VOL'}, policy='block', maxsize=1)
+            waiter = protocol.ensure_future(stream.get(), loop=self.loop)
+            yield from asyncio.sleep(0.01, loop=self.loop)
+            stream.close()
+            self.assertIsNone((yield from waiter))
+            with self.assertRaises(StopAsyncIteration):  # noqa: F821
+                yield from stream.__anext__()
+            # A closed stream no longer holds up reading
+            emulator.push('Z1VOL', '-30')
+            yield from self.wait_until(lambda: conn.protocol.attenuation == -30)
+            self.assertEqual(len(stream), 0)
+        self.run_async(run())
+
+
+class ProxyClient:
+    """Raw protocol client used to talk to a Proxy."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = b''
+
+    def send(self, *messages):
+        self.writer.write(''.join(message+';' for message in messages).encode())
+
+    @asyncio.coroutine
+    def receive(self):
+        """Return the next datagram from the proxy."""
+        while b';' not in self.buffer:
+            data = yield from self.reader.read(1024)
+            if not data:
+                raise EOFError('Proxy closed the connection')
+            self.buffer += data
+        message, _, self.buffer = self.buffer.partition(b';')
+        return message.decode()
+
+
+class ProxyTest(EmulatorTestCase):
+    """Several clients share one upstream connection through a Proxy."""
+
+    @asyncio.coroutine
+    def start_proxy(self, emulator_options=None, **options):
+        emulator = yield from self.start_emulator(**(emulator_options or {}))
+        conn = yield from self.connect(emulator)
+        missing = yield from self.power_on(conn)
+        self.assertEqual(missing, set())
+        proxy = Proxy(conn, port=0, loop=self.loop, **options)
+        yield from proxy.start()
+        self.addCleanup(proxy.close)
+        return emulator, proxy, self.record_arrivals(emulator)
+
+    @asyncio.coroutine
+    def open_client(self, proxy, echo=False):
+        reader, writer = yield from asyncio.open_connection(
+            proxy.host, proxy.port, loop=self.loop)
+        self.addCleanup(writer.close)
+        client = ProxyClient(reader, writer)
+        if echo:
+            client.send('ECH1')
+            self.assertEqual((yield from client.receive()), 'ECH1')
+        return client
+
+    def test_queries_answered_from_state(self):
+        @asyncio.coroutine
+        def run():
+            _, proxy, arrivals = yield from self.start_proxy()
+            client = yield from self.open_client(proxy)
+            client.send('Z1VOL?', 'ISN02?', 'IDM?', 'FOO?')
+            self.assertEqual((yield from client.receive()), 'Z1VOL-40')
+            self.assertEqual((yield from client.receive()), 'ISN02Game')
+            self.assertEqual((yield from client.receive()), 'IDMMRX 520')
+            self.assertEqual((yield from client.receive()), '!IFOO?')
+            self.assertEqual(arrivals, [])
+        self.run_async(run())
+
+    def test_unknown_command_is_refused(self):
+        @asyncio.coroutine
+        def run():
+            _, proxy, arrivals = yield from self.start_proxy()
+            client = yield from self.open_client(proxy)
+            client.send('FOO1', 'IDM?')
+            self.assertEqual((yield from client.receive()), '!IFOO1')
+            self.assertEqual((yield from client.receive()), 'IDMMRX 520')
+            self.assertEqual(arrivals, [])
+        self.run_async(run())
+
+    def test_concurrent_queries_share_one_request(self):
+        @asyncio.coroutine
+        def run():
+            emulator, proxy, arrivals = yield from self.start_proxy(
+                {'latency': 0.05}, max_age=0)
+            first = yield from self.open_client(proxy)
+            second = yield from self.open_client(proxy)
+            first.send('Z1BRT?')
+            second.send('Z1BRT?')
+            self.assertEqual((yield from first.receive()), 'Z1BRT640')
+            self.assertEqual((yield from second.receive()), 'Z1BRT640')
+            self.assertEqual([message for _, message in arrivals], ['Z1BRT?'])
+        self.run_async(run())
+
+    def test_commands_are_merged_and_broadcast(self):
+        @asyncio.coroutine
+        def run():
+            emulator, proxy, arrivals = yield from self.start_proxy(
+                {'latency': 0.05})
+            first = yield from self.open_client(proxy, echo=True)
+            second = yield from self.open_client(proxy, echo=True)
+            quiet = yield from self.open_client(proxy)
+            first.send('Z1VOL-35')
+            second.send('Z1VOL-35')
+            self.assertEqual((yield from first.receive()), 'Z1VOL-35')
+            self.assertEqual((yield from second.receive()), 'Z1VOL-35')
+            self.assertEqual([message for _, message in arrivals], ['Z1VOL-35'])
+            self.assertEqual(emulator.state['Z1VOL'], '-35')
+
+            # Only clients with Tx status on are told about changes
+            quiet.send('IDM?')
+            self.assertEqual((yield from quiet.receive()), 'IDMMRX 520')
+        self.run_async(run())
+
+    def test_command_results_go_to_sender(self):
+        @asyncio.coroutine
+        def run():
+            _, proxy, _ = yield from self.start_proxy()
+            first = yield from self.open_client(proxy, echo=True)
+            second = yield from self.open_client(proxy, echo=True)
+            first.send('Z1VOL10')
+            self.assertEqual((yield from first.receive()), '!RZ1VOL10')
+            # A command that changes nothing is still echoed to its sender
+            second.send('Z1VOL-40')
+            self.assertEqual((yield from second.receive()), 'Z1VOL-40')
+            first.send('IDM?')
+            self.assertEqual((yield from first.receive()), 'IDMMRX 520')
+        self.run_async(run())
+
+    def test_close_drops_clients(self):
+        @asyncio.coroutine
+        def run():
+            _, proxy, _ = yield from self.start_proxy()
+            client = yield from self.open_client(proxy)
+            yield from self.wait_until(lambda: proxy.clients)
+            proxy.close()
+            with self.assertRaises(EOFError):
+                yield from client.receive()
+            self.assertEqual(proxy.clients, set())
+        self.run_async(run())
+
+
+class SyncClientTest(EmulatorTestCase):
+    """SyncAVR gives blocking access from a thread without an event loop."""
+
+    def setUp(self):
+        super().setUp()
+        self.emulator = self.loop.run_until_complete(self.start_emulator())
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.loop.call_soon_threadsafe, self.loop.stop)
+
+    def wait_until(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out waiting for condition')
+            time.sleep(0.01)
+
+    def test_blocking_calls(self):
+        with anthemav.SyncAVR(self.emulator.host, self.emulator.port,
+                              timeout=5) as client:
+            self.assertEqual(client.set_power(True), '1')
+            self.assertEqual(client.fetch('IDM'), 'MRX 520')
+            client.volume = 50
+            self.wait_until(lambda: client.volume == 50)
+            self.assertEqual(client.batch(client.avr.fetch('IDN'),
+                                          client.avr.set_mute(True)),
+                             ['00:11:22:33:44:55', '1'])
+            self.assertEqual(client.unsupported, set())
+
+    def test_zone_is_proxied(self):
+        with anthemav.SyncAVR(self.emulator.host, self.emulator.port,
+                              timeout=5) as client:
+            zone = client.zone(2)
+            self.assertIsInstance(zone, SyncProxy)
+            self.assertEqual(zone.set_power(True), '1')
+            self.assertEqual(zone.set_volume(50), '-45')
+            self.assertEqual(zone.volume, 50)
+            zone.volume = 40
+            self.wait_until(lambda: self.emulator.state['Z2VOL'] != '-45')
+            self.assertEqual(zone.volume, 40)
+
+    def test_events_and_subscriptions(self):
+        with anthemav.SyncAVR(self.emulator.host, self.emulator.port,
+                              timeout=5) as client:
+            client.set_power(True)
+            changes = []
+            subscription = client.subscribe({'Z1MUT'}, changes.append)
+            self.assertIsInstance(subscription, SyncProxy)
+            with client.events(keys={'Z1VOL'}) as stream:
+                self.assertIsInstance(stream, SyncEventStream)
+                client.set_volume(50)
+                self.assertEqual(next(stream).value, '-45')
+                self.assertEqual(len(stream), 0)
+                threading.Timer(0.1, stream.close).start()
+                self.assertEqual(list(stream), [])
+
+            client.set_mute(True)
+            self.wait_until(lambda: changes)
+            subscription.cancel()
+            self.assertFalse(subscription.active)
+            self.assertEqual(changes[0].value, '1')
+
+
+class HeartbeatTest(EmulatorTestCase):
+    """Half-open connections are detected and reconnected."""
+
+    def test_keepalive(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, keepalive=30)
+            sock = conn.transport.get_extra_info('socket')
+            self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                self.assertEqual(
+                    sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 30)
+        self.run_async(run())
+
+    def test_idle_connection_is_probed(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            arrivals = self.record_arrivals(emulator)
+            conn = yield from self.connect(emulator, heartbeat=0.2)
+            yield from asyncio.sleep(0.7, loop=self.loop)
+            probes = [message for _, message in arrivals if message == 'Z1POW?']
+            # One from refresh_core, the rest from the heartbeat
+            self.assertGreaterEqual(len(probes), 3)
+            self.assertTrue(conn.connected)
+            self.assertIsNone(conn.health()['last_error'])
+
+            task = conn._heartbeat_task
+            conn.close()
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertTrue(task.cancelled())
+        self.run_async(run())
+
+    def test_silent_device_is_reconnected(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(
+                emulator, auto_reconnect=True, retry_base=0.05, metrics=True,
+                heartbeat=0.2, heartbeat_timeout=0.2)
+            transport = conn.transport
+            handle = emulator.handle
+            emulator.handle = lambda client, message: None
+            yield from self.wait_until(
+                lambda: conn.transport not in (None, transport))
+            emulator.handle = handle
+            self.assertEqual(conn.health()['last_error'], 'heartbeat timeout')
+            self.assertEqual(conn.metrics.get('heartbeat_failures'), 1)
+            self.assertEqual((yield from conn.protocol.fetch('IDM')), 'MRX 520')
+        self.run_async(run())
+
+    def test_paused_reading_is_not_silence(self):
+        @asyncio.coroutine
+        def run():
+            emulator = yield from self.start_emulator()
+            conn = yield from self.connect(emulator, heartbeat=0.2,
+                                           heartbeat_timeout=0.2)
+            avr = conn.protocol
+            yield from avr.fetch('IDN')
+            transport = conn.transport
+            with avr.events(keys={'Z1VOL'}, maxsize=2, policy='block') as stream:
+                for value in range(-50, -45):
+                    emulator.push('Z1VOL', str(value))
+                    yield from asyncio.sleep(0.02, loop=self.loop)
+                self.assertTrue(avr.reading_paused)
+                yield from asyncio.sleep(1, loop=self.loop)
+                self.assertIs(conn.transport, transport)
+                self.assertIsNone(conn.health()['last_error'])
+                for _ in range(5):
+                    yield from stream.get()
+            yield from asyncio.sleep(0.5, loop=self.loop)
+            self.assertIs(conn.transport, transport)
+            self.assertIsNone(conn.health()['last_error'])
+        self.run_async(run())
+
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     loop = asyncio.get_event_loop()
     loop.run_until_complete(test())
+    unittest.main()